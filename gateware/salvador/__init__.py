@@ -8,7 +8,15 @@ def cli():
 	parser = ArgumentParser(formatter_class = ArgumentDefaultsHelpFormatter,
 		description = 'OPLSniffer')
 	actions = parser.add_subparsers(dest = 'action', required = True)
-	actions.add_parser('build', help = 'build a bitstream from the design')
+	build = actions.add_parser('build', help = 'build a bitstream from the design')
+	build.add_argument('--outputs', action = 'store_true',
+		help = 'drive the gear outputs on the PWM pins, which are bare test pads on the v0.1 board')
+	build.add_argument('--hard-spi', action = 'store_true',
+		help = 'drive the FRAM through the SB_SPI block rather than from fabric, saving LUTs but not faster')
+	build.add_argument('--spi-divider', type = int, default = 1,
+		help = 'system clock cycles in each half of the FRAM SCLK period')
+	build.add_argument('--spi-ddr', action = 'store_true',
+		help = 'run the FRAM SCLK at the full system clock rate using DDR I/O')
 	actions.add_parser('prep-sim', help = 'prepare cxxrtl for the C++ based sims')
 
 	register_cli(parser = parser)
@@ -27,7 +35,7 @@ def cli():
 		return 0
 
 	platform = SalvadorPlatform()
-	salvador = Salvador()
 	if args.action == 'build':
-		platform.build(salvador, name = 'iCEdSalvador')
+		platform.build(Salvador(outputs = args.outputs, hardBus = args.hard_spi, divider = args.spi_divider,
+			ddr = args.spi_ddr), name = 'iCEdSalvador')
 	return 0
@@ -0,0 +1,24 @@
+from nmigen import *
+
+__all__ = (
+	'BitClock',
+)
+
+class BitClock(Elaboratable):
+	# Phase accumulator that ticks at frequency on average, each tick jittering by up to a system clock cycle
+	def __init__(self, *, frequency : float, width : int = 32):
+		self.tick = Signal()
+
+		self._frequency = frequency
+		self._width = width
+
+	def elaborate(self, platform) -> Module:
+		m = Module()
+		clkFreq = platform.default_clk_frequency
+		if self._frequency >= clkFreq:
+			raise ValueError(f'Tick frequency {self._frequency}Hz must be below the system clock ({clkFreq}Hz)')
+		increment = round(self._frequency / clkFreq * (2 ** self._width))
+		phase = Signal(self._width)
+
+		m.d.sync += Cat(phase, self.tick).eq(phase + increment)
+		return m
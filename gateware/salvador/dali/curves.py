@@ -0,0 +1,71 @@
+from nmigen import *
+from .types import DimmingCurve
+
+__all__ = (
+	'curveTable',
+	'OutputCurve',
+)
+
+def logarithmicCurve(level : int) -> float:
+	# The standard curve, 0.1% of full output at level 1 rising by a factor of 1000 over the levels to 254
+	return 10 ** (((level - 1) * 3 / 253) - 3)
+
+def linearCurve(level : int) -> float:
+	return level / 254
+
+# The fraction of full output each curve gives for the levels 1 to 254, level 0 always being off
+curves = {
+	DimmingCurve.logarithmic: logarithmicCurve,
+	DimmingCurve.linear: linearCurve,
+}
+
+def curveTable(curve : DimmingCurve, bits : int = 16) -> list:
+	# Level 255 is a mask rather than a level, so it's given full output
+	full = (2 ** bits) - 1
+	return [0] + [round(curves[curve](min(level, 254)) * full) for level in range(1, 256)]
+
+class OutputCurve(Elaboratable):
+	# Visits the gear a cycle at a time, looking their level up again when it or their curve changes
+	def __init__(self, *, gearCount : int = 1, bits : int = 16):
+		self.levels = tuple(Signal(8, name = f'level{index}') for index in range(gearCount))
+		self.curves = tuple(Signal(DimmingCurve, name = f'curve{index}') for index in range(gearCount))
+		self.outputs = tuple(Signal(bits, name = f'output{index}') for index in range(gearCount))
+
+		self._gearCount = gearCount
+		self._bits = bits
+
+	def elaborate(self, platform) -> Module:
+		m = Module()
+		gearCount = self._gearCount
+		curveBits = len(self.curves[0])
+		contents = []
+		for curve in range(2 ** curveBits):
+			contents += curveTable(DimmingCurve(curve), self._bits) if curve in curves else [0] * 256
+		table = Memory(width = self._bits, depth = len(contents), init = contents)
+		m.submodules.tableRead = tableRead = table.read_port(transparent = False)
+
+		# Gear being visited, and the one the table's answering for
+		gear = Signal(range(gearCount))
+		lookupGear = Signal.like(gear)
+		lookupValid = Signal()
+		# What each gear's output was last looked up for, which matches the reset output of 0
+		lookups = Array(Signal(8 + curveBits, name = f'lookup{index}') for index in range(gearCount))
+		lookup = Array(Cat(level, curve) for level, curve in zip(self.levels, self.curves))[gear]
+		changed = Signal()
+
+		m.d.comb += [
+			changed.eq(lookup != lookups[gear]),
+			tableRead.addr.eq(lookup),
+			tableRead.en.eq(changed),
+		]
+		m.d.sync += [
+			gear.eq(Mux(gear == gearCount - 1, 0, gear + 1)),
+			lookupGear.eq(gear),
+			lookupValid.eq(changed),
+		]
+		with m.If(changed):
+			m.d.sync += lookups[gear].eq(lookup)
+		for index, output in enumerate(self.outputs):
+			with m.If(lookupValid & (lookupGear == index)):
+				m.d.sync += output.eq(tableRead.data)
+		return m
@@ -1,10 +1,13 @@
-from typing import Union
-from math import ceil
 from nmigen import *
 from .types import *
 from .serial import Serial
+from .frames import FrameFIFO
 from .decoder import CommandDecoder
-from ..fram import FRAM
+from .microcode import *
+from .persist import PersistLayout, PersistEngine
+from .fade import FadeEngine
+from .curves import OutputCurve
+from ..fram import FRAMPort
 
 __all__ = (
 	'DALI',
@@ -12,382 +15,587 @@ __all__ = (
 )
 
 class DALI(Elaboratable):
-	def __init__(self, *, interface : Record, deviceType : DeviceType, persistResource : tuple):
+	# The persisted registers and their sizes in bytes, in register map order. The scenes are named after the
+	# first of them as they always have been, and anything added since goes on the end to keep the rest in place
+	persistedRegisters = (
+		('group', 2),
+		('shortAddress', 1),
+		('maxLevel', 1),
+		('minLevel', 1),
+		('failureLevel', 1),
+		('onLevel', 1),
+		('fadeTime', 1),
+		('fadeRate', 1),
+		('scene0', 16),
+		('dimmingCurve', 1),
+	)
+
+	def __init__(self, *, interface : Record, deviceType : DeviceType, persistResource : tuple = None,
+		persistMemory : FRAMPort = None, persistHardBus : bool = False, persistDivider : int = 1,
+		persistDDR : bool = False, persistHoldoff : float = 100e-3, rxDepth : int = 4,
+		settlingTime : tuple = (5.5e-3, 10.5e-3), settlingJitter : float = 0, gearCount : int = 1):
 		self._interface = interface
 		self._deviceType = deviceType
 		self.error = Signal()
+		# Count of register stores that didn't need writing back as FRAM already held the value
+		self.suppressedWrites = Signal(16)
+		# Count of forward frames lost because they arrived with the receive queue full
+		self.rxOverflows = Signal(16)
+		# Set when the last response couldn't be sent inside the settling window and was dropped
+		self.responseMissed = Signal()
+		# Count of responses abandoned because another device was sending at the same time
+		self.txCollisions = Signal(16)
+		# Count of queries the gear answered differently, where only the lowest numbered gear's answer went out
+		self.responseConflicts = Signal(16)
 		self.phyiscalMinLevel = Const(1, 8)
 		self._framMap = {}
+		self._framSizes = {}
+		self._framDefaults = {}
 		self._framNextAddr = 0
+		# The FRAM to keep the registers in, either a resource of our own or a port onto one that's shared
 		self._persistResource = persistResource
+		self._persistMemory = persistMemory
+		# Whether a FRAM resource of our own is driven through the SB_SPI block rather than from fabric
+		self._persistHardBus = persistHardBus
+		# and how fast its SCLK runs, as for FRAM
+		self._persistDivider = persistDivider
+		self._persistDDR = persistDDR
+		# How long the bus must be quiet before queued register writes are drained to FRAM
+		self._persistHoldoff = persistHoldoff
+		# How many forward frames can be waiting while we're busy with another
+		self._rxDepth = rxDepth
+		# Window after the end of a forward frame responses are started in, and how far they're randomly spread
+		self._settlingTime = settlingTime
+		self._settlingJitter = settlingJitter
+		# How many logical control gear the bus serves, each with its own slot in the register map. Journal
+		# entries address the register map with a single byte, which limits us to 9 of them
+		assert 1 <= gearCount <= 9, 'Between 1 and 9 control gear can share a bus'
+		self._gearCount = gearCount
+		# Each gear's actual level after its dimming curve, as a fraction of full output
+		self.outputs = tuple(Signal(16, name = f'output{index}') for index in range(gearCount))
 
 	def elaborate(self, platform):
 		m = Module()
-		m.submodules.serial = serial = Serial()
+		m.submodules.serial = serial = Serial(settlingTime = self._settlingTime, settlingJitter = self._settlingJitter)
 		m.submodules.decoder = decoder = CommandDecoder(deviceType = self._deviceType)
-		m.submodules.persistMemory = persistMemory = FRAM(resourceName = self._persistResource)
+		m.submodules.rxFrames = rxFrames = FrameFIFO(depth = self._rxDepth)
 		interface = self._interface
 
-		readAddress = Signal(11)
+		# The forward frame currently being worked on
+		frame = Signal.like(rxFrames.data)
+		frameError = Signal()
 
 		address = Signal(8)
 		commandBits = Signal(8)
-		command = Signal.like(decoder.command)
 		commandData = Signal.like(decoder.data)
-		deviceCommand = Signal.like(decoder.deviceCommand)
-
-		actualLevel = Signal(8)
-		onLevel = Signal.like(actualLevel)
-		failureLevel = Signal.like(actualLevel)
-		minLevel = Signal.like(actualLevel)
-		maxLevel = Signal.like(actualLevel)
-		fadeRate = Signal(range(16))
-		fadeTime = Signal(range(16))
-		shortAddress = Signal(8)
+
+		# Every gear has its own level, DTR and state flags, the ones being worked on picked out by gear
+		gearCount = self._gearCount
+		gear = Signal(range(gearCount))
+		# The levels themselves belong to the fade engine, which steps them along as fades run
+		m.submodules.fade = fade = FadeEngine(gearCount = gearCount)
+		actualLevel = Array(fade.levels)[gear]
+		fadeTime = Array(Signal(4, name = f'fadeTime{i}') for i in range(gearCount))
+		fadeRate = Array(Signal(4, name = f'fadeRate{i}') for i in range(gearCount))
+		minLevel = Array(Signal(8, name = f'minLevel{i}') for i in range(gearCount))
+		maxLevel = Array(Signal(8, name = f'maxLevel{i}') for i in range(gearCount))
+		m.submodules.outputCurve = outputCurve = OutputCurve(gearCount = gearCount, bits = len(self.outputs[0]))
+		dimmingCurve = outputCurve.curves
 		searchAddress = Signal(24)
 		randomAddress = Signal(24)
-		group = Signal(16)
-		scene = Array(Signal(8, name = f'scene{i}') for i in range(16))
 		status = Signal(8)
-		dtr = Signal(8)
+		dtr = Array(Signal(8, name = f'dtr{i}') for i in range(gearCount))[gear]
 		dtr1 = Signal(8)
 		dtr2 = Signal(8)
 		response = Signal(8)
-		allowMemoryWrite = Signal()
+		responded = Signal()
+		responseConflicts = Signal.like(self.responseConflicts)
+		allowMemoryWrite = Signal(gearCount)
 		powerFailure = Signal(reset = 1)
 
+		# The persisted registers all live in the one block RAM, laid out byte for byte the same as the FRAM
+		# register map so the boot load streams straight into it and stores are a single indexed write.
+		# Addressing state comes first so the boot load gets to it before anything else and we can
+		# work out which frames are for us as early as possible. Each gear's registers follow on from the last's
+		defaults = self.registerDefaults()
+		for index in range(gearCount):
+			for name, length in self.persistedRegisters:
+				self.mapRegister(self.gearRegister(index, name), length, defaults[name])
+		self._persistLayout = layout = self.persistedLayout()
+		gearLength = layout.length // gearCount
+		registers = Memory(width = 8, depth = layout.length, init = layout.defaults)
+		m.submodules.registerRead = registerRead = registers.read_port(transparent = False)
+		m.submodules.registerWrite = registerWrite = registers.write_port()
+		# Where the registers of the gear being worked on start
+		gearBase = Signal.like(registerRead.addr)
+		m.submodules.persist = persist = PersistEngine(resourceName = self._persistResource,
+			memory = self._persistMemory, hardBus = self._persistHardBus, divider = self._persistDivider,
+			ddr = self._persistDDR, layout = layout, holdoff = self._persistHoldoff)
+
+		# Register stores are posted to the persistence engine's queue the cycle after they execute
+		writebackAddress = Signal.like(persist.writeAddress)
+		writebackData = Signal.like(persist.writeData)
+		writebackPending = Signal()
+
+		m.d.comb += [
+			persist.writeAddress.eq(writebackAddress),
+			persist.writeData.eq(writebackData),
+			persist.writeValid.eq(writebackPending),
+			persist.activity.eq(serial.dataAvailable),
+			self.suppressedWrites.eq(persist.suppressedWrites),
+		]
+		with m.If(persist.writeReady):
+			m.d.sync += writebackPending.eq(0)
+
+		# The boot load runs alongside the command path, filling in registers as their bytes stream past
+		loadedBytes = Signal(layout.length)
+		addressingLoaded = Signal()
+		limitsLoaded = Signal()
+		# Putting the defaults back after a bad image takes a pass over the register file
+		restoring = Signal()
+		restoreAddress = Signal(range(layout.length))
+		registersLoaded = Signal()
+
+		with m.If(persist.loadValid):
+			m.d.sync += loadedBytes.bit_select(persist.loadAddress, 1).eq(1)
+			m.d.comb += [
+				registerWrite.addr.eq(persist.loadAddress),
+				registerWrite.data.eq(persist.loadData),
+				registerWrite.en.eq(1),
+			]
+		# The stored image was no good, so everything goes back to its defaults, each register becoming
+		# available again as it's restored
+		with m.If(persist.loadFailed):
+			m.d.sync += [
+				loadedBytes.eq(0),
+				restoring.eq(1),
+				restoreAddress.eq(0),
+				writebackPending.eq(0),
+			]
+		with m.Elif(restoring):
+			m.d.sync += loadedBytes.bit_select(restoreAddress, 1).eq(1)
+			m.d.comb += [
+				registerWrite.addr.eq(restoreAddress),
+				registerWrite.data.eq(Array(Const(value, 8) for value in layout.defaults)[restoreAddress]),
+				registerWrite.en.eq(1),
+			]
+			with m.If(restoreAddress == layout.length - 1):
+				m.d.sync += restoring.eq(0)
+			with m.Else():
+				m.d.sync += restoreAddress.eq(restoreAddress + 1)
+
+		# Keep track of whether each gear has a short address, along with the fade time and rate the fade engine
+		# needs, the limits the level commands hold the level to and the dimming curve its output is looked up on,
+		# from what gets written to them
+		shortAddressAddr = self.mapRegister('shortAddress')
+		missingShortAddress = Signal(gearCount,
+			reset = 2 ** gearCount - 1 if layout.defaults[shortAddressAddr] == 255 else 0)
+		for index in range(gearCount):
+			snooped = (
+				('shortAddress', missingShortAddress[index], registerWrite.data == 255),
+				('fadeTime', fadeTime[index], registerWrite.data),
+				('fadeRate', fadeRate[index], registerWrite.data),
+				('minLevel', minLevel[index], registerWrite.data),
+				('maxLevel', maxLevel[index], registerWrite.data),
+				('dimmingCurve', dimmingCurve[index], registerWrite.data),
+			)
+			for name, register, value in snooped:
+				registerAddr = self.mapRegister(self.gearRegister(index, name))
+				with m.If(registerWrite.en & (registerWrite.addr == registerAddr)):
+					m.d.sync += register.eq(value)
+
+		# Stores have to wait for the load to finish, as a damaged image puts every register back to its default
+		m.d.comb += [
+			registersLoaded.eq(persist.loaded & ~restoring),
+			addressingLoaded.eq(Array(self.registerLoaded(loadedBytes, self.gearRegister(index, 'group')) &
+				self.registerLoaded(loadedBytes, self.gearRegister(index, 'shortAddress'))
+				for index in range(gearCount))[gear]),
+			limitsLoaded.eq(Array(self.registerLoaded(loadedBytes, self.gearRegister(index, 'minLevel')) &
+				self.registerLoaded(loadedBytes, self.gearRegister(index, 'maxLevel'))
+				for index in range(gearCount))[gear]),
+		]
+
+		# Commands are run by stepping through their programs in the microcode ROM, each op combining a source with
+		# the accumulator and sending the result on to wherever the op says. Programs address the first gear's
+		# registers, so the gear being run's base is added to get at its own
+		programs = commandPrograms(deviceType = self._deviceType, physicalMinLevel = self.phyiscalMinLevel.value)
+		microcode = Memory(width = sum(width for _, width in microOpLayout), depth = 256,
+			init = assemble(programs, deviceCommandPrograms(self._deviceType), self.mapRegister))
+		m.submodules.microcodeRead = microcodeRead = microcode.read_port(transparent = False)
+		microOp = Record(microOpLayout)
+		microPC = Signal.like(microcodeRead.addr)
+		acc = Signal(8)
+		source = Signal(8)
+		result = Signal(8)
+		registerAddress = Signal.like(registerRead.addr)
+		# Where the last read was from, so the operand sticks around until the next
+		readAddress = Signal.like(registerRead.addr)
+		stall = Signal()
+		# Each command's program starts at its value in the ROM, device specific ones from 64 on
+		entry = Signal.like(microPC)
+
+		m.d.comb += [
+			entry.eq(Mux(decoder.command == DALICommand.deviceSpecific, 64 + decoder.deviceCommand, decoder.command)),
+			microcodeRead.addr.eq(microPC),
+			microOp.eq(microcodeRead.data),
+			registerRead.addr.eq(readAddress),
+		]
+		with m.Switch(microOp.src):
+			for src, value in ((Source.acc, acc), (Source.operand, registerRead.data), (Source.immediate, microOp.arg),
+				(Source.dtr, dtr), (Source.dtr1, dtr1), (Source.dtr2, dtr2), (Source.level, actualLevel),
+				(Source.status, status), (Source.randomAddrL, randomAddress[0:8]),
+				(Source.randomAddrM, randomAddress[8:16]), (Source.randomAddrH, randomAddress[16:24])):
+				with m.Case(src):
+					m.d.comb += source.eq(value)
+		with m.Switch(microOp.op):
+			with m.Case(Operation.load):
+				m.d.comb += result.eq(source)
+			with m.Case(Operation.min):
+				m.d.comb += result.eq(Mux(source < acc, source, acc))
+			with m.Case(Operation.max):
+				m.d.comb += result.eq(Mux(source > acc, source, acc))
+			with m.Case(Operation.setBit):
+				m.d.comb += result.eq(source | (1 << commandData[0:3]))
+			with m.Case(Operation.clearBit):
+				m.d.comb += result.eq(source & ~(1 << commandData[0:3]))
+			with m.Case(Operation.bit):
+				m.d.comb += result.eq(source.bit_select(microOp.arg[0:3], 1))
+			with m.Case(Operation.nibbles):
+				m.d.comb += result.eq(Cat(source[0:4], acc[0:4]))
+		with m.Switch(microOp.index):
+			with m.Case(Index.none):
+				m.d.comb += registerAddress.eq(gearBase + microOp.arg)
+			with m.Case(Index.data):
+				m.d.comb += registerAddress.eq(gearBase + microOp.arg + commandData)
+			with m.Case(Index.group):
+				m.d.comb += registerAddress.eq(gearBase + microOp.arg + commandData[3])
+		guardFailed = Signal()
+		with m.Switch(microOp.guard):
+			with m.Case(Guard.above):
+				m.d.comb += guardFailed.eq(source > microOp.arg)
+			with m.Case(Guard.notAbove):
+				m.d.comb += guardFailed.eq(source <= microOp.arg)
+			with m.Case(Guard.notAboveAcc):
+				m.d.comb += guardFailed.eq(source <= acc)
+			with m.Case(Guard.notBelowAcc):
+				m.d.comb += guardFailed.eq(source >= acc)
+		# Reads hold off until the register's been loaded, and stores until everything has. Persisting holds off
+		# while the last write-back is still waiting on the engine, which stops taking them as it drains its queue
+		m.d.comb += stall.eq((microOp.read & ~self.byteLoaded(loadedBytes, registerAddress)) |
+			(microOp.store & ~registersLoaded) | (microOp.persist & writebackPending & ~persist.writeReady))
+
 		m.d.comb += [
 			serial.rx.eq(interface.rx.i),
 			interface.tx.o.eq(serial.tx),
-			self.error.eq(serial.error),
+			rxFrames.dataIn.eq(serial.dataOut[:16]),
+			rxFrames.errorIn.eq(serial.error),
+			# Only 16-bit frames are for control gear, so backward frames (our own replies included, as we hear
+			# ourselves on the bus) and the 24 and 25-bit input device and event frames sharing the bus are dropped
+			# here rather than taking up room in the queue and a trip through the decoder
+			rxFrames.write.eq(serial.dataAvailable & (serial.error | (serial.dataLength == 16))),
+			self.rxOverflows.eq(rxFrames.overflows),
+			self.responseMissed.eq(serial.deadlineMissed),
+			self.txCollisions.eq(serial.collisions),
+			self.responseConflicts.eq(responseConflicts),
+			self.error.eq(frameError),
 
-			address.eq(serial.dataOut[8:16]),
-			commandBits.eq(serial.dataOut[0:8]),
+			address.eq(frame[8:16]),
+			commandBits.eq(frame[0:8]),
 			decoder.commandByte.eq(commandBits),
 
 			serial.dataIn.eq(response),
 
+			fade.gear.eq(gear),
+			fade.target.eq(result),
+			fade.fadeTime.eq(fadeTime[gear]),
+			fade.fadeRate.eq(fadeRate[gear]),
+			Cat(outputCurve.levels).eq(Cat(fade.levels)),
+			Cat(self.outputs).eq(Cat(outputCurve.outputs)),
+
 			# status[2] indicates whether the lamp is lit
 			status[2].eq(actualLevel != 0),
+			# status[4] indicates whether a fade is running
+			status[4].eq(fade.fading.bit_select(gear, 1)),
 			# status[6] indicates if our short address is ok
-			status[6].eq(shortAddress == 255),
+			status[6].eq(missingShortAddress.bit_select(gear, 1)),
 			status[7].eq(powerFailure),
 		]
 
+		# Direct arc power and the level commands skip the microcode, taking the level they ask for and holding it
+		# between the gear's min and max level before handing it to the fade engine. That's the cycle after DISPATCH,
+		# or the one after that to fetch a scene, with the fade engine starting a cycle later. At 1MHz the output
+		# changes 1542 cycles into the stop condition, the receiver waiting 1458 of them to be sure the frame's
+		# over (see the levelControl sim)
+		arcLevel = Signal(8)
+		limitedLevel = Signal(8)
+		sceneAddress = Signal.like(registerRead.addr)
+		m.d.comb += [
+			limitedLevel.eq(Mux(arcLevel < minLevel[gear], minLevel[gear],
+				Mux(arcLevel > maxLevel[gear], maxLevel[gear], arcLevel))),
+			sceneAddress.eq(gearBase + self.mapRegister('scene0') + decoder.data[0:4]),
+		]
+
+		# Each frame is run past every gear in turn, then answered once they all have been
 		with m.FSM(name = 'dali-fsm'):
 			with m.State('STARTUP'):
-				m.d.sync += readAddress.eq(0)
-				m.next = 'BEGIN-READ'
+				m.next = 'IDLE'
 			with m.State('RESET'):
 				m.d.sync += allowMemoryWrite.eq(0)
 				m.next = 'IDLE'
-			# Spin until we get a valid command
+			# Spin until there's a frame waiting for us
 			with m.State('IDLE'):
-				with m.If(serial.dataAvailable):
-					m.next = 'ADDRESS'
-			# Decode the address for what we've just been sent
+				with m.If(rxFrames.valid):
+					m.d.comb += rxFrames.next.eq(1)
+					m.d.sync += frameError.eq(rxFrames.error)
+					# Frames that broke the timing or came out the wrong length are flagged on error and dropped
+					with m.If(~rxFrames.error):
+						m.d.sync += [
+							frame.eq(rxFrames.data),
+							gear.eq(0),
+							gearBase.eq(0),
+							responded.eq(0),
+						]
+						m.next = 'ADDRESS'
+			# Decode the address for what we've just been sent, reading the gear's short address or the byte
+			# holding the group being addressed to match it against
 			with m.State('ADDRESS'):
+				m.d.comb += registerRead.addr.eq(gearBase + self.mapRegister('shortAddress'))
+				# Hold on to the frame until we know our own short address and groups
+				with m.If(~addressingLoaded):
+					m.next = 'ADDRESS'
 				# If it's a normal request
-				with m.If(~address[7]):
-					# And is for our short address
-					with m.If(address[1:7] == shortAddress):
-						m.next = 'DISPATCH'
-					with m.Else():
-						m.next = 'IDLE'
+				with m.Elif(~address[7]):
+					m.next = 'MATCH'
 				# If we're being group addressed
 				with m.Elif(address[5:8] == 0b100):
-					# If it's for a group we're in
-					with m.If(group.bit_select(address[1:5], 1)):
-						m.next = 'DISPATCH'
-					with m.Else():
-						m.next = 'IDLE'
+					m.d.comb += registerRead.addr.eq(gearBase + self.mapRegister('group') + address[4])
+					m.next = 'MATCH'
 				# If it's a broadcast command
 				with m.Elif(address[1:8] == 0b111_1111):
 					m.next = 'DISPATCH'
 				# Else if this is a special command
 				with m.Else():
 					m.next = 'DECODE-SPECIAL'
-			# Determine if the request was a power control request or a command
+			# Check the frame is for the gear's short address or a group it's in
+			with m.State('MATCH'):
+				with m.If(~address[7]):
+					with m.If(address[1:7] == registerRead.data):
+						m.next = 'DISPATCH'
+					with m.Else():
+						m.next = 'NEXT-GEAR'
+				with m.Else():
+					with m.If(registerRead.data.bit_select(address[1:4], 1)):
+						m.next = 'DISPATCH'
+					with m.Else():
+						m.next = 'NEXT-GEAR'
+			# Determine if the request was a power control request or a command, level commands taking the fast path
 			with m.State('DISPATCH'):
-				with m.If(address[0]):
-					m.next = 'DECODE'
+				with m.If(~address[0]):
+					m.next = 'LEVEL'
+				with m.Elif(decoder.command == DALICommand.gotoScene):
+					m.d.comb += registerRead.addr.eq(sceneAddress)
+					m.next = 'SCENE'
+				with m.Elif(decoder.command.matches(DALICommand.gotoMax, DALICommand.gotoMin, DALICommand.stepUp,
+					DALICommand.stepDown, DALICommand.stepDownAndOff, DALICommand.stepUpAndOn)):
+					m.next = 'LEVEL'
 				with m.Else():
-					# Actually needs to be level control logic..
-					m.next = 'IDLE'
-			# Decode the command we've been sent
+					m.next = 'DECODE'
+			# Fetch the level of the scene being recalled, holding on until it and the gear's limits are loaded
+			with m.State('SCENE'):
+				m.d.comb += registerRead.addr.eq(sceneAddress)
+				with m.If(self.byteLoaded(loadedBytes, sceneAddress) & limitsLoaded):
+					m.next = 'LEVEL'
+			# Set the gear's level going toward what the command asks for
+			with m.State('LEVEL'):
+				with m.If(limitsLoaded):
+					m.next = 'NEXT-GEAR'
+					# Direct arc power and scenes fade over the fade time, to off or as far as the limits allow
+					with m.If(~address[0] | (decoder.command == DALICommand.gotoScene)):
+						m.d.comb += arcLevel.eq(Mux(address[0], registerRead.data, commandBits))
+						with m.If(arcLevel == 0):
+							m.d.comb += [
+								fade.target.eq(0),
+								fade.fade.eq(1),
+							]
+						with m.Elif(arcLevel != 255):
+							m.d.comb += [
+								fade.target.eq(limitedLevel),
+								fade.fade.eq(1),
+							]
+						# A mask leaves the level alone, other than direct arc power stopping any fade where it is
+						with m.Elif(~address[0]):
+							m.d.comb += [
+								fade.target.eq(actualLevel),
+								fade.jump.eq(1),
+							]
+					# The rest go straight to their level, stepping only working on a lit lamp
+					with m.Else():
+						with m.Switch(decoder.command):
+							with m.Case(DALICommand.gotoMax):
+								m.d.comb += [
+									fade.target.eq(maxLevel[gear]),
+									fade.jump.eq(1),
+								]
+							with m.Case(DALICommand.gotoMin):
+								m.d.comb += [
+									fade.target.eq(minLevel[gear]),
+									fade.jump.eq(1),
+								]
+							with m.Case(DALICommand.stepUp):
+								m.d.comb += [
+									arcLevel.eq(actualLevel + 1),
+									fade.target.eq(limitedLevel),
+									fade.jump.eq(actualLevel != 0),
+								]
+							with m.Case(DALICommand.stepDown):
+								m.d.comb += [
+									arcLevel.eq(actualLevel - 1),
+									fade.target.eq(limitedLevel),
+									fade.jump.eq(actualLevel != 0),
+								]
+							# Stepping down from min level turns the lamp off
+							with m.Case(DALICommand.stepDownAndOff):
+								m.d.comb += [
+									arcLevel.eq(actualLevel - 1),
+									fade.target.eq(Mux(actualLevel <= minLevel[gear], 0, limitedLevel)),
+									fade.jump.eq(actualLevel != 0),
+								]
+							# Stepping up from off lands on min level
+							with m.Case(DALICommand.stepUpAndOn):
+								m.d.comb += [
+									arcLevel.eq(actualLevel + 1),
+									fade.target.eq(limitedLevel),
+									fade.jump.eq(1),
+								]
+			# Decode the command we've been sent, fetching the first op of its program
 			with m.State('DECODE'):
+				m.d.comb += microcodeRead.addr.eq(entry)
 				m.d.sync += [
-					command.eq(decoder.command),
-					deviceCommand.eq(decoder.deviceCommand),
 					commandData.eq(decoder.data),
+					microPC.eq(entry),
 				]
 				m.next = 'EXECUTE'
-			# Disptch the command
+			# Run the command's program an op a cycle, other than while one's stalled
 			with m.State('EXECUTE'):
-				with m.Switch(command):
-
-					with m.Case(DALICommand.lampOff):
-						m.d.sync += actualLevel.eq(0)
-						m.next = 'IDLE'
-
-					with m.Case(DALICommand.levelToDTR):
-						m.d.sync += dtr.eq(actualLevel)
-						m.next = 'IDLE'
-					with m.Case(DALICommand.dtrToMaxLevel):
-						with m.If(dtr == 0xFF):
-							m.d.sync += maxLevel.eq(254)
-						with m.Elif(dtr > minLevel):
-							m.d.sync += maxLevel.eq(dtr)
-						with m.Else():
-							m.d.sync += maxLevel.eq(minLevel)
-						# TODO: Check and set actualLevel if it's above the new maxLevel
-						m.d.sync += persistMemory.address.eq(self.mapRegister(maxLevel)),
-						m.next = 'WRITEBACK'
-					with m.Case(DALICommand.dtrToMinLevel):
-						with m.If(dtr < self.phyiscalMinLevel):
-							m.d.sync += minLevel.eq(self.phyiscalMinLevel)
-						with m.Elif(dtr > maxLevel):
-							m.d.sync += minLevel.eq(maxLevel)
-						with m.Else():
-							m.d.sync += minLevel.eq(dtr)
-						# TODO: Check and set actualLevel if it's below the new levelLevel (unless 0)
-						m.d.sync += persistMemory.address.eq(self.mapRegister(minLevel)),
-						m.next = 'WRITEBACK'
-					with m.Case(DALICommand.dtrToFailureLevel):
-						m.d.sync += failureLevel.eq(dtr)
-						m.d.sync += persistMemory.address.eq(self.mapRegister(failureLevel)),
-						m.next = 'WRITEBACK'
-					with m.Case(DALICommand.dtrToOnLevel):
-						m.d.sync += onLevel.eq(dtr)
-						m.d.sync += persistMemory.address.eq(self.mapRegister(onLevel)),
-						m.next = 'WRITEBACK'
-					with m.Case(DALICommand.dtrToFadeTime):
-						with m.If(dtr > 15):
-							m.d.sync += fadeTime.eq(15)
-						with m.Else():
-							m.d.sync += fadeTime.eq(dtr)
-						m.d.sync += persistMemory.address.eq(self.mapRegister(fadeTime)),
-						m.next = 'WRITEBACK'
-					with m.Case(DALICommand.dtrToFadeRate):
-						with m.If(dtr > 15):
-							m.d.sync += fadeRate.eq(15)
-						with m.Else():
-							m.d.sync += fadeRate.eq(dtr)
-						m.d.sync += persistMemory.address.eq(self.mapRegister(fadeRate)),
-						m.next = 'WRITEBACK'
-					with m.Case(DALICommand.dtrToScene):
-						m.d.sync += scene[commandData].eq(dtr)
-						m.d.sync += persistMemory.address.eq(self.mapRegister(scene) + commandData),
-						m.next = 'WRITEBACK'
-					with m.Case(DALICommand.removeFromScene):
-						m.d.sync += scene[commandData].eq(0xFF)
-						m.d.sync += persistMemory.address.eq(self.mapRegister(scene) + commandData),
-						m.next = 'WRITEBACK'
-					with m.Case(DALICommand.addToGroup):
-						m.d.sync += group.bit_select(commandData, 1).eq(1)
-						m.d.sync += persistMemory.address.eq(self.mapRegister(group) + commandData[3]),
-						m.next = 'WRITEBACK'
-					with m.Case(DALICommand.removeFromGroup):
-						m.d.sync += group.bit_select(commandData, 1).eq(0)
-						m.d.sync += persistMemory.address.eq(self.mapRegister(group) + commandData[3]),
-						m.next = 'WRITEBACK'
-					with m.Case(DALICommand.dtrToShortAddress):
-						# TOD: Validate dtr.
-						m.d.sync += shortAddress.eq(dtr)
-						m.d.sync += persistMemory.address.eq(self.mapRegister(shortAddress)),
-						m.next = 'WRITEBACK'
-					with m.Case(DALICommand.enableMemoryWrite):
-						m.d.sync += allowMemoryWrite.eq(1)
-						m.next = 'IDLE'
-					with m.Case(DALICommand.queryStatus):
-						self.sendRegister(m, response, serial, status)
-
-					with m.Case(DALICommand.queryPowerOn):
-						self.sendRegister(m, response, serial, Cat(status[2], Const(0, 7)))
-
-					with m.Case(DALICommand.queryMissingShortAddr):
-						self.sendRegister(m, response, serial, Cat(status[6], Const(0, 7)))
-					with m.Case(DALICommand.queryVersionNumber):
-						# Standard says we answer '1'..
-						self.sendRegister(m, response, serial, Const(1, 8))
-					with m.Case(DALICommand.queryDTR):
-						self.sendRegister(m, response, serial, dtr)
-					with m.Case(DALICommand.queryDeviceType):
-						self.sendRegister(m, response, serial, self._deviceType)
-					with m.Case(DALICommand.queryPhyMinLevel):
-						assert self.phyiscalMinLevel.value > 0 and self.phyiscalMinLevel.value < 255
-						self.sendRegister(m, response, serial, self.phyiscalMinLevel)
-					with m.Case(DALICommand.queryPowerFailure):
-						self.sendRegister(m, response, serial, Cat(powerFailure, Const(0, 7)))
-					with m.Case(DALICommand.queryDTR1):
-						self.sendRegister(m, response, serial, dtr1)
-					with m.Case(DALICommand.queryDTR2):
-						self.sendRegister(m, response, serial, dtr2)
-					with m.Case(DALICommand.queryLevel):
-						self.sendRegister(m, response, serial, actualLevel)
-					with m.Case(DALICommand.queryMaxLevel):
-						self.sendRegister(m, response, serial, maxLevel)
-					with m.Case(DALICommand.queryMinLevel):
-						self.sendRegister(m, response, serial, minLevel)
-					with m.Case(DALICommand.queryOnLevel):
-						self.sendRegister(m, response, serial, onLevel)
-					with m.Case(DALICommand.queryFailureLevel):
-						self.sendRegister(m, response, serial, failureLevel)
-					with m.Case(DALICommand.queryFadeTimeRate):
+				with m.If(~stall):
+					with m.If(microOp.guard == Guard.none):
+						m.d.sync += acc.eq(result)
+					with m.If(microOp.read):
+						m.d.comb += registerRead.addr.eq(registerAddress)
+						m.d.sync += readAddress.eq(registerAddress)
+					with m.If(microOp.store):
+						m.d.comb += [
+							registerWrite.addr.eq(registerAddress),
+							registerWrite.data.eq(result),
+							registerWrite.en.eq(1),
+						]
+						m.d.sync += allowMemoryWrite.bit_select(gear, 1).eq(0)
+					with m.If(microOp.persist):
 						m.d.sync += [
-							response[0:4].eq(fadeRate),
-							response[4:8].eq(fadeTime),
+							writebackAddress.eq(registerAddress),
+							writebackData.eq(result),
+							writebackPending.eq(1),
 						]
-						m.d.comb += serial.dataSend.eq(1)
-						m.next = 'WAIT'
-					with m.Case(DALICommand.querySceneLevel):
-						self.sendRegister(m, response, serial, scene[commandData])
-					with m.Case(DALICommand.queryGroups0_7):
-						self.sendRegister(m, response, serial, group[0:8])
-					with m.Case(DALICommand.queryGroups8_15):
-						self.sendRegister(m, response, serial, group[8:16])
-					with m.Case(DALICommand.queryRandomAddrL):
-						self.sendRegister(m, response, serial, randomAddress[0:8])
-						m.d.sync += response.eq(randomAddress[0:8])
-						m.d.comb += serial.dataSend.eq(1)
-						m.next = 'WAIT'
-					with m.Case(DALICommand.queryRandomAddrM):
-						self.sendRegister(m, response, serial, randomAddress[8:16])
-					with m.Case(DALICommand.queryRandomAddrH):
-						self.sendRegister(m, response, serial, randomAddress[16:24])
-					# If we got a device-type-specific command
-					with m.Case(DALICommand.deviceSpecific):
-						self._handleDeviceSpecific(m, serial, deviceCommand, response)
-					with m.Case(DALICommand.nop):
-						m.next = 'IDLE'
-					with m.Default():
-						m.next = 'IDLE'
+					with m.If(microOp.dtr):
+						m.d.sync += dtr.eq(result)
+					m.d.comb += [
+						fade.jump.eq(microOp.level),
+						fade.fadeAtRate.eq(microOp.fade),
+						fade.fadeUp.eq(microOp.fadeUp),
+					]
+					with m.If(microOp.allowWrite):
+						m.d.sync += allowMemoryWrite.bit_select(gear, 1).eq(1)
+
+					with m.If(microOp.respond):
+						self.gearResponse(m, response, responded, responseConflicts, result)
+					# The program ends at its last op, or early at a guard whose check its source fails
+					with m.Elif((microOp.next == 0) | guardFailed):
+						m.next = 'NEXT-GEAR'
+					with m.Else():
+						m.d.comb += microcodeRead.addr.eq(microOp.next)
+						m.d.sync += microPC.eq(microOp.next)
 			# Handle special commands
 			with m.State('DECODE-SPECIAL'):
 				with m.If(address == 0b1010_0011):
 					m.d.sync += dtr.eq(commandBits)
-					m.next = 'IDLE'
+					m.next = 'NEXT-GEAR'
+				# The gear's short address was read while matching the address
 				with m.Elif((address == 0b1011_1011) & (commandBits == 0)):
-					self.sendRegister(m, response, serial, shortAddress)
-					m.next = 'WAIT'
+					self.gearResponse(m, response, responded, responseConflicts, registerRead.data)
 				with m.Else():
-					m.next = 'IDLE'
+					m.next = 'NEXT-GEAR'
+			# Move on to the next gear, or answer the frame if that was the last
+			with m.State('NEXT-GEAR'):
+				with m.If(gear == gearCount - 1):
+					with m.If(responded):
+						m.d.comb += serial.dataSend.eq(1)
+						m.next = 'WAIT'
+					with m.Else():
+						m.next = 'IDLE'
+				with m.Else():
+					m.d.sync += [
+						gear.eq(gear + 1),
+						gearBase.eq(gearBase + gearLength),
+					]
+					m.next = 'ADDRESS'
 			# Resync with the TX completing
 			with m.State('WAIT'):
 				with m.If(serial.sendComplete):
 					m.next = 'IDLE'
-			# Data writeback state
-			with m.State('WRITEBACK'):
-				m.d.sync += allowMemoryWrite.eq(0)
-				with m.Switch(command):
-					with m.Case(DALICommand.dtrToMaxLevel):
-						m.d.sync += persistMemory.dataOut.eq(maxLevel)
-					with m.Case(DALICommand.dtrToMinLevel):
-						m.d.sync += persistMemory.dataOut.eq(minLevel)
-					with m.Case(DALICommand.dtrToFailureLevel):
-						m.d.sync += persistMemory.dataOut.eq(failureLevel)
-					with m.Case(DALICommand.dtrToOnLevel):
-						m.d.sync += persistMemory.dataOut.eq(onLevel)
-					with m.Case(DALICommand.dtrToFadeTime):
-						m.d.sync += persistMemory.dataOut.eq(fadeTime)
-					with m.Case(DALICommand.dtrToFadeRate):
-						m.d.sync += persistMemory.dataOut.eq(fadeRate)
-					with m.Case(DALICommand.dtrToScene, DALICommand.removeFromScene):
-						m.d.sync += persistMemory.dataOut.eq(scene[commandData])
-					with m.Case(DALICommand.addToGroup, DALICommand.removeFromGroup):
-						m.d.sync += persistMemory.dataOut.eq(group.bit_select(commandData[3:], 8))
-					with m.Case(DALICommand.dtrToShortAddress):
-						m.d.sync += persistMemory.dataOut.eq(shortAddress)
-					with m.Default():
-						# ERROR..
-						m.next = 'IDLE'
-				m.d.comb += persistMemory.write.eq(1)
-				m.next = 'WRITEBACK-WAIT'
-			with m.State('WRITEBACK-WAIT'):
-				with m.If(persistMemory.complete):
-					m.next = 'IDLE'
-			# These two states are at the bottom as they make use of the writeback information created above
-			with m.State('BEGIN-READ'):
-				with m.If(readAddress == self._framNextAddr):
-					m.next = 'IDLE'
-				with m.Else():
-					m.d.sync += persistMemory.address.eq(readAddress)
-					m.d.comb += persistMemory.read.eq(1)
-					sceneAddress = self.mapRegister(scene)
-					groupAddress = self.mapRegister(group)
-					with m.If((readAddress >= sceneAddress) & (readAddress < sceneAddress + len(scene))):
-						m.d.sync += commandData.eq(readAddress - sceneAddress)
-					with m.Elif((readAddress >= groupAddress) & (readAddress < groupAddress + (len(group) // 8))):
-						m.d.sync += commandData.eq(readAddress - groupAddress)
-					m.next = 'WAIT-READ'
-			with m.State('WAIT-READ'):
-				with m.If(persistMemory.complete):
-					m.next = 'STORE-READ'
-			with m.State('STORE-READ'):
-					for regName, addr in self._framMap.items():
-						if regName == maxLevel.name:
-							with m.If(readAddress == addr):
-								m.d.sync += maxLevel.eq(persistMemory.dataIn)
-						elif regName == minLevel.name:
-							with m.Elif(readAddress == addr):
-								m.d.sync += minLevel.eq(persistMemory.dataIn)
-						elif regName == failureLevel.name:
-							with m.Elif(readAddress == addr):
-								m.d.sync += failureLevel.eq(persistMemory.dataIn)
-						elif regName == onLevel.name:
-							with m.Elif(readAddress == addr):
-								m.d.sync += onLevel.eq(persistMemory.dataIn)
-						elif regName == fadeTime.name:
-							with m.Elif(readAddress == addr):
-								m.d.sync += fadeTime.eq(persistMemory.dataIn)
-						elif regName == fadeRate.name:
-							with m.Elif(readAddress == addr):
-								m.d.sync += fadeRate.eq(persistMemory.dataIn)
-						elif regName == scene._inner[0].name:
-							with m.Elif((readAddress >= addr) & (readAddress < addr + len(scene))):
-								m.d.sync += scene[commandData].eq(persistMemory.dataIn)
-						elif regName == group.name:
-							with m.Elif((readAddress >= addr) & (readAddress < addr + (len(group) // 8))):
-								m.d.sync += group.bit_select(commandData * 8, 8).eq(persistMemory.dataIn)
-						elif regName == shortAddress.name:
-							with m.Elif(readAddress == addr):
-								m.d.sync += shortAddress.eq(persistMemory.dataIn)
-					m.d.sync += readAddress.eq(readAddress + 1)
-					m.next = 'BEGIN-READ'
 
 		return m
 
-	def mapRegister(self, register : Union[Signal, Array]):
-		if isinstance(register, Signal):
-			addr = self._framMap.setdefault(register.name, self._framNextAddr)
-			if addr == self._framNextAddr:
-				self._framNextAddr += ceil(len(register) / 8)
-		else:
-			addr = self._framMap.setdefault(register._inner[0].name, self._framNextAddr)
-			if addr == self._framNextAddr:
-				self._framNextAddr += len(register)
-		return addr
-
-	def sendRegister(self, m, response : Signal, serial : Serial, register : Value):
-		m.d.sync += [
-			response.eq(register),
-			#allowMemoryWrite.eq(0),
-		]
-		m.d.comb += serial.dataSend.eq(1)
-		m.next = 'WAIT'
-
-	def _handleDeviceSpecific(self, m, serial, command, response):
-		if self._deviceType == DeviceType.led:
-			return self._handleLEDCommands(m, serial, command, response)
-		raise ValueError(f'DeviceType {self._deviceType} is not supported')
-
-	def _handleLEDCommands(self, m, serial, command, response):
-		with m.Switch(command):
-			with m.Case(DALILEDCommand.queryExtVersionNumber):
-				m.d.sync += response.eq(1)
-				m.d.comb += serial.dataSend.eq(1)
-				m.next = 'WAIT'
-			with m.Case(DALILEDCommand.nop):
-				m.next = 'IDLE'
-			with m.Default():
-				m.next = 'IDLE'
+	def gearRegister(self, gear : int, name : str) -> str:
+		# Gear 0 keeps the plain register names
+		if gear == 0:
+			return name
+		return f'gear{gear}.{name}'
+
+	def mapRegister(self, name : str, length : int = None, default : bytes = None) -> int:
+		# New registers get the next length bytes, defaulting to all 0 if not given
+		if name not in self._framMap:
+			assert length is not None, f'Register {name} has not been mapped'
+			assert default is None or len(default) == length, f'Register {name} has a default of the wrong size'
+			self._framMap[name] = self._framNextAddr
+			self._framSizes[name] = length
+			self._framDefaults[name] = bytes(length) if default is None else default
+			self._framNextAddr += length
+		return self._framMap[name]
+
+	def registerDefaults(self) -> dict:
+		# The DALI reset values, which the registers take on without a good image
+		return {
+			'group': bytes(2),
+			'shortAddress': bytes((255,)),
+			'maxLevel': bytes((254,)),
+			'minLevel': bytes((self.phyiscalMinLevel.value,)),
+			'failureLevel': bytes((254,)),
+			'onLevel': bytes((254,)),
+			'fadeTime': bytes((0,)),
+			'fadeRate': bytes((7,)),
+			'scene0': bytes((255,)) * 16,
+			'dimmingCurve': bytes((DimmingCurve.logarithmic,)),
+		}
+
+	def persistedLayout(self) -> PersistLayout:
+		return PersistLayout((name, addr, self._framDefaults[name]) for name, addr in self._framMap.items())
+
+	def registerLoaded(self, loadedBytes : Signal, name : str):
+		# Whether the whole register has been loaded
+		addr = self.mapRegister(name)
+		return loadedBytes[addr:addr + self._framSizes[name]].all()
+
+	def byteLoaded(self, loadedBytes : Signal, addr : Value):
+		# Whether the byte at addr has been loaded, which any address off the end of the map never is
+		return Cat(loadedBytes, Const(0, 1)).bit_select(addr, 1)
+
+	def gearResponse(self, m, response : Signal, responded : Signal, conflicts : Signal, register : Value):
+		# The bus only gets one answer per frame, so the first gear to answer is the one heard
+		with m.If(~responded):
+			m.d.sync += [
+				response.eq(register),
+				responded.eq(1),
+			]
+		with m.Elif((register != response) & (conflicts != 2 ** len(conflicts) - 1)):
+			m.d.sync += conflicts.eq(conflicts + 1)
+		m.next = 'NEXT-GEAR'
@@ -0,0 +1,145 @@
+from enum import IntEnum, unique
+from math import sqrt
+from nmigen import *
+from .bitclock import BitClock
+
+__all__ = (
+	'FadeEngine',
+	'fadeTimings',
+)
+
+@unique
+class FadeMode(IntEnum):
+	idle = 0
+	time = 1
+	rate = 2
+
+def fadeTimings(tickRate : float, accumulatorBits : int = 16) -> list:
+	# How many ticks each fade time lasts, then how much of a step (out of 2 ** accumulatorBits) a tick is
+	# worth at each fade rate
+	times = [0] + [round(0.5 * sqrt(2 ** time) * tickRate) for time in range(1, 16)]
+	rates = [round(506 / sqrt(2 ** max(rate, 1)) / tickRate * (2 ** accumulatorBits)) for rate in range(16)]
+	return times + rates
+
+class FadeEngine(Elaboratable):
+	# Steps each gear's level toward its target off a shared tick, over the fade time or at the fade rate for
+	# 200ms. A new command for a gear starts over from wherever its level got to
+	def __init__(self, *, gearCount : int = 1, tickRate : float = 1e3):
+		# The command - gear's fade time and rate are given alongside, and it starts the cycle after it's strobed
+		self.gear = Signal(range(gearCount))
+		self.target = Signal(8)
+		self.fadeTime = Signal(4)
+		self.fadeRate = Signal(4)
+		# Go straight to target, fade to it over the fade time or toward it at the fade rate. Fades at the fade
+		# rate go up if fadeUp is set and down if not, and don't start if the level is already past target that way
+		self.jump = Signal()
+		self.fade = Signal()
+		self.fadeAtRate = Signal()
+		self.fadeUp = Signal()
+		# Each gear's actual level, and whether it's fading
+		self.levels = tuple(Signal(8, name = f'level{index}') for index in range(gearCount))
+		self.fading = Signal(gearCount)
+
+		self._tickRate = tickRate
+
+	def elaborate(self, platform) -> Module:
+		m = Module()
+		m.submodules.tick = tick = BitClock(frequency = self._tickRate)
+		timings = fadeTimings(self._tickRate)
+		# The shortest fade time has to have at least as many ticks as there are levels to step through
+		assert timings[1] >= 255, f'A {self._tickRate}Hz tick is too slow to fade over the shortest fade time'
+		rateTicks = round(200e-3 * self._tickRate)
+		stepWidth = max(timing.bit_length() for timing in timings + [2 ** 16])
+		steps = Memory(width = stepWidth, depth = len(timings), init = timings)
+		m.submodules.stepsRead = stepsRead = steps.read_port(transparent = False)
+
+		# The command being started, held for the cycle the ROM takes to answer
+		startGear = Signal.like(self.gear)
+		startTarget = Signal.like(self.target)
+		startMode = Signal(FadeMode)
+		startUp = Signal()
+		startPending = Signal()
+
+		m.d.comb += stepsRead.addr.eq(Mux(self.fadeAtRate, 16 + self.fadeRate, self.fadeTime))
+		m.d.sync += [
+			startGear.eq(self.gear),
+			startTarget.eq(self.target),
+			startMode.eq(Mux(self.fade, FadeMode.time, Mux(self.fadeAtRate, FadeMode.rate, FadeMode.idle))),
+			startUp.eq(self.fadeUp),
+			startPending.eq(self.jump | self.fade | self.fadeAtRate),
+		]
+
+		for index, level in enumerate(self.levels):
+			target = Signal(8, name = f'target{index}')
+			mode = Signal(FadeMode, name = f'mode{index}')
+			# Which way the level is being stepped
+			up = Signal(name = f'up{index}')
+			# Each tick adds increment to the accumulator, and a step is taken every time it makes it to limit
+			accumulator = Signal(stepWidth, name = f'accumulator{index}')
+			increment = Signal(stepWidth, name = f'increment{index}')
+			limit = Signal(stepWidth, name = f'limit{index}')
+			gained = Signal(stepWidth + 1, name = f'gained{index}')
+			nextLevel = Signal(8, name = f'nextLevel{index}')
+			remaining = Signal(range(rateTicks + 1), name = f'remaining{index}')
+			distance = Signal(8, name = f'distance{index}')
+
+			m.d.comb += [
+				gained.eq(accumulator + increment),
+				nextLevel.eq(Mux(up, level + 1, level - 1)),
+				distance.eq(Mux(startTarget > level, startTarget - level, level - startTarget)),
+				self.fading[index].eq(mode != FadeMode.idle),
+			]
+
+			with m.If(tick.tick & (mode != FadeMode.idle)):
+				with m.If(gained >= limit):
+					m.d.sync += [
+						accumulator.eq(gained - limit),
+						level.eq(nextLevel),
+					]
+					with m.If(nextLevel == target):
+						m.d.sync += mode.eq(FadeMode.idle)
+				with m.Else():
+					m.d.sync += accumulator.eq(gained)
+				# Fades at the fade rate only last so long
+				with m.If(mode == FadeMode.rate):
+					m.d.sync += remaining.eq(remaining - 1)
+					with m.If(remaining == 1):
+						m.d.sync += mode.eq(FadeMode.idle)
+
+			# A new command takes over from whatever the gear was doing, other than fading at the fade rate which
+			# never lights a lamp that's off
+			with m.If(startPending & (startGear == index) & ~((startMode == FadeMode.rate) & (level == 0))):
+				m.d.sync += [
+					target.eq(startTarget),
+					accumulator.eq(0),
+				]
+				with m.Switch(startMode):
+					# Jumps, and fades with no fade time, go straight to the target
+					with m.Case(FadeMode.idle):
+						m.d.sync += [
+							level.eq(startTarget),
+							mode.eq(FadeMode.idle),
+						]
+					with m.Case(FadeMode.time):
+						with m.If(stepsRead.data == 0):
+							m.d.sync += [
+								level.eq(startTarget),
+								mode.eq(FadeMode.idle),
+							]
+						with m.Else():
+							m.d.sync += [
+								increment.eq(distance),
+								limit.eq(stepsRead.data),
+								up.eq(startTarget > level),
+								mode.eq(Mux(distance == 0, FadeMode.idle, FadeMode.time)),
+							]
+					with m.Case(FadeMode.rate):
+						m.d.sync += [
+							increment.eq(stepsRead.data),
+							limit.eq(2 ** 16),
+							remaining.eq(rateTicks),
+							up.eq(startUp),
+							mode.eq(Mux(Mux(startUp, level >= startTarget, level <= startTarget),
+								FadeMode.idle, FadeMode.rate)),
+						]
+		return m
@@ -0,0 +1,55 @@
+from nmigen import *
+from nmigen.lib.fifo import SyncFIFOBuffered
+
+__all__ = (
+	'FrameFIFO',
+)
+
+class FrameFIFO(Elaboratable):
+	# Holds received frames while the controller's busy, each stamped with the time it arrived
+	def __init__(self, *, depth : int = 4, timestampPeriod : float = 100e-6):
+		# Frame in - dataIn and errorIn are queued on the cycle write is strobed
+		self.dataIn = Signal(16)
+		self.errorIn = Signal()
+		self.write = Signal()
+		# Frame out - the oldest frame is held on data, error and timestamp while valid is high,
+		# strobing next drops it and moves on to the one after
+		self.data = Signal.like(self.dataIn)
+		self.error = Signal()
+		self.timestamp = Signal(16)
+		self.valid = Signal()
+		self.next = Signal()
+		# Free running arrival time counter
+		self.time = Signal.like(self.timestamp)
+		# Count of frames dropped because the queue was full when they arrived
+		self.overflows = Signal(16)
+
+		self._depth = depth
+		self._timestampPeriod = timestampPeriod
+
+	def elaborate(self, platform) -> Module:
+		m = Module()
+		m.submodules.fifo = fifo = SyncFIFOBuffered(
+			width = len(self.dataIn) + 1 + len(self.timestamp), depth = self._depth)
+
+		timerCount = max(int(platform.default_clk_frequency * self._timestampPeriod), 1)
+		timer = Signal(range(timerCount))
+		with m.If(timer == timerCount - 1):
+			m.d.sync += [
+				timer.eq(0),
+				self.time.eq(self.time + 1),
+			]
+		with m.Else():
+			m.d.sync += timer.eq(timer + 1)
+
+		m.d.comb += [
+			fifo.w_data.eq(Cat(self.dataIn, self.errorIn, self.time)),
+			fifo.w_en.eq(self.write),
+			Cat(self.data, self.error, self.timestamp).eq(fifo.r_data),
+			self.valid.eq(fifo.r_rdy),
+			fifo.r_en.eq(self.next),
+		]
+
+		with m.If(self.write & ~fifo.w_rdy & (self.overflows != 2 ** len(self.overflows) - 1)):
+			m.d.sync += self.overflows.eq(self.overflows + 1)
+		return m
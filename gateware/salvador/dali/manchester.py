@@ -1,6 +1,8 @@
+from math import ceil, floor
 from nmigen import *
+from nmigen.lib.cdc import FFSynchronizer
 
-__all__ = ('ManchesterEncoder', 'ManchesterDecoder')
+__all__ = ('ManchesterEncoder', 'ManchesterReceiver')
 
 class ManchesterEncoder(Elaboratable):
 	def __init__(self):
@@ -35,37 +37,182 @@ class ManchesterEncoder(Elaboratable):
 
 		return m
 
-class ManchesterDecoder(Elaboratable):
-	def __init__(self):
-		self.dataIn = Signal()
-		self.step = Signal()
-		self.dataOut = Signal()
-		self.valid = Signal()
-		self.bypass = Signal()
+class ManchesterReceiver(Elaboratable):
+	# Majority filters the line and times each bit off the transitions either side of it, tracking the half-bit
+	# period from the start bit. Frames come out on dataOut, length and error once the stop condition is most of
+	# the way through, error flagging bad timing or a length not in frameLengths
+	def __init__(self, *, oversampling = 16, tolerance = 0.2, frameLengths = (8, 16, 24, 25)):
+		self.rx = Signal(reset = 1)
+		self.sample = Signal()
+		self.dataOut = Signal(max(frameLengths))
+		self.length = Signal(range(max(frameLengths) + 2))
+		self.dataAvailable = Signal()
+		self.error = Signal()
+		self.sinceEnd = Signal(range(ceil(oversampling * (1 + tolerance)) * 8))
+		# The filtered line level, for anything wanting to watch the bus
+		self.level = Signal(reset = 1)
+		self._oversampling = oversampling
+		self._tolerance = tolerance
+		self._frameLengths = frameLengths
 
 	def elaborate(self, platform):
 		m = Module()
+		halfBit = self._oversampling
+		minHalfBit = max(floor(halfBit * (1 - self._tolerance)), 2)
+		maxHalfBit = ceil(halfBit * (1 + self._tolerance))
+		idleTime = ceil(halfBit * 4)
 
-		data = Signal()
-		cycle = Signal()
+		# Filter the line down to the majority of the last five samples, idling high
+		rx = Signal(reset = 1)
+		samples = Signal(5, reset = 0b11111)
+		filtered = Signal()
+		line = Signal(reset = 1)
+		edge = Signal()
+		m.submodules += FFSynchronizer(self.rx, rx, reset = 1)
+		with m.If(self.sample):
+			m.d.sync += [
+				samples.eq(Cat(rx, samples[:-1])),
+				line.eq(filtered),
+			]
+		m.d.comb += [
+			filtered.eq(sum(samples) >= 3),
+			edge.eq(self.sample & (filtered != line)),
+			self.level.eq(line),
+		]
 
-		with m.If(self.step):
-			with m.If(~cycle):
-				m.d.sync += [
-					data.eq(self.dataIn),
-					cycle.eq(1),
-				]
-			with m.Elif(~self.bypass):
-				m.d.sync += [
-					self.dataOut.eq(data),
-					self.valid.eq(data == ~self.dataIn),
-					cycle.eq(0),
-				]
-			with m.Else():
-				m.d.sync += [
-					self.dataOut.eq(data),
-					self.valid.eq(data == self.dataIn),
-					cycle.eq(0),
-				]
+		# Samples since the last transition, and that in the same fixed point as the half-bit period
+		interval = Signal(range(maxHalfBit * 8))
+		elapsed = Signal(len(interval) + 4)
+		halfBitTime = Signal(range((maxHalfBit + 1) << 4))
+		tooShort = Signal()
+		short = Signal()
+		long = Signal()
+		stopTime = Signal.like(elapsed)
+		stopFromMidBit = Signal()
+		with m.If(edge):
+			m.d.sync += interval.eq(1)
+		with m.Elif(self.sample & (interval != maxHalfBit * 8 - 1)):
+			m.d.sync += interval.eq(interval + 1)
+		m.d.comb += [
+			elapsed.eq(Cat(Const(0, 4), interval)),
+			# Transitions are half a bit apart (short) or a whole bit apart (long), give or take half of one
+			tooShort.eq(elapsed < halfBitTime[1:]),
+			short.eq(elapsed < halfBitTime + halfBitTime[1:]),
+			long.eq(elapsed < (halfBitTime << 1) + halfBitTime[1:]),
+		]
+
+		def trackHalfBit(period):
+			# Move the half-bit period an eighth of the way toward the one just measured
+			estimate = halfBitTime - halfBitTime[3:] + period
+			m.d.sync += halfBitTime.eq(Mux(estimate < (minHalfBit << 4), minHalfBit << 4,
+				Mux(estimate > (maxHalfBit << 4), maxHalfBit << 4, estimate)))
+
+		dataRX = Signal.like(self.dataOut)
+		dataRXCount = Signal.like(self.length)
+		dataRXError = Signal()
+		lengthValid = Signal()
+		m.d.comb += lengthValid.eq(Cat(dataRXCount == length for length in self._frameLengths).any())
+
+		def shiftBit():
+			# The bit is whatever the line held before the transition in the middle of it
+			m.d.sync += dataRX.eq(Cat(line, dataRX[:-1]))
+			with m.If(dataRXCount <= len(self.dataOut)):
+				m.d.sync += dataRXCount.eq(dataRXCount + 1)
+
+		def frameError():
+			m.d.sync += dataRXError.eq(1)
+			m.next = 'SETTLE'
+
+		m.d.sync += self.dataAvailable.eq(0)
+
+		with m.FSM(name = 'rx-fsm'):
+			# Wait for the line to fall at the start of a frame, ignoring it coming back up after a glitch or short
+			with m.State('IDLE'):
+				with m.If(edge & ~filtered):
+					m.d.sync += [
+						dataRX.eq(0),
+						dataRXCount.eq(0),
+						dataRXError.eq(0),
+					]
+					m.next = 'START'
+			# Time the first half of the start bit, quietly dropping anything too short or long to be one
+			with m.State('START'):
+				with m.If(edge):
+					with m.If(interval < minHalfBit):
+						m.next = 'IDLE'
+					with m.Else():
+						m.d.sync += halfBitTime.eq(elapsed)
+						m.next = 'MID-BIT'
+				with m.Elif(interval > maxHalfBit):
+					m.next = 'SETTLE'
+			# From the middle of a bit, the next transition is either at the end of it if the following
+			# bit has the same value, or half a bit later in the middle of the following bit if not
+			with m.State('MID-BIT'):
+				with m.If(edge):
+					with m.If(tooShort):
+						frameError()
+					with m.Elif(short):
+						trackHalfBit(Cat(Const(0, 1), interval))
+						m.next = 'BOUNDARY'
+					with m.Elif(long):
+						trackHalfBit(interval)
+						shiftBit()
+					with m.Else():
+						frameError()
+				# With the line high and no transition, the last bit ended half a bit after this one's middle
+				with m.Elif(~long):
+					with m.If(line):
+						m.d.sync += [
+							stopTime.eq((halfBitTime << 2) + halfBitTime[1:]),
+							stopFromMidBit.eq(1),
+						]
+						m.next = 'STOP'
+					with m.Else():
+						frameError()
+			# At the boundary between two bits of the same value, the middle of the next is half a bit on
+			with m.State('BOUNDARY'):
+				with m.If(edge):
+					with m.If(~tooShort & short):
+						trackHalfBit(Cat(Const(0, 1), interval))
+						shiftBit()
+						m.next = 'MID-BIT'
+					with m.Else():
+						frameError()
+				# With the line high and no transition, the last bit ended here
+				with m.Elif(~short):
+					with m.If(line):
+						m.d.sync += [
+							stopTime.eq((halfBitTime << 1) + halfBitTime + halfBitTime[1:]),
+							stopFromMidBit.eq(0),
+						]
+						m.next = 'STOP'
+					with m.Else():
+						frameError()
+			# Wait out most of the stop condition, leaving room for the next frame starting right after it
+			with m.State('STOP'):
+				with m.If(edge):
+					frameError()
+				with m.Elif(elapsed >= stopTime):
+					m.d.sync += [
+						self.dataOut.eq(dataRX),
+						self.length.eq(dataRXCount),
+						self.error.eq(~lengthValid),
+						self.dataAvailable.eq(1),
+						# Coming from the middle of the last bit, it ended half a bit later
+						self.sinceEnd.eq(interval - Mux(stopFromMidBit, halfBitTime[4:], 0)),
+					]
+					m.next = 'IDLE'
+			# Wait for the line to go idle, reporting the frame if it got far enough to be a bad one
+			with m.State('SETTLE'):
+				with m.If(line & (interval >= idleTime)):
+					with m.If(dataRXError):
+						m.d.sync += [
+							self.dataOut.eq(dataRX),
+							self.length.eq(dataRXCount),
+							self.error.eq(1),
+							self.dataAvailable.eq(1),
+							self.sinceEnd.eq(interval),
+						]
+					m.next = 'IDLE'
 
 		return m
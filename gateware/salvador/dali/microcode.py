@@ -0,0 +1,247 @@
+from enum import IntEnum, unique
+from nmigen.hdl.ast import Shape
+from .types import DALICommand, DeviceType, DALILEDCommand, DimmingCurve
+
+__all__ = (
+	'Source',
+	'Operation',
+	'Index',
+	'Guard',
+	'MicroOp',
+	'microOpLayout',
+	'commandPrograms',
+	'deviceCommandPrograms',
+	'assemble',
+)
+
+@unique
+class Source(IntEnum):
+	acc = 0
+	operand = 1
+	immediate = 2
+	dtr = 3
+	dtr1 = 4
+	dtr2 = 5
+	level = 6
+	status = 7
+	randomAddrL = 8
+	randomAddrM = 9
+	randomAddrH = 10
+
+@unique
+class Operation(IntEnum):
+	# result = source
+	load = 0
+	# result = the smaller or larger of the accumulator and source
+	min = 1
+	max = 2
+	# result = source with the bit the command's data picks out of a group byte set or cleared
+	setBit = 3
+	clearBit = 4
+	# result = the bit of source at arg
+	bit = 5
+	# result = the accumulator's low nibble in the top half and source's in the bottom
+	nibbles = 6
+
+@unique
+class Index(IntEnum):
+	none = 0
+	# Indexed by the command's data, as for the scenes
+	data = 1
+	# The group byte the command's data falls in
+	group = 2
+
+@unique
+class Guard(IntEnum):
+	none = 0
+	# End the program if source is above arg
+	above = 1
+	# End the program if source is no more than arg, so with arg 0 if it's 0
+	notAbove = 2
+	# End the program if source is no more or no less than the accumulator
+	notAboveAcc = 3
+	notBelowAcc = 4
+
+# Fields of a microcode word, low bits first. arg is a register (by address) or an immediate, and next is where
+# to go after this op with 0 ending the program - that's lampOff's entry and nothing ever jumps back to an entry
+microOpLayout = (
+	('arg', 8),
+	('index', Shape.cast(Index).width),
+	('src', Shape.cast(Source).width),
+	('op', Shape.cast(Operation).width),
+	# Read the register at arg, its value turning up as the operand source from the next op on
+	('read', 1),
+	# Write the result to the register at arg, and queue that for writing back to FRAM
+	('store', 1),
+	('persist', 1),
+	# Write the result to DTR or the actual level, or fade the actual level toward it at the fade rate -
+	# up if fadeUp is set and down if not, going nowhere if the level is already past the result that way
+	('dtr', 1),
+	('level', 1),
+	('fade', 1),
+	('fadeUp', 1),
+	# Send the result as the response, which ends the program
+	('respond', 1),
+	('allowWrite', 1),
+	# End the program here if source fails the guard's check, going on to the next op otherwise. Guards
+	# leave the accumulator alone
+	('guard', Shape.cast(Guard).width),
+	('next', 8),
+)
+
+class MicroOp:
+	# arg is a register by name or (name, byte offset) when reading or storing, and a guard's limit
+	def __init__(self, *, src : Source = Source.acc, op : Operation = Operation.load, arg = 0,
+		index : Index = Index.none, read = False, store = False, persist = False, dtr = False, level = False,
+		fade = False, fadeUp = False, respond = False, allowWrite = False, guard : Guard = Guard.none):
+		assert not guard or not any((read, store, persist, dtr, level, fade, respond, allowWrite)), \
+			'Guards only check their source'
+		assert fade or not fadeUp, 'Only fades have a direction'
+		self.fields = {
+			'arg': arg, 'index': index, 'src': src, 'op': op, 'read': read, 'store': store, 'persist': persist,
+			'dtr': dtr, 'level': level, 'fade': fade, 'fadeUp': fadeUp, 'respond': respond,
+			'allowWrite': allowWrite, 'guard': guard,
+		}
+
+	def encode(self, registerAddress, next : int) -> int:
+		fields = dict(self.fields, next = next)
+		if isinstance(fields['arg'], str):
+			fields['arg'] = registerAddress(fields['arg'])
+		elif isinstance(fields['arg'], tuple):
+			name, offset = fields['arg']
+			fields['arg'] = registerAddress(name) + offset
+		word = 0
+		offset = 0
+		for name, width in microOpLayout:
+			value = int(fields[name])
+			assert 0 <= value < 2 ** width, f'{value} does not fit the {width} bit {name} field'
+			word |= value << offset
+			offset += width
+		return word
+
+def respond(src : Source, arg = 0, *, op = Operation.load) -> tuple:
+	return (MicroOp(src = src, op = op, arg = arg, respond = True),)
+
+def query(register, index : Index = Index.none) -> tuple:
+	return (
+		MicroOp(arg = register, index = index, read = True),
+		MicroOp(src = Source.operand, respond = True),
+	)
+
+def store(register : str, src : Source = Source.acc, index : Index = Index.none) -> tuple:
+	return (MicroOp(src = src, arg = register, index = index, store = True, persist = True),)
+
+def commandPrograms(*, deviceType : DeviceType, physicalMinLevel : int) -> dict:
+	# Commands without a program do nothing
+	return {
+		DALICommand.lampOff: (MicroOp(src = Source.immediate, arg = 0, level = True),),
+		# Fade for 200ms at the fade rate, going no further than max or min level
+		DALICommand.fadeUp: (
+			MicroOp(arg = 'maxLevel', read = True),
+			MicroOp(src = Source.operand, fade = True, fadeUp = True),
+		),
+		DALICommand.fadeDown: (
+			MicroOp(arg = 'minLevel', read = True),
+			MicroOp(src = Source.operand, fade = True),
+		),
+		DALICommand.levelToDTR: (MicroOp(src = Source.level, dtr = True),),
+		# Max level is DTR, but no more than 254 and no lower than min level. A lamp above it comes down to it
+		DALICommand.dtrToMaxLevel: (
+			MicroOp(src = Source.dtr, arg = 'minLevel', read = True),
+			MicroOp(src = Source.immediate, op = Operation.min, arg = 254),
+			MicroOp(src = Source.operand, op = Operation.max),
+		) + store('maxLevel') + (
+			MicroOp(src = Source.level, guard = Guard.notAboveAcc),
+			MicroOp(level = True),
+		),
+		# Min level is DTR, but no higher than max level and no lower than the physical minimum. A lamp that's
+		# lit below it goes up to it
+		DALICommand.dtrToMinLevel: (
+			MicroOp(src = Source.dtr, arg = 'maxLevel', read = True),
+			MicroOp(src = Source.operand, op = Operation.min),
+			MicroOp(src = Source.immediate, op = Operation.max, arg = physicalMinLevel),
+		) + store('minLevel') + (
+			MicroOp(src = Source.level, guard = Guard.notBelowAcc),
+			MicroOp(src = Source.level, guard = Guard.notAbove),
+			MicroOp(level = True),
+		),
+		DALICommand.dtrToFailureLevel: store('failureLevel', Source.dtr),
+		DALICommand.dtrToOnLevel: store('onLevel', Source.dtr),
+		DALICommand.dtrToFadeTime: (
+			MicroOp(src = Source.dtr),
+			MicroOp(src = Source.immediate, op = Operation.min, arg = 15),
+		) + store('fadeTime'),
+		DALICommand.dtrToFadeRate: (
+			MicroOp(src = Source.dtr),
+			MicroOp(src = Source.immediate, op = Operation.min, arg = 15),
+		) + store('fadeRate'),
+		DALICommand.dtrToScene: store('scene0', Source.dtr, Index.data),
+		DALICommand.removeFromScene:
+			(MicroOp(src = Source.immediate, arg = 0xFF),) + store('scene0', index = Index.data),
+		DALICommand.addToGroup: (
+			MicroOp(arg = 'group', index = Index.group, read = True),
+			MicroOp(src = Source.operand, op = Operation.setBit),
+		) + store('group', index = Index.group),
+		DALICommand.removeFromGroup: (
+			MicroOp(arg = 'group', index = Index.group, read = True),
+			MicroOp(src = Source.operand, op = Operation.clearBit),
+		) + store('group', index = Index.group),
+		DALICommand.dtrToShortAddress: store('shortAddress', Source.dtr),
+		DALICommand.enableMemoryWrite: (MicroOp(allowWrite = True),),
+		DALICommand.queryStatus: respond(Source.status),
+		DALICommand.queryPowerOn: respond(Source.status, 2, op = Operation.bit),
+		DALICommand.queryMissingShortAddr: respond(Source.status, 6, op = Operation.bit),
+		DALICommand.queryPowerFailure: respond(Source.status, 7, op = Operation.bit),
+		# Standard says we answer '1'..
+		DALICommand.queryVersionNumber: respond(Source.immediate, 1),
+		DALICommand.queryDTR: respond(Source.dtr),
+		DALICommand.queryDeviceType: respond(Source.immediate, deviceType),
+		DALICommand.queryPhyMinLevel: respond(Source.immediate, physicalMinLevel),
+		DALICommand.queryDTR1: respond(Source.dtr1),
+		DALICommand.queryDTR2: respond(Source.dtr2),
+		DALICommand.queryLevel: respond(Source.level),
+		DALICommand.queryMaxLevel: query('maxLevel'),
+		DALICommand.queryMinLevel: query('minLevel'),
+		DALICommand.queryOnLevel: query('onLevel'),
+		DALICommand.queryFailureLevel: query('failureLevel'),
+		DALICommand.queryFadeTimeRate: (
+			MicroOp(arg = 'fadeTime', read = True),
+			MicroOp(src = Source.operand, arg = 'fadeRate', read = True),
+			MicroOp(src = Source.operand, op = Operation.nibbles, respond = True),
+		),
+		DALICommand.querySceneLevel: query('scene0', Index.data),
+		DALICommand.queryGroups0_7: query('group'),
+		DALICommand.queryGroups8_15: query(('group', 1)),
+		DALICommand.queryRandomAddrH: respond(Source.randomAddrH),
+		DALICommand.queryRandomAddrM: respond(Source.randomAddrM),
+		DALICommand.queryRandomAddrL: respond(Source.randomAddrL),
+	}
+
+def deviceCommandPrograms(deviceType : DeviceType) -> dict:
+	# Device specific commands without a program do nothing
+	if deviceType == DeviceType.led:
+		return {
+			# A DTR that isn't one of our curves is ignored
+			DALILEDCommand.selectCurve: (
+				MicroOp(src = Source.dtr, arg = max(DimmingCurve), guard = Guard.above),
+			) + store('dimmingCurve', Source.dtr),
+			DALILEDCommand.queryDimmingCurve: query('dimmingCurve'),
+			DALILEDCommand.queryExtVersionNumber: respond(Source.immediate, 1),
+		}
+	raise ValueError(f'DeviceType {deviceType} is not supported')
+
+def assemble(programs : dict, devicePrograms : dict, registerAddress) -> list:
+	# Each command's first op sits at its value, or 64 on for device specific ones, with the rest of the
+	# program after the entry points
+	entries = {command.value: program for command, program in programs.items()}
+	entries.update({64 + command.value: program for command, program in devicePrograms.items()})
+	contents = [0] * 96
+	for entry, program in sorted(entries.items()):
+		assert 0 < len(program), 'Programs need at least one op'
+		addresses = [entry] + list(range(len(contents), len(contents) + len(program) - 1))
+		contents.extend([0] * (len(program) - 1))
+		for i, microOp in enumerate(program):
+			last = i == len(program) - 1 or microOp.fields['respond']
+			contents[addresses[i]] = microOp.encode(registerAddress, 0 if last else addresses[i + 1])
+	assert len(contents) <= 256
+	return contents
@@ -0,0 +1,618 @@
+from nmigen import *
+from nmigen.lib.fifo import SyncFIFOBuffered
+from ..fram import FRAM, FRAMPort
+
+__all__ = (
+	'PersistLayout',
+	'PersistEngine',
+	'crc16',
+	'crc16Step',
+)
+
+def crc16(data : bytes, crc : int = 0xFFFF) -> int:
+	# CRC-16/CCITT-FALSE (polynomial 0x1021, MSb first) of data, continuing on from crc
+	for byte in data:
+		crc ^= byte << 8
+		for _ in range(8):
+			crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+	return crc
+
+def crc16Step(crc : Value, data : Value) -> Value:
+	# Folds one byte of data into crc in a single cycle, as crc16 does
+	for bit in reversed(range(8)):
+		feedback = crc[15] ^ data[bit]
+		crc = crc.shift_left(1)[0:16] ^ Mux(feedback, 0x1021, 0)
+	return crc
+
+class PersistLayout:
+	# A 4 byte header of the layout version and map length, the register map, and the CRC-16 of all that,
+	# followed by the journal - a ring of slots each holding one record of (address, value) writes
+	headerLength = 4
+	crcLength = 2
+
+	def __init__(self, registers, *, journalSlots : int = 4, journalDepth : int = 32):
+		registers = sorted(registers, key = lambda register: register[1])
+		self.defaults = b''
+		for name, addr, default in registers:
+			assert addr == len(self.defaults), f'Register {name} is not contiguous with the one before it'
+			self.defaults += bytes(default)
+		self.length = len(self.defaults)
+		assert self.length > 0
+		# Journal entries address the register map and the image CRC after it with a single byte
+		assert self.length + self.crcLength <= 256
+		descriptor = ';'.join(f'{name}:{addr}:{len(default)}' for name, addr, default in registers)
+		self.version = crc16(descriptor.encode())
+		self.header = self.version.to_bytes(2, 'big') + self.length.to_bytes(2, 'big')
+		self.crcAddress = self.headerLength + self.length
+		self.imageLength = self.crcAddress + self.crcLength
+
+		assert journalSlots >= 2, 'The journal needs somewhere to go while the newest record is being replaced'
+		self.journalSlots = journalSlots
+		self.journalDepth = journalDepth
+		self.recordEntries = journalDepth + self.crcLength
+		assert self.recordEntries < 256
+		self.slotLength = 2 + (self.recordEntries * 2) + self.crcLength
+		self.journalBase = self.imageLength
+		self.journalLength = self.slotLength * journalSlots
+
+	def image(self, registers : bytes = None) -> bytes:
+		# The FRAM image holding registers, or the defaults
+		if registers is None:
+			registers = self.defaults
+		assert len(registers) == self.length
+		image = self.header + bytes(registers)
+		return image + crc16(image).to_bytes(2, 'big')
+
+	def record(self, sequence : int, entries, registers : bytes) -> bytes:
+		# The journal record for entries, which leave the register map holding registers
+		imageCRC = crc16(self.image(registers)[:self.crcAddress])
+		entries = list(entries) + [(self.length, imageCRC >> 8), (self.length + 1, imageCRC & 0xFF)]
+		assert len(entries) <= self.recordEntries
+		record = bytes((sequence & 0xFF, len(entries))) + bytes(byte for entry in entries for byte in entry)
+		return record + crc16(record, crc16(self.header)).to_bytes(2, 'big')
+
+	def slotAddress(self, slot : int) -> int:
+		return self.journalBase + (slot * self.slotLength)
+
+class PersistEngine(Elaboratable):
+	# Loads the register map from FRAM at boot, then journals posted writes once the bus goes quiet and
+	# applies each record to the image before starting the next, so only the newest can need replaying
+	def __init__(self, *, resourceName : tuple = None, memory : FRAMPort = None, layout : PersistLayout,
+		holdoff : float, hardBus : bool = False, divider : int = 1, ddr : bool = False):
+		# Boot-time load stream - each byte of the register map is presented once on loadData with its
+		# address while loadValid is high, in address order, loaded goes high once they all have been.
+		# If the image turns out to be damaged or from a different layout, loadFailed strobes just before
+		# loaded goes high and the register map should be put back to its defaults
+		self.loadAddress = Signal(11)
+		self.loadData = Signal(8)
+		self.loadValid = Signal()
+		self.loadFailed = Signal()
+		self.loaded = Signal()
+		# Posted writes - writeAddress and writeData are queued when writeValid and writeReady are both high
+		self.writeAddress = Signal(11)
+		self.writeData = Signal(8)
+		self.writeValid = Signal()
+		self.writeReady = Signal()
+		# Strobe on bus activity, holds off draining the queue until things have gone quiet again
+		self.activity = Signal()
+		# Count of writes dropped because FRAM already holds (or is about to hold) the value written
+		self.suppressedWrites = Signal(16)
+
+		# Either the FRAM resource to drive or a port onto one shared through an arbiter
+		assert (resourceName is None) != (memory is None), 'Exactly one of resourceName and memory must be given'
+		# and for a resource of our own, whether to drive it through the SB_SPI block rather than from fabric
+		# and how fast SCLK runs, as for FRAM
+		assert not ((hardBus or divider != 1 or ddr) and memory is not None), \
+			'A shared FRAM picks its bus where it is driven from'
+		self._resourceName = resourceName
+		self._hardBus = hardBus
+		self._divider = divider
+		self._ddr = ddr
+		self._memory = memory
+		self._layout = layout
+		self._holdoff = holdoff
+		# A whole queue's worth of writes has to fit in a single journal record
+		self._depth = layout.journalDepth
+
+	def elaborate(self, platform) -> Module:
+		m = Module()
+		layout = self._layout
+		if self._memory is None:
+			m.submodules.memory = memory = FRAM(resourceName = self._resourceName, hardBus = self._hardBus,
+				divider = self._divider, ddr = self._ddr)
+		else:
+			memory = self._memory
+		assert layout.journalBase + layout.journalLength <= 2 ** len(memory.address), \
+			'The image and journal do not fit in the FRAM'
+		# Queued writes are kept as address and data pairs in block RAM, and thrown away if the boot load fails
+		queueFlush = Signal()
+		m.submodules.queue = queue = ResetInserter(queueFlush)(SyncFIFOBuffered(
+			width = len(self.writeAddress) + len(self.writeData), depth = self._depth))
+
+		# Shadow of what FRAM will hold once the queue has drained, for spotting writes that change nothing
+		shadow = Memory(width = len(self.writeData), depth = layout.length)
+		m.submodules.shadowRead = shadowRead = shadow.read_port(transparent = False)
+		m.submodules.shadowWrite = shadowWrite = shadow.write_port()
+		# and a second port over it for regenerating the image and its CRC
+		m.submodules.imageRead = imageRead = shadow.read_port(transparent = False)
+		checkValid = Signal()
+		checkAddress = Signal.like(self.writeAddress)
+		checkData = Signal.like(self.writeData)
+		# Holds the check stage off the shadow, which also keeps the queue from growing
+		shadowBusy = Signal()
+
+		# The (address, value) entries of the record being applied to the image
+		staging = Memory(width = 16, depth = layout.recordEntries)
+		m.submodules.stagingRead = stagingRead = staging.read_port(transparent = False)
+		m.submodules.stagingWrite = stagingWrite = staging.write_port()
+		stagingIndex = Signal(range(layout.recordEntries + 1))
+		stagingNext = Signal.like(stagingIndex)
+		stagingCount = Signal.like(stagingIndex)
+		stagingAddress = Signal(8)
+		stagingData = Signal(8)
+		applyPending = Signal()
+
+		queueAddress = Signal.like(self.writeAddress)
+		queueData = Signal.like(self.writeData)
+		currentAddress = Signal.like(self.writeAddress)
+		currentData = Signal.like(self.writeData)
+		holdoffCount = int(platform.default_clk_frequency * self._holdoff)
+		holdoffTimer = Signal(range(holdoffCount + 1))
+		# Carry on with the burst while the next staged write is for the address straight after this one
+		burstContinues = Signal()
+
+		# Position within the image for the boot load, restoring defaults and regenerating the image
+		imageIndex = Signal(range(layout.imageLength))
+		imageNext = Signal.like(imageIndex)
+		imageByte = Signal(8)
+		loadByte = Signal(8)
+		crc = Signal(16)
+		headerValid = Signal()
+		# The whole image needs rewriting, after the journal has been cleared out of the way
+		imageStale = Signal()
+		journalStale = Signal()
+
+		# Journal scan, replay and append state
+		journalIndex = Signal(range(layout.journalLength))
+		recordIndex = Signal(range(layout.slotLength))
+		recordCount = Signal(8)
+		recordSequence = Signal(8)
+		recordCRC = Signal(16)
+		recordByte = Signal(8)
+		recordEntry = Signal(8)
+		entryAddress = Signal(8)
+		entryData = Signal(8)
+		scanBase = Signal.like(memory.address)
+		newestValid = Signal()
+		newestBase = Signal.like(memory.address)
+		newestSequence = Signal(8)
+		newestCount = Signal(8)
+		appendBase = Signal.like(memory.address)
+		appendSequence = Signal(8)
+		replayAddress = Signal(8)
+		# Register map bytes the replayed record has written, and the image CRC it leaves behind
+		replayed = Signal(layout.length)
+		replayCRC = Signal(16)
+
+		header = Array(Const(byte, 8) for byte in layout.header)
+		defaults = Array(Const(byte, 8) for byte in layout.defaults)
+		# The CRC over the header never changes, so regenerating the CRC alone can start from it
+		headerCRC = crc16(layout.header)
+		lastSlotBase = layout.slotAddress(layout.journalSlots - 1)
+
+		m.d.comb += [
+			self.writeReady.eq(~checkValid),
+			shadowRead.addr.eq(self.writeAddress),
+			shadowRead.en.eq(self.writeValid & self.writeReady),
+			shadowWrite.addr.eq(checkAddress),
+			shadowWrite.data.eq(checkData),
+			shadowWrite.en.eq(0),
+			shadowBusy.eq(0),
+			queue.w_data.eq(Cat(checkAddress, checkData)),
+			queue.w_en.eq(0),
+			queueAddress.eq(queue.r_data[0:len(queueAddress)]),
+			queueData.eq(queue.r_data[len(queueAddress):]),
+			queue.r_en.eq(0),
+			queueFlush.eq(0),
+
+			stagingNext.eq(stagingIndex),
+			stagingRead.addr.eq(stagingNext),
+			stagingAddress.eq(stagingRead.data[0:8]),
+			stagingData.eq(stagingRead.data[8:16]),
+			stagingWrite.addr.eq(recordEntry),
+			stagingWrite.data.eq(Cat(entryAddress, entryData)),
+			stagingWrite.en.eq(0),
+			recordEntry.eq((recordIndex - 2)[1:]),
+
+			imageNext.eq(imageIndex),
+			imageRead.addr.eq(imageNext - layout.headerLength),
+			self.loadAddress.eq(imageIndex - layout.headerLength),
+			self.loadData.eq(loadByte),
+			self.loadValid.eq(0),
+			memory.dataOut.eq(currentData),
+			burstContinues.eq((stagingIndex < stagingCount) & (stagingAddress == currentAddress + 1)),
+		]
+		m.d.sync += [
+			imageIndex.eq(imageNext),
+			stagingIndex.eq(stagingNext),
+			self.loadFailed.eq(0),
+		]
+
+		# Byte at imageIndex of the image as it stands in the shadow
+		with m.If(imageIndex < layout.headerLength):
+			m.d.comb += imageByte.eq(header[imageIndex[0:2]])
+		with m.Elif(imageIndex < layout.crcAddress):
+			m.d.comb += imageByte.eq(imageRead.data)
+		with m.Elif(imageIndex == layout.crcAddress):
+			m.d.comb += imageByte.eq(crc[8:16])
+		with m.Else():
+			m.d.comb += imageByte.eq(crc[0:8])
+
+		# Byte at imageIndex of the image as read back from FRAM, with anything the replayed record wrote
+		# taking precedence as the power may have gone before it made it into the image
+		with m.If((imageIndex >= layout.headerLength) & (imageIndex < layout.crcAddress)):
+			m.d.comb += loadByte.eq(Mux(replayed.bit_select(self.loadAddress, 1), imageRead.data, memory.dataIn))
+		with m.Elif((imageIndex == layout.crcAddress) & applyPending):
+			m.d.comb += loadByte.eq(replayCRC[8:16])
+		with m.Elif((imageIndex == layout.crcAddress + 1) & applyPending):
+			m.d.comb += loadByte.eq(replayCRC[0:8])
+		with m.Else():
+			m.d.comb += loadByte.eq(memory.dataIn)
+
+		# Entry of the record being appended, the queued writes followed by the image CRC they lead to
+		with m.If(recordEntry < recordCount - layout.crcLength):
+			m.d.comb += [
+				entryAddress.eq(queueAddress),
+				entryData.eq(queueData),
+			]
+		with m.Elif(recordEntry == recordCount - layout.crcLength):
+			m.d.comb += [
+				entryAddress.eq(layout.length),
+				entryData.eq(crc[8:16]),
+			]
+		with m.Else():
+			m.d.comb += [
+				entryAddress.eq(layout.length + 1),
+				entryData.eq(crc[0:8]),
+			]
+
+		with m.If(recordIndex == 0):
+			m.d.comb += recordByte.eq(appendSequence)
+		with m.Elif(recordIndex == 1):
+			m.d.comb += recordByte.eq(recordCount)
+		with m.Elif(recordIndex < (recordCount * 2) + 2):
+			m.d.comb += recordByte.eq(Mux(recordIndex[0], entryData, entryAddress))
+		with m.Elif(recordIndex == (recordCount * 2) + 2):
+			m.d.comb += recordByte.eq(recordCRC[8:16])
+		with m.Else():
+			m.d.comb += recordByte.eq(recordCRC[0:8])
+
+		# Writes are checked against the shadow the cycle after they're accepted, and only queued if they change it
+		with m.If(self.writeValid & self.writeReady):
+			m.d.sync += [
+				checkValid.eq(1),
+				checkAddress.eq(self.writeAddress),
+				checkData.eq(self.writeData),
+			]
+		with m.Elif(checkValid):
+			with m.If(shadowRead.data == checkData):
+				m.d.sync += checkValid.eq(0)
+				with m.If(self.suppressedWrites != 2 ** len(self.suppressedWrites) - 1):
+					m.d.sync += self.suppressedWrites.eq(self.suppressedWrites + 1)
+			# The shadow's write port belongs to the boot load and journal for any cycle they need it
+			with m.Elif(queue.w_rdy & ~shadowBusy):
+				m.d.comb += [
+					queue.w_en.eq(1),
+					shadowWrite.en.eq(1),
+				]
+				m.d.sync += checkValid.eq(0)
+
+		with m.If(self.activity):
+			m.d.sync += holdoffTimer.eq(holdoffCount)
+		with m.Elif(holdoffTimer != 0):
+			m.d.sync += holdoffTimer.eq(holdoffTimer - 1)
+
+		with m.FSM(name = 'persist-fsm'):
+			# Read the whole journal in one burst, looking for the newest record that checks out
+			with m.State('JOURNAL-BEGIN'):
+				m.d.sync += [
+					memory.address.eq(layout.journalBase),
+					journalIndex.eq(0),
+					recordIndex.eq(0),
+					scanBase.eq(layout.journalBase),
+				]
+				m.d.comb += memory.read.eq(1)
+				m.next = 'JOURNAL-SCAN'
+			with m.State('JOURNAL-SCAN'):
+				m.d.comb += [
+					memory.readReady.eq(1),
+					memory.last.eq(journalIndex == layout.journalLength - 1),
+				]
+				with m.If(memory.readValid):
+					m.d.sync += [
+						journalIndex.eq(journalIndex + 1),
+						recordCRC.eq(crc16Step(recordCRC, memory.dataIn)),
+					]
+					with m.If(recordIndex == 0):
+						m.d.sync += [
+							recordSequence.eq(memory.dataIn),
+							recordCRC.eq(crc16Step(Const(headerCRC, 16), memory.dataIn)),
+						]
+					with m.Elif(recordIndex == 1):
+						m.d.sync += recordCount.eq(memory.dataIn)
+					# The record ends with its CRC, which leaves nothing behind if it's intact
+					with m.Elif((recordIndex == (recordCount * 2) + 3) & (recordCount != 0) &
+						(recordCount <= layout.recordEntries) & (crc16Step(recordCRC, memory.dataIn) == 0)):
+						# Sequence numbers wrap, a record is newer if it's less than half way round ahead
+						with m.If(~newestValid | ((recordSequence - newestSequence)[7] == 0)):
+							m.d.sync += [
+								newestValid.eq(1),
+								newestBase.eq(scanBase),
+								newestSequence.eq(recordSequence),
+								newestCount.eq(recordCount),
+							]
+					with m.If(recordIndex == layout.slotLength - 1):
+						m.d.sync += [
+							recordIndex.eq(0),
+							scanBase.eq(scanBase + layout.slotLength),
+						]
+					with m.Else():
+						m.d.sync += recordIndex.eq(recordIndex + 1)
+					with m.If(memory.last):
+						m.next = 'JOURNAL-SCANNED'
+			# New records go in the slot after the newest, or at the start of an empty journal
+			with m.State('JOURNAL-SCANNED'):
+				with m.If(newestValid):
+					m.d.sync += [
+						appendBase.eq(Mux(newestBase == lastSlotBase, layout.journalBase, newestBase + layout.slotLength)),
+						appendSequence.eq(newestSequence + 1),
+					]
+					m.next = 'REPLAY-BEGIN'
+				with m.Else():
+					m.d.sync += appendBase.eq(layout.journalBase)
+					m.next = 'LOAD-BEGIN'
+			# Read the newest record's entries back into the shadow, and stage them to be applied again
+			with m.State('REPLAY-BEGIN'):
+				m.d.sync += [
+					memory.address.eq(newestBase + 2),
+					recordIndex.eq(0),
+				]
+				m.d.comb += memory.read.eq(1)
+				m.next = 'REPLAY'
+			with m.State('REPLAY'):
+				m.d.comb += [
+					memory.readReady.eq(1),
+					memory.last.eq(recordIndex == (newestCount * 2) - 1),
+				]
+				with m.If(memory.readValid):
+					m.d.sync += recordIndex.eq(recordIndex + 1)
+					with m.If(~recordIndex[0]):
+						m.d.sync += replayAddress.eq(memory.dataIn)
+					with m.Else():
+						m.d.comb += [
+							recordEntry.eq(recordIndex[1:]),
+							entryAddress.eq(replayAddress),
+							entryData.eq(memory.dataIn),
+							stagingWrite.en.eq(1),
+						]
+						with m.If(replayAddress < layout.length):
+							m.d.comb += [
+								shadowBusy.eq(1),
+								shadowWrite.addr.eq(replayAddress),
+								shadowWrite.data.eq(memory.dataIn),
+								shadowWrite.en.eq(1),
+							]
+							m.d.sync += replayed.bit_select(replayAddress, 1).eq(1)
+						with m.Elif(replayAddress == layout.length):
+							m.d.sync += replayCRC[8:16].eq(memory.dataIn)
+						with m.Else():
+							m.d.sync += replayCRC[0:8].eq(memory.dataIn)
+					with m.If(memory.last):
+						m.d.sync += [
+							stagingCount.eq(newestCount),
+							applyPending.eq(1),
+						]
+						m.next = 'LOAD-BEGIN'
+			# Read the whole image in one burst, checking the header and CRC as it streams past
+			with m.State('LOAD-BEGIN'):
+				m.d.sync += [
+					memory.address.eq(0),
+					crc.eq(0xFFFF),
+					headerValid.eq(1),
+				]
+				m.d.comb += [
+					memory.read.eq(1),
+					imageNext.eq(0),
+				]
+				m.next = 'LOAD'
+			with m.State('LOAD'):
+				m.d.comb += [
+					memory.readReady.eq(1),
+					memory.last.eq(imageIndex == layout.imageLength - 1),
+					self.loadValid.eq(memory.readValid & (imageIndex >= layout.headerLength) &
+						(imageIndex < layout.crcAddress)),
+				]
+				with m.If(memory.readValid):
+					m.d.comb += imageNext.eq(imageIndex + 1)
+					m.d.sync += crc.eq(crc16Step(crc, loadByte))
+					with m.If((imageIndex < layout.headerLength) & (loadByte != header[imageIndex[0:2]])):
+						m.d.sync += headerValid.eq(0)
+					with m.If(self.loadValid):
+						m.d.comb += [
+							shadowBusy.eq(1),
+							shadowWrite.addr.eq(self.loadAddress),
+							shadowWrite.data.eq(loadByte),
+							shadowWrite.en.eq(1),
+						]
+					# Running the stored CRC through as well leaves nothing behind if the image is intact
+					with m.If(memory.last):
+						with m.If(headerValid & (crc16Step(crc, loadByte) == 0)):
+							m.next = 'LOADED'
+						with m.Else():
+							m.d.comb += imageNext.eq(0)
+							m.next = 'RESTORE'
+			# Put the shadow back to the defaults and have the journal cleared and the image rebuilt once
+			# things are quiet. Anything written meanwhile is dropped along with the registers it came from
+			with m.State('RESTORE'):
+				m.d.comb += [
+					shadowBusy.eq(1),
+					shadowWrite.addr.eq(imageIndex),
+					shadowWrite.data.eq(defaults[imageIndex]),
+					shadowWrite.en.eq(1),
+					imageNext.eq(imageIndex + 1),
+				]
+				with m.If(imageIndex == layout.length - 1):
+					m.d.comb += queueFlush.eq(1)
+					m.d.sync += [
+						checkValid.eq(0),
+						applyPending.eq(0),
+						self.loadFailed.eq(1),
+						imageStale.eq(1),
+						journalStale.eq(1),
+					]
+					m.next = 'LOADED'
+			with m.State('LOADED'):
+				m.d.sync += self.loaded.eq(1)
+				m.next = 'IDLE'
+			# Finish applying any record straight away, otherwise wait for the bus to have been quiet for
+			# a while, or the queue to be getting full, before journalling what's queued
+			with m.State('IDLE'):
+				with m.If(applyPending):
+					m.d.comb += stagingNext.eq(0)
+					m.next = 'APPLY'
+				with m.Elif((holdoffTimer == 0) | (queue.level >= self._depth // 2)):
+					with m.If(journalStale):
+						m.d.sync += journalIndex.eq(0)
+						m.next = 'ERASE'
+					with m.Elif(imageStale):
+						m.d.comb += imageNext.eq(0)
+						m.d.sync += crc.eq(0xFFFF)
+						m.next = 'IMAGE-BEGIN'
+					with m.Elif(queue.r_rdy):
+						m.d.comb += [
+							shadowBusy.eq(1),
+							imageNext.eq(layout.headerLength),
+						]
+						m.d.sync += crc.eq(headerCRC)
+						m.next = 'SNAPSHOT'
+			# With the queue and shadow held still, work out the image CRC once everything queued is applied
+			with m.State('SNAPSHOT'):
+				m.d.comb += [
+					shadowBusy.eq(1),
+					imageNext.eq(imageIndex + 1),
+				]
+				m.d.sync += crc.eq(crc16Step(crc, imageByte))
+				with m.If(imageIndex == layout.crcAddress - 1):
+					m.d.sync += [
+						recordCount.eq(queue.level + layout.crcLength),
+						memory.address.eq(appendBase),
+						recordIndex.eq(0),
+						recordCRC.eq(headerCRC),
+					]
+					m.next = 'RECORD'
+			# Append everything that was queued to the journal as a single record, staging it as it goes
+			with m.State('RECORD'):
+				m.d.comb += memory.write.eq(1)
+				m.next = 'RECORD-DATA'
+			with m.State('RECORD-DATA'):
+				m.d.comb += [
+					memory.dataOut.eq(recordByte),
+					memory.writeValid.eq(1),
+					memory.last.eq(recordIndex == (recordCount * 2) + 3),
+				]
+				with m.If(memory.writeReady):
+					m.d.sync += recordIndex.eq(recordIndex + 1)
+					with m.If(recordIndex < (recordCount * 2) + 2):
+						m.d.sync += recordCRC.eq(crc16Step(recordCRC, recordByte))
+					with m.If((recordIndex >= 2) & (recordIndex < (recordCount * 2) + 2) & recordIndex[0]):
+						m.d.comb += stagingWrite.en.eq(1)
+						with m.If(recordEntry < recordCount - layout.crcLength):
+							m.d.comb += queue.r_en.eq(1)
+					with m.If(memory.last):
+						m.next = 'RECORD-WAIT'
+			with m.State('RECORD-WAIT'):
+				with m.If(memory.complete):
+					m.d.sync += [
+						appendBase.eq(Mux(appendBase == lastSlotBase, layout.journalBase, appendBase + layout.slotLength)),
+						appendSequence.eq(appendSequence + 1),
+						stagingCount.eq(recordCount),
+						applyPending.eq(1),
+					]
+					m.next = 'IDLE'
+			# Apply the staged record to the image, writing runs of consecutive addresses back to back
+			with m.State('APPLY'):
+				m.d.comb += stagingNext.eq(stagingIndex + 1)
+				m.d.sync += [
+					currentAddress.eq(stagingAddress),
+					currentData.eq(stagingData),
+					memory.address.eq(stagingAddress + layout.headerLength),
+				]
+				m.next = 'WRITE'
+			with m.State('WRITE'):
+				m.d.comb += memory.write.eq(1)
+				m.next = 'WRITE-DATA'
+			with m.State('WRITE-DATA'):
+				m.d.comb += [
+					memory.writeValid.eq(1),
+					memory.last.eq(~burstContinues),
+				]
+				with m.If(memory.writeReady):
+					with m.If(burstContinues):
+						m.d.comb += stagingNext.eq(stagingIndex + 1)
+						m.d.sync += [
+							currentAddress.eq(stagingAddress),
+							currentData.eq(stagingData),
+						]
+					with m.Else():
+						m.next = 'WRITE-WAIT'
+			with m.State('WRITE-WAIT'):
+				with m.If(memory.complete):
+					with m.If(stagingIndex < stagingCount):
+						m.next = 'APPLY'
+					with m.Else():
+						m.d.sync += applyPending.eq(0)
+						m.next = 'IDLE'
+			# Clear out every record so none of them get replayed over the rebuilt image
+			with m.State('ERASE'):
+				m.d.sync += memory.address.eq(layout.journalBase)
+				m.d.comb += memory.write.eq(1)
+				m.next = 'ERASE-DATA'
+			with m.State('ERASE-DATA'):
+				m.d.comb += [
+					memory.dataOut.eq(0),
+					memory.writeValid.eq(1),
+					memory.last.eq(journalIndex == layout.journalLength - 1),
+				]
+				with m.If(memory.writeReady):
+					m.d.sync += journalIndex.eq(journalIndex + 1)
+					with m.If(memory.last):
+						m.next = 'ERASE-WAIT'
+			with m.State('ERASE-WAIT'):
+				with m.If(memory.complete):
+					m.d.sync += [
+						journalStale.eq(0),
+						appendBase.eq(layout.journalBase),
+					]
+					m.next = 'IDLE'
+			# Write the whole image out from the shadow in one burst
+			with m.State('IMAGE-BEGIN'):
+				m.d.sync += memory.address.eq(0)
+				m.d.comb += memory.write.eq(1)
+				m.next = 'IMAGE-DATA'
+			with m.State('IMAGE-DATA'):
+				m.d.comb += [
+					memory.dataOut.eq(imageByte),
+					memory.writeValid.eq(1),
+					memory.last.eq(imageIndex == layout.imageLength - 1),
+				]
+				with m.If(memory.writeReady):
+					m.d.comb += imageNext.eq(imageIndex + 1)
+					with m.If(imageIndex < layout.crcAddress):
+						m.d.sync += crc.eq(crc16Step(crc, imageByte))
+					with m.If(memory.last):
+						m.next = 'IMAGE-WAIT'
+			with m.State('IMAGE-WAIT'):
+				with m.If(memory.complete):
+					m.d.sync += imageStale.eq(0)
+					m.next = 'IDLE'
+		return m
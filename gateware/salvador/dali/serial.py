@@ -1,165 +1,129 @@
+from math import ceil, floor
 from nmigen import *
 from .manchester import *
+from .bitclock import BitClock
 
 class Serial(Elaboratable):
-	def __init__(self, *, baudRate = 1200):
+	def __init__(self, *, baudRate = 1200, oversampling = 16, settlingTime = (5.5e-3, 10.5e-3), settlingJitter = 0):
 		self.rx = Signal()
 		self.tx = Signal()
 		self.dataIn = Signal(8)
 		self.dataSend = Signal()
 		self.sendComplete = Signal()
-		self.dataOut = Signal(16)
+		# Forward frames come in 16, 24 and 25 bits long, right aligned in dataOut with their length in bits
+		self.dataOut = Signal(25)
+		self.dataLength = Signal(range(27))
 		self.dataAvailable = Signal()
 		self.error = Signal()
+		# Set when a response was dropped for being asked for too late after the forward frame, until the next goes out
+		self.deadlineMissed = Signal()
+		# Set when a response was abandoned because something else pulled the bus low, until the next goes out
+		self.collision = Signal()
+		# Count of responses abandoned for collisions
+		self.collisions = Signal(16)
 		self._bitRate = baudRate * 2
+		self._oversampling = oversampling
+		# Window after the end of a forward frame the response has to start in, and how far into it the start
+		# is randomly pushed
+		self._settlingTime = settlingTime
+		self._settlingJitter = settlingJitter
 
 	def elaborate(self, platform):
 		m = Module()
-		timerCount = int(platform.default_clk_frequency) // self._bitRate
-		rxTimer = Signal(range(timerCount))
-		txTimer = Signal(range(timerCount))
-		rxTimerEnabled = Signal()
+		# Both directions run off the one prescaler, RX sampling on every tick and TX stepping every half-bit's worth
+		m.submodules.bitClock = bitClock = BitClock(frequency = self._bitRate * self._oversampling)
+		txTimer = Signal(range(self._oversampling))
 		txTimerEnabled = Signal()
 
-		with m.If(rxTimerEnabled):
-			with m.If(rxTimer == (timerCount - 1)):
-				m.d.sync += rxTimer.eq(0)
-			with m.Else():
-				m.d.sync += rxTimer.eq(rxTimer + 1)
-		with m.Else():
-			m.d.sync += rxTimer.eq(0)
-
-		with m.If(txTimerEnabled):
-			with m.If(txTimer == (timerCount - 1)):
+		with m.If(txTimerEnabled & bitClock.tick):
+			with m.If(txTimer == (self._oversampling - 1)):
 				m.d.sync += txTimer.eq(0)
 			with m.Else():
 				m.d.sync += txTimer.eq(txTimer + 1)
-		with m.Else():
+		with m.Elif(~txTimerEnabled):
 			m.d.sync += txTimer.eq(0)
 
 		m.submodules.encoder = encoder = ManchesterEncoder()
-		m.submodules.decoder = decoder = ManchesterDecoder()
+		m.submodules.receiver = receiver = ManchesterReceiver(oversampling = self._oversampling)
 
-		rxStep = Signal()
-		rxCycle = Signal()
 		txStep = Signal()
 		txCycle = Signal()
 
 		m.d.comb += [
-			rxStep.eq((rxTimer == 0) & rxTimerEnabled),
-			self.dataAvailable.eq(0),
-			txStep.eq((txTimer == 0) & txTimerEnabled),
-			self.sendComplete.eq(0),
+			receiver.rx.eq(self.rx),
+			receiver.sample.eq(bitClock.tick),
+			self.dataOut.eq(receiver.dataOut),
+			self.dataLength.eq(receiver.length),
+			self.dataAvailable.eq(receiver.dataAvailable),
+			self.error.eq(receiver.error),
 
-			decoder.step.eq(rxStep),
-			decoder.dataIn.eq(self.rx),
+			txStep.eq(bitClock.tick & (txTimer == 0) & txTimerEnabled),
+			self.sendComplete.eq(0),
 
 			encoder.step.eq(txStep),
 			self.tx.eq(encoder.dataOut),
 		]
 
-		rxDelayed = Signal()
-		startStrobe = Signal()
-		m.d.sync += rxDelayed.eq(self.rx)
-		m.d.comb += startStrobe.eq(rxDelayed & ~self.rx)
+		tickRate = self._bitRate * self._oversampling
+		settlingMin = ceil(self._settlingTime[0] * tickRate)
+		settlingMax = floor(self._settlingTime[1] * tickRate)
+		jitterBits = (floor(self._settlingJitter * tickRate) + 1).bit_length() - 1
+		if settlingMin + (2 ** jitterBits) - 1 > settlingMax:
+			raise ValueError(f'Settling time of {self._settlingTime[0]}s plus {self._settlingJitter}s jitter '
+				f'runs past the end of the settling window at {self._settlingTime[1]}s')
 
-		dataValid = Signal()
-		dataRX = Signal.like(self.dataOut)
-		dataRXCount = Signal(range(16))
-		dataRXStopCount = Signal(range(2))
-		dataRXError = Signal()
+		# Bit clock ticks since the last forward frame ended, saturating once the window has closed. Backward
+		# frames, ours included, don't open a window of their own
+		sinceFrame = Signal(range(settlingMax + 2), reset = settlingMax + 1)
+		responseStart = Signal.like(sinceFrame)
+		with m.If(receiver.dataAvailable & (receiver.length != 8)):
+			m.d.sync += sinceFrame.eq(receiver.sinceEnd)
+		with m.Elif(bitClock.tick & (sinceFrame <= settlingMax)):
+			m.d.sync += sinceFrame.eq(sinceFrame + 1)
 
-		with m.FSM(name = 'rx-fsm'):
-			# Wait for data on the rx line
-			with m.State('IDLE'):
-				with m.If(startStrobe):
-					# We've seen the start bit condition, start the rx timer
-					# and reset the cycle toggle + bypass mode
-					m.d.sync += [
-						rxTimerEnabled.eq(1),
-						rxCycle.eq(0),
-						decoder.bypass.eq(0),
-					]
-					m.next = 'START'
-				with m.Else():
-					# Ensure the rx timer is off (resets it to 0) otherwise
-					m.d.sync += rxTimerEnabled.eq(0)
-			# We saw the start condition, wait half a bit time to check it
-			with m.State('START'):
-				with m.If(rxStep):
-					m.d.sync += rxCycle.eq(rxCycle ^ 1)
-				with m.If(rxStep & rxCycle):
-					m.next = 'START-CHECK'
-			# Retiming and decoder check state for the start bit (first half)
-			with m.State('START-CHECK'):
-				with m.If(decoder.valid):
-					m.d.sync += [
-						dataValid.eq(1),
-						dataRXCount.eq(0),
-					]
-					m.next = 'SHIFT'
-				with m.Else():
-					m.next = 'IDLE'
-			# Data shift state
-			with m.State('SHIFT'):
-				with m.If(rxStep):
-					m.d.sync += rxCycle.eq(rxCycle ^ 1)
-				with m.If(rxStep & rxCycle):
-					# When we get to the first half of the cycle for the next bit,
-					# we know the current one is good and can be stored
-					m.next = 'SHIFT-CHECK'
-			# Retiming and decoder check + data store state
-			with m.State('SHIFT-CHECK'):
-				# Store the value of the *previous* bit
-				m.d.sync += [
-					dataRX.eq(Cat(decoder.dataOut , dataRX[:-1])),
-					dataRXCount.eq(dataRXCount + 1),
-				]
-				# Check if the decoder state indicates an error (invalidate if true)
-				with m.If(~decoder.valid):
-					m.d.sync += dataValid.eq(0)
-				# If we timed in all the bits then put the decoder into bypass and look for the stop bits
-				# (This state covers the first half of the first stop bit)
-				with m.If(dataRXCount == 15):
-					m.d.sync += [
-						decoder.bypass.eq(1),
-						dataRXStopCount.eq(0),
-					]
-					m.next = 'STOP'
-				# Next bit please
-				with m.Else():
-					m.next = 'SHIFT'
-			# Stop bit checking
-			with m.State('STOP'):
-				with m.If(rxStep):
-					m.d.sync += rxCycle.eq(rxCycle ^ 1)
-				with m.If(rxStep & rxCycle):
-					# If we've seen the second half of the current stop bit
-					m.d.sync += dataRXStopCount.eq(dataRXStopCount + 1)
-					# Make sure things are still valid (invalidate if not)
-					with m.If(~decoder.valid):
-						m.d.sync == dataValid.eq(0)
-					# If we've seen both stop bits
-					with m.If(dataRXStopCount == 1):
-						# Make the error state and received data are presented up
-						m.d.sync += [
-							self.error.eq(dataRXError),
-							self.dataOut.eq(dataRX),
-						]
-						# And signal that we've made data available
-						m.d.comb += self.dataAvailable.eq(1)
-						m.next = 'IDLE'
-		m.d.comb += dataRXError.eq(dataValid & (~decoder.valid))
+		jitter = Const(0, 1)
+		if jitterBits:
+			# x^16 + x^14 + x^13 + x^11 + 1, run freely so the value picked up depends on when we're asked
+			lfsr = Signal(16, reset = 1)
+			m.d.sync += lfsr.eq(Cat(lfsr[15] ^ lfsr[13] ^ lfsr[12] ^ lfsr[10], lfsr[:-1]))
+			jitter = lfsr[:jitterBits]
 
 		dataTX = Signal.like(self.dataIn)
 		dataTXCount = Signal(range(8))
 		dataTXStopCount = Signal(range(2))
 
+		# Read the bus back half way through each half-bit we send. It's wired-AND so only shows a
+		# collision as the line being low while we've let go of it
+		collided = Signal()
+		m.d.comb += collided.eq(txTimerEnabled & bitClock.tick & (txTimer == self._oversampling // 2) &
+			encoder.dataOut & ~receiver.level)
+
+		def abortOnCollision():
+			with m.If(collided):
+				m.d.sync += [
+					txTimerEnabled.eq(0),
+					encoder.bypass.eq(1),
+					encoder.dataIn.eq(1),
+				]
+				m.next = 'ABORT'
+
 		with m.FSM(name = 'tx-fsm'):
 			# Wait for the controller to signal data to send
 			with m.State('IDLE'):
 				with m.If(self.dataSend):
-					# Signal received, start the tx timer,
+					# If the settling window after the forward frame has already closed, it's too late to answer
+					with m.If(sinceFrame > settlingMax):
+						m.next = 'DROP'
+					with m.Else():
+						m.d.sync += responseStart.eq(settlingMin + jitter)
+						m.next = 'SETTLE'
+				with m.Else():
+					# Ensure the tx timer is off (resets it to 0) otherwise
+					m.d.sync += txTimerEnabled.eq(0)
+			# Hold the response until the bus has settled after the forward frame
+			with m.State('SETTLE'):
+				with m.If(sinceFrame >= responseStart):
+					# Start the tx timer,
 					# setting a 0-bit for the encoder
 					# and reset the cycle toggle + bypass mode
 					m.d.sync += [
@@ -167,11 +131,15 @@ class Serial(Elaboratable):
 						txCycle.eq(0),
 						encoder.bypass.eq(0),
 						encoder.dataIn.eq(0),
+						self.deadlineMissed.eq(0),
+						self.collision.eq(0),
 					]
 					m.next = 'START'
-				with m.Else():
-					# Ensure the tx timer is off (resets it to 0) otherwise
-					m.d.sync += txTimerEnabled.eq(0)
+			# Flag the response as missed and let the controller know we're done with it
+			with m.State('DROP'):
+				m.d.sync += self.deadlineMissed.eq(1)
+				m.d.comb += self.sendComplete.eq(1)
+				m.next = 'IDLE'
 			# We began the start condition, wait half a bit time to before starting shift prep
 			with m.State('START'):
 				with m.If(txStep):
@@ -181,6 +149,7 @@ class Serial(Elaboratable):
 					# the encoder will put out its complement, so load the next bit
 					m.d.sync += dataTX.eq(self.dataIn)
 					m.next = 'SHIFT-PREP'
+				abortOnCollision()
 			# Retiming and encoder prep state for the end of the start bit and first data bit
 			with m.State('SHIFT-PREP'):
 				m.d.sync += [
@@ -188,6 +157,7 @@ class Serial(Elaboratable):
 					encoder.dataIn.eq(dataTX[7]),
 				]
 				m.next = 'SHIFT'
+				abortOnCollision()
 			# Data shift state
 			with m.State('SHIFT'):
 				with m.If(txStep):
@@ -197,6 +167,7 @@ class Serial(Elaboratable):
 					# the encoder will put out its complement, shift the data to send
 					m.d.sync += dataTX.eq(dataTX.shift_left(1)),
 					m.next = 'SHIFT-NEXT'
+				abortOnCollision()
 			# Retiming and decoder check + data store state
 			with m.State('SHIFT-NEXT'):
 				m.d.sync += dataTXCount.eq(dataTXCount + 1)
@@ -213,6 +184,7 @@ class Serial(Elaboratable):
 					# Load the next bit please
 					m.d.sync += encoder.dataIn.eq(dataTX[7]),
 					m.next = 'SHIFT'
+				abortOnCollision()
 			# Stop bit generation
 			with m.State('STOP'):
 				with m.If(txStep):
@@ -225,4 +197,15 @@ class Serial(Elaboratable):
 						# Signal that we're done transmitting
 						m.d.comb += self.sendComplete.eq(1)
 						m.next = 'IDLE'
+				abortOnCollision()
+			# Let go of the bus, flag and count the collision and let the controller know we're done
+			with m.State('ABORT'):
+				m.d.comb += [
+					encoder.step.eq(1),
+					self.sendComplete.eq(1),
+				]
+				m.d.sync += self.collision.eq(1)
+				with m.If(self.collisions != 2 ** len(self.collisions) - 1):
+					m.d.sync += self.collisions.eq(self.collisions + 1)
+				m.next = 'IDLE'
 		return m
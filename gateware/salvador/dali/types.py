@@ -4,6 +4,9 @@ __all__ = (
 	'DALICommand',
 	'DeviceType',
 	'DALILEDCommand',
+	'DimmingCurve',
+	'DALICommandOpcodes',
+	'DALILEDCommandOpcodes',
 )
 
 @unique
@@ -94,3 +97,94 @@ class DALILEDCommand(IntEnum):
 	queryMinFastFadeTime = 22,
 	queryExtVersionNumber = 23,
 	nop = 24,
+
+@unique
+class DimmingCurve(IntEnum):
+	logarithmic = 0
+	linear = 1
+
+# Command byte patterns for the standard commands, with '-' marking bits that don't matter. Any of those in the
+# bottom nibble are handed on as the command's data, and bytes matching none of the patterns decode to nop
+DALICommandOpcodes = (
+	('0000 0000', DALICommand.lampOff),
+	('0000 0001', DALICommand.fadeUp),
+	('0000 0010', DALICommand.fadeDown),
+	('0000 0011', DALICommand.stepUp),
+	('0000 0100', DALICommand.stepDown),
+	('0000 0101', DALICommand.gotoMax),
+	('0000 0110', DALICommand.gotoMin),
+	('0000 0111', DALICommand.stepDownAndOff),
+	('0000 1000', DALICommand.stepUpAndOn),
+	('0000 1001', DALICommand.enableDirectCtrl),
+	('0001 ----', DALICommand.gotoScene),
+	('0010 0000', DALICommand.reset),
+	('0010 0001', DALICommand.levelToDTR),
+	('0010 1010', DALICommand.dtrToMaxLevel),
+	('0010 1011', DALICommand.dtrToMinLevel),
+	('0010 1100', DALICommand.dtrToFailureLevel),
+	('0010 1101', DALICommand.dtrToOnLevel),
+	('0010 1110', DALICommand.dtrToFadeTime),
+	('0010 1111', DALICommand.dtrToFadeRate),
+	('0100 ----', DALICommand.dtrToScene),
+	('0101 ----', DALICommand.removeFromScene),
+	('0110 ----', DALICommand.addToGroup),
+	('0111 ----', DALICommand.removeFromGroup),
+	('1000 0000', DALICommand.dtrToShortAddress),
+	('1000 0001', DALICommand.enableMemoryWrite),
+	('1001 0000', DALICommand.queryStatus),
+	('1001 0001', DALICommand.queryControlGear),
+	('1001 0010', DALICommand.queryFailure),
+	('1001 0011', DALICommand.queryPowerOn),
+	('1001 0100', DALICommand.queryLimitError),
+	('1001 0101', DALICommand.queryResetState),
+	('1001 0110', DALICommand.queryMissingShortAddr),
+	('1001 0111', DALICommand.queryVersionNumber),
+	('1001 1000', DALICommand.queryDTR),
+	('1001 1001', DALICommand.queryDeviceType),
+	('1001 1010', DALICommand.queryPhyMinLevel),
+	('1001 1011', DALICommand.queryPowerFailure),
+	('1001 1100', DALICommand.queryDTR1),
+	('1001 1101', DALICommand.queryDTR2),
+	('1010 0000', DALICommand.queryLevel),
+	('1010 0001', DALICommand.queryMaxLevel),
+	('1010 0010', DALICommand.queryMinLevel),
+	('1010 0011', DALICommand.queryOnLevel),
+	('1010 0100', DALICommand.queryFailureLevel),
+	('1010 0101', DALICommand.queryFadeTimeRate),
+	('1011 ----', DALICommand.querySceneLevel),
+	('1100 0000', DALICommand.queryGroups0_7),
+	('1100 0001', DALICommand.queryGroups8_15),
+	('1100 0010', DALICommand.queryRandomAddrH),
+	('1100 0011', DALICommand.queryRandomAddrM),
+	('1100 0100', DALICommand.queryRandomAddrL),
+	('1100 0101', DALICommand.readMemoryLoc),
+	('111- ----', DALICommand.deviceSpecific),
+)
+
+# Device specific command patterns for LED gear, over the bottom 5 bits of the command byte
+DALILEDCommandOpcodes = (
+	('00000', DALILEDCommand.referenceSystemPower),
+	('00001', DALILEDCommand.enableCurrentProt),
+	('00010', DALILEDCommand.disableCurrentProt),
+	('00011', DALILEDCommand.selectCurve),
+	('00100', DALILEDCommand.dtrToFastFadeTime),
+	('01101', DALILEDCommand.queryGearType),
+	('01110', DALILEDCommand.queryDimmingCurve),
+	('01111', DALILEDCommand.queryOperatingModes),
+	('10000', DALILEDCommand.queryFeatures),
+	('10001', DALILEDCommand.queryFailStatus),
+	('10010', DALILEDCommand.queryShortCircuit),
+	('10011', DALILEDCommand.queryOpenCircuit),
+	('10100', DALILEDCommand.queryLoadDecrease),
+	('10101', DALILEDCommand.queryLoadIncrease),
+	('10110', DALILEDCommand.queryCurrentProtActive),
+	('10111', DALILEDCommand.queryThermalShutDown),
+	('11000', DALILEDCommand.queryThermalOverload),
+	('11001', DALILEDCommand.queryReferenceRunning),
+	('11010', DALILEDCommand.queryReferenceFailed),
+	('11011', DALILEDCommand.queryCurrentProtEn),
+	('11100', DALILEDCommand.queryOperatingMode),
+	('11101', DALILEDCommand.queryFastFadeTime),
+	('11110', DALILEDCommand.queryMinFastFadeTime),
+	('11111', DALILEDCommand.queryExtVersionNumber),
+)
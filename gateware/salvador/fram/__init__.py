@@ -1,5 +1,8 @@
 from .fram import FRAM
+from .arbiter import FRAMArbiter, FRAMPort
 
 __all__ = (
 	'FRAM',
+	'FRAMArbiter',
+	'FRAMPort',
 )
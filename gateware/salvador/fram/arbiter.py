@@ -0,0 +1,109 @@
+from nmigen import *
+from .fram import FRAM
+
+__all__ = (
+	'FRAMArbiter',
+	'FRAMPort',
+)
+
+class FRAMPort:
+	# Addresses are relative to the start of the client's window
+	def __init__(self, *, windowBits : int):
+		self.address = Signal(windowBits)
+		self.dataIn = Signal(8)
+		self.dataOut = Signal(8)
+		self.read = Signal()
+		self.write = Signal()
+		self.complete = Signal()
+		self.readValid = Signal()
+		self.readReady = Signal()
+		self.writeValid = Signal()
+		self.writeReady = Signal()
+		self.last = Signal()
+
+class FRAMArbiter(Elaboratable):
+	# Splits the FRAM into a window per client, serving pending transactions round robin
+	def __init__(self, resourceName : tuple, *, clients : int, hardBus : bool = False, divider : int = 1,
+		ddr : bool = False):
+		assert clients >= 1
+		self._resourceName = resourceName
+		# Whether the FRAM is driven through the SB_SPI block rather than from fabric
+		self._hardBus = hardBus
+		# and how fast SCLK runs, as for FRAM
+		self._divider = divider
+		self._ddr = ddr
+		# The FRAM has an 11 bit address, the top bits of which pick the window
+		self._selectBits = (clients - 1).bit_length()
+		self.ports = tuple(FRAMPort(windowBits = 11 - self._selectBits) for _ in range(clients))
+
+	def elaborate(self, platform) -> Module:
+		m = Module()
+		m.submodules.memory = memory = FRAM(resourceName = self._resourceName, hardBus = self._hardBus,
+			divider = self._divider, ddr = self._ddr)
+		clients = len(self.ports)
+
+		# Transactions clients have started but not yet been given the FRAM for
+		pendingRead = Signal(clients)
+		pendingWrite = Signal(clients)
+		pending = Signal(clients)
+		grant = Signal(range(clients))
+		nextGrant = Signal.like(grant)
+		busy = Signal()
+
+		m.d.comb += pending.eq(pendingRead | pendingWrite)
+		for index, port in enumerate(self.ports):
+			with m.If(port.read):
+				m.d.sync += pendingRead[index].eq(1)
+			with m.If(port.write):
+				m.d.sync += pendingWrite[index].eq(1)
+
+		# Next in line is the first pending client after the one granted last, which goes to the back of the queue
+		with m.Switch(grant):
+			for last in range(clients):
+				with m.Case(last):
+					for offset in reversed(range(1, clients + 1)):
+						index = (last + offset) % clients
+						with m.If(pending[index]):
+							m.d.comb += nextGrant.eq(index)
+
+		# The granted client is connected straight through, everyone else sees a FRAM that's doing nothing
+		for index, port in enumerate(self.ports):
+			selected = busy & (grant == index)
+			m.d.comb += [
+				port.dataIn.eq(memory.dataIn),
+				port.readValid.eq(selected & memory.readValid),
+				port.writeReady.eq(selected & memory.writeReady),
+				port.complete.eq(selected & memory.complete),
+			]
+			with m.If(grant == index):
+				m.d.comb += [
+					memory.address.eq(Cat(port.address, Const(index, self._selectBits))),
+					memory.dataOut.eq(port.dataOut),
+					memory.readReady.eq(busy & port.readReady),
+					memory.writeValid.eq(busy & port.writeValid),
+					memory.last.eq(port.last),
+				]
+
+		with m.FSM(name = 'arbiter-fsm'):
+			# Wait for a client to want the FRAM, picking the next in line
+			with m.State('IDLE'):
+				with m.If(pending.any()):
+					m.d.sync += grant.eq(nextGrant)
+					m.next = 'START'
+			# Hand the granted client's transaction on to the FRAM
+			with m.State('START'):
+				m.d.comb += [
+					memory.read.eq(pendingRead.bit_select(grant, 1)),
+					memory.write.eq(pendingWrite.bit_select(grant, 1)),
+				]
+				m.d.sync += [
+					pendingRead.bit_select(grant, 1).eq(0),
+					pendingWrite.bit_select(grant, 1).eq(0),
+				]
+				m.next = 'BUSY'
+			# Then leave the client to it until the transaction completes
+			with m.State('BUSY'):
+				m.d.comb += busy.eq(1)
+				with m.If(memory.complete):
+					m.next = 'IDLE'
+		return m
@@ -5,56 +5,261 @@ __all__ = (
 )
 
 class Bus(Elaboratable):
-	def __init__(self, *, resource):
+	# With ddr SCLK runs at the system clock rate, and clk, copi and cipo have to be requested with xdr = 2
+	def __init__(self, *, resource, divider : int = 1, ddr : bool = False):
+		if divider < 1:
+			raise ValueError(f'SCLK divider must be at least 1, not {divider}')
+		if ddr and divider != 1:
+			raise ValueError('SCLK always runs at the system clock rate with DDR I/O, divider must be 1')
 		self._bus = resource
-		self.cs = Signal()
+		self._divider = divider
+		self._ddr = ddr
+		# Byte stream in - copi is taken along with copi_oe and last when valid and ready are both high
 		self.copi = Signal(8)
 		self.copi_oe = Signal(reset = 1)
+		self.valid = Signal()
+		self.ready = Signal()
+		# Marks the byte as the final one of the transaction, CS is released once it's been shifted
+		self.last = Signal()
+		# Byte stream out - cipo holds the byte just shifted in while complete is high
 		self.cipo = Signal(8)
-		self.begin = Signal()
 		self.complete = Signal()
+		# Strobes once CS has been released at the end of a transaction
+		self.done = Signal()
+		# Abandons the current transaction, releasing CS immediately
+		self.stop = Signal()
 
 	def elaborate(self, platform) -> Module:
 		m = Module()
 		bus = self._bus
+		clk = Signal(reset = 1)
 		data = Signal.like(self.copi)
+		dataIn = Signal.like(self.cipo)
+		dataOE = Signal(reset = 1)
 		bitCounter = Signal(range(8))
+		lastByte = Signal()
+
+		# Holding buffer for the next byte so it can be loaded while the current one shifts
+		buffer = Signal.like(self.copi)
+		bufferOE = Signal()
+		bufferLast = Signal()
+		bufferFull = Signal()
+		load = Signal()
+
+		# The SPI side only advances once every divider cycles
+		tick = Signal()
+		if self._divider > 1:
+			prescaler = Signal(range(self._divider))
+			m.d.comb += tick.eq(prescaler == 0)
+			with m.If(tick):
+				m.d.sync += prescaler.eq(self._divider - 1)
+			with m.Else():
+				m.d.sync += prescaler.eq(prescaler - 1)
+		else:
+			m.d.comb += tick.eq(1)
 
 		m.d.comb += [
+			self.ready.eq(~bufferFull),
+			load.eq(0),
+			bus.copi.oe.eq(dataOE),
+		]
+		m.d.sync += [
 			self.complete.eq(0),
-			bus.cs.o.eq(self.cs),
-			bus.copi.oe.eq(self.copi_oe),
+			self.done.eq(0),
 		]
 
+		with m.If(self.valid & self.ready):
+			m.d.sync += [
+				buffer.eq(self.copi),
+				bufferOE.eq(self.copi_oe),
+				bufferLast.eq(self.last),
+				bufferFull.eq(1),
+			]
+		with m.Elif(load):
+			m.d.sync += bufferFull.eq(0)
+
+		with m.If(load):
+			m.d.sync += [
+				data.eq(buffer),
+				dataOE.eq(bufferOE),
+				lastByte.eq(bufferLast),
+			]
+
+		if self._ddr:
+			self.elaborateDDR(m, data = data, dataIn = dataIn, dataOE = dataOE, bitCounter = bitCounter, lastByte = lastByte,
+				bufferFull = bufferFull, load = load)
+		else:
+			m.d.comb += bus.clk.o.eq(clk)
+			# Stopping can't wait for the next tick or SCLK would carry on after CS has been released
+			with m.If(tick | self.stop):
+				self.elaborateSDR(m, clk = clk, data = data, dataIn = dataIn, dataOE = dataOE, bitCounter = bitCounter,
+					lastByte = lastByte, bufferFull = bufferFull, load = load)
+
+		# Abandoning the transaction overrides anything the FSM was about to do
+		with m.If(self.stop):
+			m.d.sync += [
+				bus.cs.o.eq(0),
+				clk.eq(1),
+				dataOE.eq(1),
+				bitCounter.eq(0),
+				bufferFull.eq(0),
+				self.complete.eq(0),
+				self.done.eq(0),
+			]
+		return m
+
+	def elaborateSDR(self, m, *, clk, data, dataIn, dataOE, bitCounter, lastByte, bufferFull, load):
+		bus = self._bus
 		with m.FSM(name = 'spi-fsm'):
 			with m.State('IDLE'):
-				with m.If(self.begin):
-					m.next = 'SHIFT-START'
-			with m.State('SHIFT-START'):
-				m.d.sync += data.eq(self.copi)
-				m.next = 'SHIFT-L'
+				with m.If(bufferFull):
+					m.d.comb += load.eq(1)
+					m.d.sync += bus.cs.o.eq(1)
+					m.next = 'SHIFT-L'
+			# Shift the current byte out MSb first, SCLK idles high (mode 3)
 			with m.State('SHIFT-L'):
 				m.d.sync += [
-					bus.clk.o.eq(0),
+					clk.eq(0),
 					bus.copi.o.eq(data[7]),
 					data.eq(data.shift_left(1)),
 					bitCounter.eq(bitCounter - 1),
 				]
 				m.next = 'SHIFT-H'
+				with m.If(self.stop):
+					m.next = 'DESELECT'
 			with m.State('SHIFT-H'):
 				m.d.sync += [
-					bus.clk.o.eq(1),
-					self.cipo.eq(self.cipo.shift_left(1)),
-					self.cipo[0].eq(bus.cipo.i),
+					clk.eq(1),
+					dataIn.eq(Cat(bus.cipo.i, dataIn[0:7])),
 				]
 				with m.If(bitCounter == 0):
-					m.next = 'FINISH'
+					m.d.sync += [
+						self.cipo.eq(Cat(bus.cipo.i, dataIn[0:7])),
+						self.complete.eq(1),
+					]
+					# End of the transaction, release CS even if the next one is already queued
+					with m.If(lastByte):
+						m.next = 'RELEASE'
+					# Otherwise keep SCLK running straight into the next byte if we have it
+					with m.Elif(bufferFull):
+						m.d.comb += load.eq(1)
+						m.next = 'SHIFT-L'
+					with m.Else():
+						m.next = 'STALL'
 				with m.Else():
 					m.next = 'SHIFT-L'
-			with m.State('FINISH'):
-				m.d.comb += self.complete.eq(1)
-				with m.If(self.begin):
-					m.next = 'SHIFT-START'
+				with m.If(self.stop):
+					m.next = 'DESELECT'
+			# The next byte wasn't ready in time, hold CS and wait for it
+			with m.State('STALL'):
+				with m.If(self.stop):
+					m.next = 'DESELECT'
+				with m.Elif(bufferFull):
+					m.d.comb += load.eq(1)
+					m.next = 'SHIFT-L'
+			# Hold CS for a cycle past the final rising edge of SCLK before letting go
+			with m.State('RELEASE'):
+				m.d.sync += [
+					bus.cs.o.eq(0),
+					dataOE.eq(1),
+					self.done.eq(1),
+				]
+				m.next = 'DESELECT'
+			# Guarantee CS stays deasserted for at least two cycles between transactions
+			with m.State('DESELECT'):
+				m.next = 'IDLE'
+
+	def elaborateDDR(self, m, *, data, dataIn, dataOE, bitCounter, lastByte, bufferFull, load):
+		# Whatever is put on the DDR outputs in a cycle appears on the pins over the following one,
+		# SCLK low for the first half and high for the second, so each cycle in SHIFT clocks one bit.
+		# CIPO is captured on the falling system clock edge mid-way through that and reaches us a cycle later
+		bus = self._bus
+		copi = Signal()
+		shifting = Signal()
+		sampleValid = Signal(2)
+		sampleCounter = Signal(range(8))
+
+		m.d.comb += [
+			bus.clk.o_clk.eq(ClockSignal()),
+			bus.copi.o_clk.eq(ClockSignal()),
+			bus.cipo.i_clk.eq(ClockSignal()),
+			bus.clk.o0.eq(1),
+			bus.clk.o1.eq(1),
+			bus.copi.o0.eq(copi),
+			bus.copi.o1.eq(copi),
+			shifting.eq(0),
+		]
+		m.d.sync += sampleValid.eq(Cat(shifting, sampleValid[0]))
+
+		with m.If(sampleValid[1]):
+			m.d.sync += [
+				dataIn.eq(Cat(bus.cipo.i1, dataIn[0:7])),
+				sampleCounter.eq(sampleCounter - 1),
+			]
+			# Counting down from 0, the eighth sample of the byte is taken with the counter at 1
+			with m.If(sampleCounter == 1):
+				m.d.sync += [
+					self.cipo.eq(Cat(bus.cipo.i1, dataIn[0:7])),
+					self.complete.eq(1),
+				]
+
+		with m.FSM(name = 'spi-fsm'):
+			with m.State('IDLE'):
+				with m.If(bufferFull):
+					m.d.comb += load.eq(1)
+					m.d.sync += bus.cs.o.eq(1)
+					m.next = 'SHIFT'
+			# Shift the current byte out MSb first, SCLK idles high (mode 3)
+			with m.State('SHIFT'):
+				m.d.comb += [
+					shifting.eq(1),
+					bus.clk.o0.eq(0),
+					bus.copi.o0.eq(data[7]),
+					bus.copi.o1.eq(data[7]),
+				]
+				m.d.sync += [
+					copi.eq(data[7]),
+					bitCounter.eq(bitCounter - 1),
+				]
+				with m.If(bitCounter == 1):
+					# End of the transaction, release CS even if the next one is already queued
+					with m.If(lastByte):
+						m.next = 'RELEASE'
+					# Otherwise keep SCLK running straight into the next byte if we have it
+					with m.Elif(bufferFull):
+						m.d.comb += load.eq(1)
+					with m.Else():
+						m.next = 'STALL'
 				with m.Else():
-					m.next = 'IDLE'
-		return m
+					m.d.sync += data.eq(data.shift_left(1))
+				with m.If(self.stop):
+					m.next = 'DESELECT'
+			# The next byte wasn't ready in time, hold CS and wait for it
+			with m.State('STALL'):
+				with m.If(self.stop):
+					m.next = 'DESELECT'
+				with m.Elif(bufferFull):
+					m.d.comb += load.eq(1)
+					m.next = 'SHIFT'
+			# Hold CS until the final bit has been sampled, which is also past the final rising edge of SCLK
+			with m.State('RELEASE'):
+				with m.If(sampleValid == 0):
+					m.d.sync += [
+						bus.cs.o.eq(0),
+						dataOE.eq(1),
+						self.done.eq(1),
+					]
+					m.next = 'DESELECT'
+			# Guarantee CS stays deasserted for at least two cycles between transactions
+			with m.State('DESELECT'):
+				m.next = 'IDLE'
+
+		with m.If(self.stop):
+			m.d.comb += [
+				shifting.eq(0),
+				bus.clk.o0.eq(1),
+			]
+			m.d.sync += [
+				sampleValid.eq(0),
+				sampleCounter.eq(0),
+			]
@@ -1,6 +1,8 @@
 from nmigen import *
+from nmigen.lib.fifo import SyncFIFO
 from enum import IntEnum, unique
 from .bus import Bus
+from .hardBus import HardBus
 
 __all__ = (
 	'FRAM',
@@ -16,81 +18,151 @@ class Opcodes(IntEnum):
 	write = 0b0000_0010
 
 class FRAM(Elaboratable):
-	def __init__(self, resourceName : tuple):
+	def __init__(self, resourceName : tuple, *, hardBus : bool = False, divider : int = 1, ddr : bool = False):
 		self.address = Signal(11)
 		self.dataIn = Signal(8)
 		self.dataOut = Signal(8)
 		self.read = Signal()
 		self.write = Signal()
 		self.complete = Signal()
+		# Read stream - one byte is handed out per readValid & readReady,
+		# raise last alongside readReady to end the burst after that byte
+		self.readValid = Signal()
+		self.readReady = Signal()
+		# Write stream - dataOut is taken when writeReady and writeValid are both high,
+		# raise last alongside writeValid to end the burst after that byte
+		self.writeValid = Signal()
+		self.writeReady = Signal()
+		self.last = Signal()
 
 		self._resourceName = resourceName
+		# Run the bus on the SB_SPI block rather than in fabric when asked to, which saves LUTs but can't do DDR
+		assert not (hardBus and ddr), 'The SB_SPI block cannot run SCLK at DDR'
+		self._hardBus = hardBus
+		# SCLK spends divider system clock cycles in each half of its period, ddr runs it at the full clock rate
+		self._divider = divider
+		self._ddr = ddr
 
 	def elaborate(self, platform) -> Module:
 		m = Module()
 		self.fixCOPI(platform.lookup(*self._resourceName))
-		m.submodules.bus = bus = Bus(resource = platform.request(*self._resourceName))
+		if self._hardBus:
+			m.submodules.bus = bus = HardBus(resource = platform.request(*self._resourceName),
+				divider = self._divider)
+		elif self._ddr:
+			resource = platform.request(*self._resourceName, xdr = {'clk': 2, 'copi': 2, 'cipo': 2})
+			m.submodules.bus = bus = Bus(resource = resource, divider = self._divider, ddr = True)
+		else:
+			m.submodules.bus = bus = Bus(resource = platform.request(*self._resourceName),
+				divider = self._divider)
+		self._bus = bus
+
+		# Read data lands in a small FIFO so the consumer can stall without the bus having to
+		readFlush = Signal()
+		m.submodules.readFIFO = readFIFO = ResetInserter(readFlush)(SyncFIFO(width = 8, depth = 2))
+		# Count of the command/address bytes still to complete, and of the read bytes on the bus
+		headerBytes = Signal(range(4))
+		readPending = Signal(range(3))
 
 		command = Signal(Opcodes)
 		m.d.comb += [
 			self.complete.eq(0),
+			self.writeReady.eq(0),
+			bus.valid.eq(0),
+			bus.last.eq(0),
+			bus.stop.eq(0),
+			readFlush.eq(0),
+
+			self.readValid.eq(readFIFO.r_rdy),
+			self.dataIn.eq(readFIFO.r_data),
+			readFIFO.r_en.eq(self.readReady),
+			readFIFO.w_data.eq(bus.cipo),
+			readFIFO.w_en.eq(0),
 		]
 
+		# Route the bytes shifted in for a read into the FIFO once the header is out of the way
+		with m.If(bus.complete & (command == Opcodes.read)):
+			with m.If(headerBytes != 0):
+				m.d.sync += headerBytes.eq(headerBytes - 1)
+			with m.Else():
+				m.d.comb += readFIFO.w_en.eq(1)
+
 		with m.FSM(name = 'fram-fsm'):
 			with m.State('IDLE'):
 				with m.If(self.read):
 					m.d.sync += [
 						command.eq(Opcodes.read),
-						bus.cs.eq(1),
+						headerBytes.eq(3),
 					]
 					m.next = 'ISSUE-CMD'
 				with m.Elif(self.write):
 					m.next = 'WRITE-ENABLE'
+			# WREN is its own transaction, the bus releases CS before the write command goes out
 			with m.State('WRITE-ENABLE'):
-				m.d.sync += bus.copi.eq(Opcodes.writeEnable)
-				m.d.comb += bus.begin.eq(1)
-				m.next = 'WAIT-WRITE'
-			with m.State('WAIT-WRITE'):
-				m.d.sync += bus.cs.eq(1)
-				with m.If(bus.complete):
-					m.d.sync += bus.cs.eq(0)
-					m.next = 'WRITE'
-			with m.State('WRITE'):
-				m.d.sync += command.eq(Opcodes.write)
-				m.next = 'ISSUE-CMD'
+				m.d.comb += [
+					bus.copi.eq(Opcodes.writeEnable),
+					bus.valid.eq(1),
+					bus.last.eq(1),
+				]
+				with m.If(bus.ready):
+					m.d.sync += command.eq(Opcodes.write)
+					m.next = 'ISSUE-CMD'
 			with m.State('ISSUE-CMD'):
-				m.d.sync += [
+				m.d.comb += [
 					bus.copi.eq(command),
-					bus.copi_oe.eq(1),
+					bus.valid.eq(1),
 				]
-				m.d.comb += bus.begin.eq(1)
-				m.next = 'ISSUE-ADDR-H'
+				with m.If(bus.ready):
+					m.next = 'ISSUE-ADDR-H'
 			with m.State('ISSUE-ADDR-H'):
-				m.d.sync += bus.cs.eq(1)
-				with m.If(bus.complete):
-					m.d.sync += bus.copi.eq(Cat(self.address[8:11], Const(0, 5)))
-					m.d.comb += bus.begin.eq(1)
+				m.d.comb += [
+					bus.copi.eq(Cat(self.address[8:11], Const(0, 5))),
+					bus.valid.eq(1),
+				]
+				with m.If(bus.ready):
 					m.next = 'ISSUE-ADDR-L'
 			with m.State('ISSUE-ADDR-L'):
-				with m.If(bus.complete):
-					m.d.sync += bus.copi.eq(self.address[0:8])
-					m.d.comb += bus.begin.eq(1)
-					m.next = 'ISSUE-DATA'
-			with m.State('ISSUE-DATA'):
-				with m.If(bus.complete):
+				m.d.comb += [
+					bus.copi.eq(self.address[0:8]),
+					bus.valid.eq(1),
+				]
+				with m.If(bus.ready):
 					with m.If(command == Opcodes.read):
-						m.d.sync += bus.copi_oe.eq(0)
+						m.d.sync += readPending.eq(0)
+						m.next = 'READ-DATA'
 					with m.Else():
-						m.d.sync += bus.copi.eq(self.dataOut)
-					m.d.comb += bus.begin.eq(1)
-					m.next = 'ISSUE-DATA-WAIT'
-			with m.State('ISSUE-DATA-WAIT'):
-				with m.If(bus.complete):
-					m.d.sync += [
-						bus.cs.eq(0),
-						bus.copi_oe.eq(1),
-						self.dataIn.eq(bus.cipo),
+						m.next = 'WRITE-DATA'
+			# Keep the bus fed with dummy bytes (the FRAM auto-increments) for as long as there's room for the results
+			with m.State('READ-DATA'):
+				m.d.comb += [
+					bus.copi.eq(0),
+					bus.copi_oe.eq(0),
+					bus.valid.eq((readFIFO.level + readPending) < readFIFO.depth),
+				]
+				with m.If((bus.valid & bus.ready) & ~readFIFO.w_en):
+					m.d.sync += readPending.eq(readPending + 1)
+				with m.Elif(~(bus.valid & bus.ready) & readFIFO.w_en):
+					m.d.sync += readPending.eq(readPending - 1)
+				# Once the last byte has been taken, abandon whatever has been read ahead
+				with m.If(self.readValid & self.readReady & self.last):
+					m.d.comb += [
+						bus.stop.eq(1),
+						readFlush.eq(1),
+						self.complete.eq(1),
 					]
+					m.next = 'IDLE'
+			with m.State('WRITE-DATA'):
+				m.d.comb += [
+					bus.copi.eq(self.dataOut),
+					bus.valid.eq(self.writeValid),
+					bus.last.eq(self.last),
+					self.writeReady.eq(bus.ready),
+				]
+				with m.If(self.writeValid & bus.ready & self.last):
+					m.next = 'WRITE-WAIT'
+			# Wait for the bus to finish shifting out the burst and release CS
+			with m.State('WRITE-WAIT'):
+				with m.If(bus.done):
 					m.d.comb += self.complete.eq(1)
 					m.next = 'IDLE'
 		return m
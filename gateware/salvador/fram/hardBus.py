@@ -0,0 +1,232 @@
+from nmigen import *
+from enum import IntEnum, unique
+
+__all__ = (
+	'HardBus',
+)
+
+@unique
+class Registers(IntEnum):
+	control0 = 0b1000
+	control1 = 0b1001
+	control2 = 0b1010
+	baudRate = 0b1011
+	status = 0b1100
+	transmit = 0b1101
+	receive = 0b1110
+	chipSelect = 0b1111
+
+class HardBus(Elaboratable):
+	# Bus on the UP5K's SB_SPI block, which drives the data direction itself so copi_oe is ignored.
+	# The block runs from the system clock and every byte costs several system bus accesses, so this is
+	# no faster than the fabric Bus (and slower than it with DDR) - it only saves the LUTs the shifter takes
+	def __init__(self, *, resource, block : int = 0, divider : int = 1):
+		self._bus = resource
+		# The two blocks sit at 0b0000 and 0b0010 in the upper nibble of the system bus address
+		self._block = block << 1
+		self._divider = divider
+		# Byte stream in - copi is taken along with last when valid and ready are both high
+		self.copi = Signal(8)
+		self.copi_oe = Signal(reset = 1)
+		self.valid = Signal()
+		self.ready = Signal()
+		# Marks the byte as the final one of the transaction, CS is released once it's been shifted
+		self.last = Signal()
+		# Byte stream out - cipo holds the byte just shifted in while complete is high
+		self.cipo = Signal(8)
+		self.complete = Signal()
+		# Strobes once CS has been released at the end of a transaction
+		self.done = Signal()
+		# Abandons the current transaction, releasing CS once the bytes already in the block are out
+		self.stop = Signal()
+
+		# The hard block's system bus and chip selects, which the sims drive in its place as it has no model
+		self._accessWrite = Signal()
+		self._register = Signal(4)
+		self._dataWrite = Signal(8)
+		self._dataRead = Signal(8)
+		self._strobe = Signal()
+		self._ack = Signal()
+		self._chipSelects = Signal(4, reset = 0b1111)
+
+	def elaborate(self, platform) -> Module:
+		m = Module()
+		bus = self._bus
+
+		# System bus interface to the hard block
+		access = Signal()
+		accessWrite = self._accessWrite
+		register = self._register
+		dataWrite = self._dataWrite
+		dataRead = self._dataRead
+		strobe = self._strobe
+		ack = self._ack
+		acked = Signal()
+		chipSelects = self._chipSelects
+
+		m.submodules.spi = Instance(
+			'SB_SPI',
+			p_BUS_ADDR74 = f'0b{self._block:04b}',
+			# SCLK is divided down from this, so it can't go any faster than the fabric bus's
+			i_SBCLKI = ClockSignal(),
+			i_SBRWI = accessWrite,
+			i_SBSTBI = strobe,
+			**{f'i_SBADRI{i}': bit for i, bit in enumerate(Cat(register, Const(self._block, 4)))},
+			**{f'i_SBDATI{i}': dataWrite[i] for i in range(8)},
+			**{f'o_SBDATO{i}': dataRead[i] for i in range(8)},
+			o_SBACKO = ack,
+			i_MI = bus.cipo.i,
+			o_MO = bus.copi.o,
+			o_MOE = bus.copi.oe,
+			o_SCKO = bus.clk.o,
+			i_SI = 0,
+			i_SCKI = 1,
+			i_SCSNI = 1,
+			**{f'o_MCSNO{i}': chipSelects[i] for i in range(4)},
+		)
+
+		# Accesses are held until acknowledged, and we always leave a cycle between them
+		m.d.comb += [
+			strobe.eq(access & ~acked),
+			bus.cs.o.eq(~chipSelects[0]),
+		]
+		m.d.sync += acked.eq(ack)
+
+		# Holding buffer for the next byte so the stream can be accepted while we talk to the block
+		buffer = Signal.like(self.copi)
+		bufferLast = Signal()
+		bufferFull = Signal()
+		load = Signal()
+		# Bytes written to the block that have yet to be read back
+		inFlight = Signal(range(3))
+		transmitData = Signal(8)
+		lastSent = Signal()
+		aborted = Signal()
+		status = Signal(8)
+		init = Signal(range(4))
+
+		m.d.comb += [
+			self.ready.eq(~bufferFull),
+			load.eq(0),
+		]
+		m.d.sync += [
+			self.complete.eq(0),
+			self.done.eq(0),
+		]
+
+		with m.If(self.valid & self.ready):
+			m.d.sync += [
+				buffer.eq(self.copi),
+				bufferLast.eq(self.last),
+				bufferFull.eq(1),
+			]
+		with m.Elif(load):
+			m.d.sync += bufferFull.eq(0)
+
+		# Stopping drops anything not yet handed to the block and discards whatever it still returns
+		with m.If(self.stop):
+			m.d.sync += [
+				aborted.eq(1),
+				bufferFull.eq(0),
+			]
+
+		initSequence = Array(Const(value, 8) for value in (
+			0b1000_0000, # SPI enabled
+			0b1100_0110, # Controller, manual CS hold, mode 3
+			(self._divider * 2) - 1, # SCLK = clock / (n + 1)
+			0b0000_1111, # All chip selects deasserted
+		))
+		initRegisters = Array(Const(value, 4) for value in
+			(Registers.control1, Registers.control2, Registers.baudRate, Registers.chipSelect))
+
+		with m.FSM(name = 'sbspi-fsm'):
+			# Bring the block up as a mode 3 controller with all chip selects deasserted
+			with m.State('INIT'):
+				m.d.comb += [
+					access.eq(1),
+					accessWrite.eq(1),
+					register.eq(initRegisters[init]),
+					dataWrite.eq(initSequence[init]),
+				]
+				with m.If(ack):
+					m.d.sync += init.eq(init + 1)
+					with m.If(init == 3):
+						m.next = 'DESELECT'
+			with m.State('IDLE'):
+				with m.If(bufferFull):
+					m.d.sync += [
+						inFlight.eq(0),
+						lastSent.eq(0),
+						aborted.eq(0),
+					]
+					m.next = 'SELECT'
+			with m.State('SELECT'):
+				m.d.comb += [
+					access.eq(1),
+					accessWrite.eq(1),
+					register.eq(Registers.chipSelect),
+					dataWrite.eq(0b1110),
+				]
+				with m.If(ack):
+					m.next = 'POLL'
+			# Find out whether the block has room for another byte or has one for us
+			with m.State('POLL'):
+				m.d.comb += [
+					access.eq(1),
+					register.eq(Registers.status),
+				]
+				with m.If(ack):
+					m.d.sync += status.eq(dataRead)
+					m.next = 'DISPATCH'
+			with m.State('DISPATCH'):
+				# Status bit 3 is RRDY, receive data waiting
+				with m.If(status[3] & (inFlight != 0)):
+					m.next = 'RECEIVE'
+				# Status bit 4 is TRDY, room in the transmit register
+				with m.Elif(status[4] & (inFlight != 2) & bufferFull & ~lastSent & ~aborted):
+					m.d.comb += load.eq(1)
+					m.d.sync += [
+						transmitData.eq(buffer),
+						lastSent.eq(bufferLast),
+					]
+					m.next = 'TRANSMIT'
+				with m.Elif((lastSent | aborted) & (inFlight == 0)):
+					m.next = 'RELEASE'
+				with m.Else():
+					m.next = 'POLL'
+			with m.State('TRANSMIT'):
+				m.d.comb += [
+					access.eq(1),
+					accessWrite.eq(1),
+					register.eq(Registers.transmit),
+					dataWrite.eq(transmitData),
+				]
+				with m.If(ack):
+					m.d.sync += inFlight.eq(inFlight + 1)
+					m.next = 'POLL'
+			with m.State('RECEIVE'):
+				m.d.comb += [
+					access.eq(1),
+					register.eq(Registers.receive),
+				]
+				with m.If(ack):
+					m.d.sync += [
+						self.cipo.eq(dataRead),
+						self.complete.eq(~aborted & ~self.stop),
+						inFlight.eq(inFlight - 1),
+					]
+					m.next = 'POLL'
+			with m.State('RELEASE'):
+				m.d.comb += [
+					access.eq(1),
+					accessWrite.eq(1),
+					register.eq(Registers.chipSelect),
+					dataWrite.eq(0b1111),
+				]
+				with m.If(ack):
+					m.d.sync += self.done.eq(~aborted)
+					m.next = 'DESELECT'
+			# Guarantee CS stays deasserted for at least two cycles between transactions
+			with m.State('DESELECT'):
+				m.next = 'IDLE'
+		return m
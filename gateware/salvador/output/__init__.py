@@ -0,0 +1,8 @@
+from .pwm import PWMOutput, Modulation
+from .pll import ICE40PLL
+
+__all__ = (
+	'PWMOutput',
+	'Modulation',
+	'ICE40PLL',
+)
@@ -0,0 +1,58 @@
+from nmigen import *
+from nmigen.lib.cdc import ResetSynchronizer
+
+__all__ = (
+	'ICE40PLL',
+	'pllParameters',
+)
+
+def pllParameters(inputFrequency : float, outputFrequency : float) -> tuple:
+	# Finds the (DIVR, DIVF, DIVQ, FILTER_RANGE, frequency) closest to outputFrequency
+	best = None
+	for divr in range(16):
+		# The phase detector has to run at between 10 and 133MHz
+		pfd = inputFrequency / (divr + 1)
+		if not 10e6 <= pfd <= 133e6:
+			continue
+		for divf in range(128):
+			# And the VCO at between 533 and 1066MHz
+			vco = pfd * (divf + 1)
+			if not 533e6 <= vco <= 1066e6:
+				continue
+			for divq in range(1, 7):
+				frequency = vco / (2 ** divq)
+				if best is None or abs(frequency - outputFrequency) < abs(best[-1] - outputFrequency):
+					# The loop filter is picked by which band the phase detector frequency falls in
+					filterRange = 1 + sum(pfd >= limit for limit in (17e6, 26e6, 44e6, 66e6, 101e6))
+					best = (divr, divf, divq, filterRange, frequency)
+	if best is None:
+		raise ValueError(f'The PLL cannot be run from a {inputFrequency}Hz clock')
+	return best
+
+class ICE40PLL(Elaboratable):
+	# The domain is held in reset until the PLL locks, frequency ending up as what it gets
+	def __init__(self, *, frequency : float, domain : str = 'pwm'):
+		self.frequency = frequency
+		self.locked = Signal()
+
+		self._domain = domain
+
+	def elaborate(self, platform) -> Module:
+		m = Module()
+		divr, divf, divq, filterRange, self.frequency = pllParameters(platform.default_clk_frequency,
+			self.frequency)
+		m.domains += ClockDomain(self._domain)
+		m.submodules.pll = Instance('SB_PLL40_CORE',
+			p_FEEDBACK_PATH = 'SIMPLE',
+			p_DIVR = divr,
+			p_DIVF = divf,
+			p_DIVQ = divq,
+			p_FILTER_RANGE = filterRange,
+			i_REFERENCECLK = ClockSignal('sync'),
+			i_RESETB = 1,
+			i_BYPASS = 0,
+			o_PLLOUTGLOBAL = ClockSignal(self._domain),
+			o_LOCK = self.locked,
+		)
+		m.submodules.reset = ResetSynchronizer(~self.locked, domain = self._domain)
+		return m
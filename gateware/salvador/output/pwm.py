@@ -0,0 +1,77 @@
+from enum import IntEnum, unique
+from nmigen import *
+from nmigen.lib.fifo import AsyncFIFO
+
+__all__ = (
+	'PWMOutput',
+	'Modulation',
+)
+
+@unique
+class Modulation(IntEnum):
+	pwm = 0
+	dithered = 1
+	sigmaDelta = 2
+
+class PWMOutput(Elaboratable):
+	# duty is picked up at the start of each period. Dithering puts the top pwmBits in the pulse width and makes
+	# the rest up over the periods, sigma-delta switching every clock instead
+	def __init__(self, *, domain : str = 'pwm', bits : int = 16, modulation : Modulation = Modulation.dithered,
+		pwmBits : int = 12):
+		# In the sync domain
+		self.duty = Signal(bits)
+		# In the output's domain
+		self.output = Signal()
+
+		self._domain = domain
+		self._modulation = modulation
+		self._pwmBits = pwmBits if modulation == Modulation.dithered else bits
+		assert self._pwmBits <= bits
+
+	def elaborate(self, platform) -> Module:
+		m = Module()
+		bits = len(self.duty)
+		m.submodules.fifo = fifo = AsyncFIFO(width = bits, depth = 4, r_domain = self._domain, w_domain = 'sync')
+
+		# Hand each new duty over, trying again until there's room for it in the FIFO
+		handedOver = Signal.like(self.duty)
+		m.d.comb += [
+			fifo.w_data.eq(self.duty),
+			fifo.w_en.eq(self.duty != handedOver),
+		]
+		with m.If(fifo.w_en & fifo.w_rdy):
+			m.d.sync += handedOver.eq(self.duty)
+
+		duty = Signal.like(self.duty)
+		m.d.comb += fifo.r_en.eq(1)
+		with m.If(fifo.r_rdy):
+			m.d[self._domain] += duty.eq(fifo.r_data)
+
+		if self._modulation == Modulation.sigmaDelta:
+			# The output is the carry out of adding duty into an accumulator every clock, with the top half of
+			# the range adding one more so full scale carries every time
+			accumulator = Signal(bits)
+			m.d[self._domain] += Cat(accumulator, self.output).eq(accumulator + duty + duty[-1])
+			return m
+
+		pwmBits = self._pwmBits
+		ditherBits = bits - pwmBits
+		counter = Signal(pwmBits)
+		# Pulse width for the period under way, which can go one past the counter to be fully on
+		width = Signal(pwmBits + 1)
+		dither = Signal(ditherBits)
+		ditherSum = Signal(ditherBits + 1)
+
+		if ditherBits:
+			# Full scale has to carry every period to be fully on, so the top half of the range adds one more
+			m.d.comb += ditherSum.eq(dither + duty[:ditherBits] + duty[-1])
+		with m.If(counter == (2 ** pwmBits) - 2):
+			m.d[self._domain] += [
+				counter.eq(0),
+				dither.eq(ditherSum[:ditherBits]),
+				width.eq(duty[ditherBits:] + ditherSum[ditherBits]),
+			]
+		with m.Else():
+			m.d[self._domain] += counter.eq(counter + 1)
+		m.d[self._domain] += self.output.eq(counter < width)
+		return m
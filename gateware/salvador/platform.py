@@ -23,6 +23,13 @@ class SalvadorPlatform(LatticeICE40Platform):
 		SPIResource('fram', 0, cs_n = '36', clk = '37', copi = '38', cipo = '42',
 			role = 'controller',
 			attrs = Attrs(IO_STANDARD = 'SB_LVCMOS')),
+
+		# The v0.1 board has no output stage, so these go to pads that are otherwise unconnected and are only
+		# there to probe the gear outputs with a scope or to wire up a stage by hand
+		PWMResource(0, pin = '11', attrs = Attrs(IO_STANDARD = 'SB_LVCMOS')),
+		PWMResource(1, pin = '12', attrs = Attrs(IO_STANDARD = 'SB_LVCMOS')),
+		PWMResource(2, pin = '13', attrs = Attrs(IO_STANDARD = 'SB_LVCMOS')),
+		PWMResource(3, pin = '18', attrs = Attrs(IO_STANDARD = 'SB_LVCMOS')),
 	]
 
 	connectors = []
@@ -1,6 +1,6 @@
 from nmigen.build import *
 
-__all__ = ('DALIResource',)
+__all__ = ('DALIResource', 'PWMResource')
 
 def DALIResource(*args, rx, tx, conn = None, attrs = None):
 	ios = [
@@ -10,3 +10,9 @@ def DALIResource(*args, rx, tx, conn = None, attrs = None):
 	if attrs is not None:
 		ios.append(attrs)
 	return Resource.family(*args, default_name = 'dali', ios = ios)
+
+def PWMResource(*args, pin, conn = None, attrs = None):
+	ios = [Pins(pin, dir = 'o', conn = conn, assert_width = 1)]
+	if attrs is not None:
+		ios.append(attrs)
+	return Resource.family(*args, default_name = 'pwm', ios = ios)
@@ -1,9 +1,53 @@
 from nmigen import *
+from nmigen.build import ResourceError
 from .dali import *
+from .fram import FRAMArbiter
+from .output import PWMOutput, ICE40PLL
 
 class Salvador(Elaboratable):
+	def __init__(self, *, buses : int = 1, gearCount : int = 1, outputs : bool = False, hardBus : bool = False,
+		divider : int = 1, ddr : bool = False):
+		# How many DALI buses there are, each on the matching DALI resource and with its own window of the FRAM
+		self._buses = buses
+		# How many logical control gear each DALI bus serves
+		self._gearCount = gearCount
+		# Whether to drive each gear's output on the matching PWM resource, numbered on from the last bus's
+		self._outputs = outputs
+		# Whether to drive the FRAM through the SB_SPI block rather than from fabric
+		self._hardBus = hardBus
+		# and how fast its SCLK runs - divider system clock cycles to each half period, or the full clock rate with ddr
+		self._divider = divider
+		self._ddr = ddr
+
 	def elaborate(self, platform):
 		m = Module()
-		m.submodules.dali = DALI(interface = platform.request('dali'), deviceType = DeviceType.led,
-			persistResource = ('fram', 0))
+		# Each bus needs a DALI resource of its own, which the platform has to have defined
+		for bus in range(self._buses):
+			try:
+				platform.lookup('dali', bus)
+			except ResourceError:
+				raise ValueError(f'{self._buses} DALI buses were asked for but the platform only has {bus}') from None
+		# As does each gear's output when they're driven
+		for index in range(self._buses * self._gearCount if self._outputs else 0):
+			try:
+				platform.lookup('pwm', index)
+			except ResourceError:
+				raise ValueError(f'{self._buses * self._gearCount} PWM outputs were asked for but the platform '
+					f'only has {index}') from None
+		m.submodules.fram = fram = FRAMArbiter(('fram', 0), clients = self._buses, hardBus = self._hardBus,
+			divider = self._divider, ddr = self._ddr)
+		if self._outputs:
+			m.submodules.pll = ICE40PLL(frequency = 64e6)
+		for bus, port in enumerate(fram.ports):
+			m.submodules[f'dali{bus}'] = dali = DALI(interface = platform.request('dali', bus),
+				deviceType = DeviceType.led, persistMemory = port, gearCount = self._gearCount)
+			if not self._outputs:
+				continue
+			for gear, output in enumerate(dali.outputs):
+				index = bus * self._gearCount + gear
+				m.submodules[f'pwm{index}'] = pwm = PWMOutput()
+				m.d.comb += [
+					pwm.duty.eq(output),
+					platform.request('pwm', index).o.eq(pwm.output),
+				]
 		return m
@@ -0,0 +1,56 @@
+from arachne.core.sim import sim_case
+from nmigen.sim import *
+
+from ...dali.curves import OutputCurve, curveTable
+from ...dali.types import DimmingCurve
+
+__all__ = (
+	'outputCurves',
+)
+
+class Platform:
+	@property
+	def default_clk_frequency(self):
+		return float(1e6)
+
+@sim_case(domains = (('sync', 1e6),), dut = OutputCurve(gearCount = 3), platform = Platform())
+def outputCurves(sim : Simulator, dut : OutputCurve):
+	logarithmic = curveTable(DimmingCurve.logarithmic)
+	linear = curveTable(DimmingCurve.linear)
+
+	def outputs():
+		result = []
+		for output in dut.outputs:
+			result.append((yield output))
+		return result
+
+	def settle():
+		# Long enough to get round all the gear and have the table answer
+		for _ in range(6):
+			yield
+		yield Settle()
+
+	def domainSync():
+		yield Settle()
+		# Everything starts out off
+		yield from settle()
+		assert (yield from outputs()) == [0, 0, 0]
+		# The standard curve runs from 0.1% of full output at level 1 to all of it at 254
+		assert logarithmic[1] == round(65535 / 1000)
+		assert logarithmic[254] == 65535
+		assert linear[127] == round(65535 / 2)
+		yield dut.levels[0].eq(1)
+		yield dut.levels[1].eq(170)
+		yield dut.levels[2].eq(254)
+		yield from settle()
+		assert (yield from outputs()) == [logarithmic[1], logarithmic[170], logarithmic[254]]
+		# Switching curve changes the output without the level changing
+		yield dut.curves[1].eq(DimmingCurve.linear)
+		yield from settle()
+		assert (yield dut.outputs[1]) == linear[170]
+		# As does the level changing on the new curve
+		yield dut.levels[1].eq(127)
+		yield from settle()
+		assert (yield dut.outputs[1]) == linear[127]
+		assert (yield dut.outputs[0]) == logarithmic[1]
+	yield domainSync, 'sync'
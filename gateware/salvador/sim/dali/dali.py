@@ -1,17 +1,33 @@
 from arachne.core.sim import sim_case
-from nmigen import Record
+from nmigen import Record, Module, Signal, ResetSignal
 from nmigen.build import Resource, Subsignal, Pins
 from nmigen.hdl.rec import DIR_FANIN, DIR_FANOUT
 from nmigen.sim import *
 
 from ...dali.dali import *
+from ...dali.persist import crc16
 from ...fram.fram import Opcodes as FRAMOpcodes
+from ..fram.fram import framDevice
 
 __all__ = (
 	'deviceAndVersion',
 	'addressing',
 	'setAndQueryLevels',
-	'startupRead'
+	'startupRead',
+	'coalescedWriteback',
+	'postedWrites',
+	'unchangedWrites',
+	'corruptImage',
+	'journalReplay',
+	'queuedFrames',
+	'ignoredFrames',
+	'brokenFrames',
+	'loopedBackReplies',
+	'registerCommands',
+	'multipleGear',
+	'drainedBroadcast',
+	'levelControl',
+	'levelLimits',
 )
 
 fram_spi = Record(
@@ -62,36 +78,69 @@ interface = Record(
 	name = 'dali_0',
 )
 
+class PowerCycledDALI(DALI):
+	# DALI with a reset to pull so the sims can cut the power to it and watch it come back up from FRAM
+	def __init__(self, **kwargs):
+		super().__init__(**kwargs)
+		self.reset = Signal()
+
+	def elaborate(self, platform) -> Module:
+		m = super().elaborate(platform)
+		m.d.comb += ResetSignal().eq(self.reset)
+		return m
+
+def persistRegisters(dut : DALI, **registers) -> bytes:
+	# Build the persisted register map holding the register bytes given, with everything else at its defaults
+	payload = bytearray(dut._persistLayout.defaults)
+	for name, value in registers.items():
+		value = bytes(value)
+		addr = dut._framMap[name]
+		payload[addr:addr + len(value)] = value
+	return bytes(payload)
+
+def persistImage(dut : DALI, **registers) -> bytes:
+	# Build an intact FRAM image holding the register bytes given, with everything else at its defaults
+	return dut._persistLayout.image(persistRegisters(dut, **registers))
+
 def waitBitTime(clkFreq, bitRate):
 	for _ in range(int(clkFreq) // bitRate):
 		yield
 	yield Settle()
 
-def sendCommand(command, *, interface, clkFreq, bitRate):
+def sendCommand(command, *, interface, clkFreq, bitRate, bits = 16, stopBits = True):
 	# Generate state bit
 	yield interface.rx.i.eq(0)
 	yield from waitBitTime(clkFreq, bitRate)
 	yield interface.rx.i.eq(1)
 	yield from waitBitTime(clkFreq, bitRate)
 	# Send command bits
-	for i in range(16):
-		bit = (command >> (15 - i)) & 1
+	for i in range(bits):
+		bit = (command >> (bits - 1 - i)) & 1
 		yield interface.rx.i.eq(bit)
 		yield from waitBitTime(clkFreq, bitRate)
 		yield interface.rx.i.eq(bit ^ 1)
 		yield from waitBitTime(clkFreq, bitRate)
-	# Stop bits
+	# Stop bits, which can be left to the caller to time
 	yield interface.rx.i.eq(1)
+	if not stopBits:
+		return
 	yield from waitBitTime(clkFreq, bitRate)
 	yield from waitBitTime(clkFreq, bitRate)
 	yield from waitBitTime(clkFreq, bitRate)
 	yield from waitBitTime(clkFreq, bitRate)
 
 def recvResponse(*, interface, clkFreq, bitRate) -> int:
-	# Wait for processing
-	yield
-	yield
-	yield
+	# The response has to start in the settling window after the forward frame, the stop bits of which have
+	# already gone by
+	delay = 4 * (int(clkFreq) // bitRate)
+	while (yield interface.tx.o) == 1:
+		assert delay <= clkFreq * 10.5e-3
+		delay += 1
+		yield
+	assert delay >= clkFreq * 5.5e-3
+	# Check each half-bit in its middle
+	for _ in range(int(clkFreq) // (bitRate * 2)):
+		yield
 	# Check the dut generates the correct start bit
 	assert (yield interface.tx.o) == 0
 	yield from waitBitTime(clkFreq, bitRate)
@@ -113,15 +162,16 @@ def recvResponse(*, interface, clkFreq, bitRate) -> int:
 	yield from waitBitTime(clkFreq, bitRate)
 	return response
 
+def query(frame, *, clkFreq, bitRate, interface = interface) -> int:
+	# Send a command and return the response to it
+	yield from sendCommand(frame, interface = interface, clkFreq = clkFreq, bitRate = bitRate)
+	return (yield from recvResponse(interface = interface, clkFreq = clkFreq, bitRate = bitRate))
+
 def validateIdle(*, interface, clkFreq, bitRate):
-	# Wait for processing
-	yield
-	yield
-	# Check that the dut *does not* generate a start bit
-	assert (yield interface.tx.o) == 1
-	yield from waitBitTime(clkFreq, bitRate)
-	assert (yield interface.tx.o) == 1
-	yield from waitBitTime(clkFreq, bitRate)
+	# Check that the dut *does not* generate a start bit at any point in the settling window
+	for _ in range(int(clkFreq * 10.5e-3)):
+		assert (yield interface.tx.o) == 1
+		yield
 
 @sim_case(domains = (('sync', 16e6),),
 	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0)),
@@ -249,23 +299,18 @@ def startupRead(sim : Simulator, dut : DALI):
 			yield Settle()
 			assert (yield fram_spi.clk.o) == 1
 
-	def writeAddress(*, addr):
-		yield
+	def burstRead(*, start, data, setup):
+		for _ in range(setup):
+			yield
 		yield Settle()
 		assert (yield fram_spi.cs.o) == 1
-		yield
-		yield
 		assert (yield from readSPI()) == FRAMOpcodes.read
+		assert (yield from readSPI()) == start >> 8
+		assert (yield from readSPI()) == start & 0xFF
+		for value in data:
+			yield from writeSPI(data = value)
 		yield
 		yield
-		assert (yield from readSPI()) == (addr >> 8)
-		yield
-		yield
-		assert (yield from readSPI()) == (addr & 0xFF)
-		yield
-		yield
-		yield from writeSPI(data = addr + 5)
-		yield
 		yield Settle()
 		assert (yield fram_spi.cs.o) == 0
 		yield
@@ -273,8 +318,13 @@ def startupRead(sim : Simulator, dut : DALI):
 	def domainSync():
 		yield interface.rx.i.eq(1)
 		yield Settle()
-		for i in range(25):
-			yield from writeAddress(addr = i)
+		# The journal gets scanned first, here it's empty
+		layout = dut._persistLayout
+		yield from burstRead(start = layout.journalBase, data = bytes(layout.journalLength), setup = 2)
+		# Then the whole image comes in as a single burst, groups and short address first
+		yield from burstRead(start = 0, setup = 3, data = persistImage(dut, group = (0x1B, 0x1C), shortAddress = (0x1D,),
+			maxLevel = (5,), minLevel = (6,), failureLevel = (7,), onLevel = (8,), fadeTime = (9,), fadeRate = (0xA,),
+			scene0 = range(0xB, 0x1B)))
 		yield from waitBitTime(1e6, bitRate)
 		# Broadcast "Query Max Level"
 		yield from sendCommand(0b1111_1111_1010_0001, interface = interface, clkFreq = 1e6, bitRate = bitRate)
@@ -315,3 +365,617 @@ def startupRead(sim : Simulator, dut : DALI):
 		assert (yield from recvResponse(interface = interface, clkFreq = 1e6, bitRate = bitRate)) == 0x1D
 		yield from waitBitTime(1e6, bitRate)
 	yield domainSync, 'sync'
+
+def recordWrite(dut : DALI, *, slot, sequence, entries, registers):
+	# The journal append that starts each write back, as FRAM transactions
+	layout = dut._persistLayout
+	address = layout.slotAddress(slot)
+	record = layout.record(sequence, ((dut._framMap[name] + index, value) for name, index, value in entries), registers)
+	return [[FRAMOpcodes.writeEnable], [FRAMOpcodes.write, address >> 8, address & 0xFF, *record]]
+
+def crcWrite(image : bytes):
+	# The CRC update that ends each write back, bringing FRAM back to an intact image
+	crcAddress = len(image) - 2
+	return [[FRAMOpcodes.writeEnable], [FRAMOpcodes.write, crcAddress >> 8, crcAddress & 0xFF, *image[-2:]]]
+
+@sim_case(domains = (('sync', 1e6),),
+	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0),
+		persistHoldoff = 50e-3),
+	platform = Platform(clk_freq = 1e6))
+def coalescedWriteback(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+	memory = dict(enumerate(persistImage(dut)))
+	transactions = []
+
+	def domainSync():
+		yield interface.rx.i.eq(1)
+		yield Settle()
+		# Let the startup read complete
+		yield from waitBitTime(1e6, bitRate)
+		yield from waitBitTime(1e6, bitRate)
+		# Send "Download to DTR" w/ payload of 0x42
+		yield from sendCommand(0b1010_0011_0100_0010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Broadcast "Store DTR as Scene 1"
+		yield from sendCommand(0b1111_1111_0100_0001, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Broadcast "Store DTR as Scene 2"
+		yield from sendCommand(0b1111_1111_0100_0010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Broadcast "Query Scene Level 2"
+		yield from sendCommand(0b1111_1111_1011_0010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Check the device answered with 0x42
+		assert (yield from recvResponse(interface = interface, clkFreq = 1e6, bitRate = bitRate)) == 0x42
+		# Wait for the bus to have been quiet long enough for the write back to happen
+		for _ in range(60):
+			yield from waitBitTime(1e6, 1000)
+		# Check both scenes got journalled together, then written back in a single burst followed by the new CRC
+		sceneAddress = dut._persistLayout.headerLength + dut._framMap['scene0']
+		registers = persistRegisters(dut, scene0 = (0xFF, 0x42, 0x42))
+		image = dut._persistLayout.image(registers)
+		writes = [transaction for transaction in transactions if transaction[0] != FRAMOpcodes.read]
+		assert writes == [
+			*recordWrite(dut, slot = 0, sequence = 0, entries = (('scene0', 1, 0x42), ('scene0', 2, 0x42)),
+				registers = registers),
+			[FRAMOpcodes.writeEnable], [FRAMOpcodes.write, 0, sceneAddress + 1, 0x42, 0x42],
+			*crcWrite(image),
+		]
+		assert bytes(memory[addr] for addr in range(len(image))) == image
+
+	yield domainSync, 'sync'
+	yield framDevice(bus = fram_spi, memory = memory, transactions = transactions), 'sync'
+
+@sim_case(domains = (('sync', 1e6),),
+	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0),
+		persistHoldoff = 0),
+	platform = Platform(clk_freq = 1e6))
+def postedWrites(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+	memory = dict(enumerate(persistImage(dut)))
+	transactions = []
+
+	def domainSync():
+		yield interface.rx.i.eq(1)
+		yield Settle()
+		# Let the startup read complete
+		yield from waitBitTime(1e6, bitRate)
+		yield from waitBitTime(1e6, bitRate)
+		# Send "Download to DTR" w/ payload of 0x42
+		yield from sendCommand(0b1010_0011_0100_0010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Broadcast "Store DTR as Scene 3", then straight away "Query Scene Level 3"
+		yield from sendCommand(0b1111_1111_0100_0011, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_1011_0011, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Check the device answered with 0x42 from the live register
+		assert (yield from recvResponse(interface = interface, clkFreq = 1e6, bitRate = bitRate)) == 0x42
+		yield from waitBitTime(1e6, bitRate)
+		# And that the store made it out to FRAM in the background
+		sceneAddress = dut._persistLayout.headerLength + dut._framMap['scene0']
+		registers = persistRegisters(dut, scene0 = (0xFF, 0xFF, 0xFF, 0x42))
+		writes = [transaction for transaction in transactions if transaction[0] != FRAMOpcodes.read]
+		assert writes == [
+			*recordWrite(dut, slot = 0, sequence = 0, entries = (('scene0', 3, 0x42),), registers = registers),
+			[FRAMOpcodes.writeEnable], [FRAMOpcodes.write, 0, sceneAddress + 3, 0x42],
+			*crcWrite(dut._persistLayout.image(registers)),
+		]
+
+	yield domainSync, 'sync'
+	yield framDevice(bus = fram_spi, memory = memory, transactions = transactions), 'sync'
+
+@sim_case(domains = (('sync', 1e6),),
+	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0),
+		persistHoldoff = 0),
+	platform = Platform(clk_freq = 1e6))
+def unchangedWrites(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+	memory = dict(enumerate(persistImage(dut)))
+	transactions = []
+
+	def domainSync():
+		yield interface.rx.i.eq(1)
+		yield Settle()
+		# Let the startup read complete
+		yield from waitBitTime(1e6, bitRate)
+		yield from waitBitTime(1e6, bitRate)
+		# Send "Download to DTR" w/ payload of 0x42
+		yield from sendCommand(0b1010_0011_0100_0010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Broadcast "Store DTR as Scene 4" twice, as a building management system refreshing it might
+		yield from sendCommand(0b1111_1111_0100_0100, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_0100_0100, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Send "Download to DTR" w/ payload of 0xFF, then broadcast "Store DTR as Scene 5" which is already unset
+		yield from sendCommand(0b1010_0011_1111_1111, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_0100_0101, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from waitBitTime(1e6, bitRate)
+		# Check only the first store got written back and the other two were counted as suppressed
+		sceneAddress = dut._persistLayout.headerLength + dut._framMap['scene0']
+		registers = persistRegisters(dut, scene0 = (0xFF, 0xFF, 0xFF, 0xFF, 0x42))
+		writes = [transaction for transaction in transactions if transaction[0] != FRAMOpcodes.read]
+		assert writes == [
+			*recordWrite(dut, slot = 0, sequence = 0, entries = (('scene0', 4, 0x42),), registers = registers),
+			[FRAMOpcodes.writeEnable], [FRAMOpcodes.write, 0, sceneAddress + 4, 0x42],
+			*crcWrite(dut._persistLayout.image(registers)),
+		]
+		assert (yield dut.suppressedWrites) == 2
+
+	yield domainSync, 'sync'
+	yield framDevice(bus = fram_spi, memory = memory, transactions = transactions), 'sync'
+
+@sim_case(domains = (('sync', 1e6),),
+	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0),
+		persistHoldoff = 0),
+	platform = Platform(clk_freq = 1e6))
+def corruptImage(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+	# An image with max level set to 0x80 but that has had a bit flip since it was written
+	image = bytearray(persistImage(dut, maxLevel = (0x80,), shortAddress = (0x05,)))
+	image[dut._persistLayout.headerLength + dut._framMap['maxLevel']] ^= 0x01
+	memory = dict(enumerate(image))
+	transactions = []
+
+	def domainSync():
+		yield interface.rx.i.eq(1)
+		yield Settle()
+		# Let the startup read complete
+		yield from waitBitTime(1e6, bitRate)
+		yield from waitBitTime(1e6, bitRate)
+		# Broadcast "Query Max Level"
+		yield from sendCommand(0b1111_1111_1010_0001, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Check the device fell back to the default rather than using the damaged value
+		assert (yield from recvResponse(interface = interface, clkFreq = 1e6, bitRate = bitRate)) == 254
+		# Send "Query Device Type" to device 5, which must not answer as that short address came from the same image
+		yield from sendCommand(0b0000_1011_1001_1001, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield
+		yield from validateIdle(interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Check the journal was cleared out and then the image rebuilt from the defaults in one burst
+		layout = dut._persistLayout
+		image = persistImage(dut)
+		writes = [transaction for transaction in transactions if transaction[0] != FRAMOpcodes.read]
+		assert writes == [
+			[FRAMOpcodes.writeEnable],
+			[FRAMOpcodes.write, layout.journalBase >> 8, layout.journalBase & 0xFF, *bytes(layout.journalLength)],
+			[FRAMOpcodes.writeEnable], [FRAMOpcodes.write, 0, 0, *image],
+		]
+		assert crc16(image) == 0
+		assert bytes(memory[addr] for addr in range(len(image))) == image
+
+	yield domainSync, 'sync'
+	yield framDevice(bus = fram_spi, memory = memory, transactions = transactions), 'sync'
+
+@sim_case(domains = (('sync', 1e6),),
+	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0),
+		persistHoldoff = 0),
+	platform = Platform(clk_freq = 1e6))
+def journalReplay(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+	layout = dut._persistLayout
+	# Group 0_7 and max level were journalled together, then the power went with only the group byte
+	# applied to the image and its CRC still the one from before. The record before that, setting the
+	# short address, made it in full and the slot after holds a record that was itself cut short
+	before = persistRegisters(dut, shortAddress = (0x05,))
+	after = persistRegisters(dut, shortAddress = (0x05,), group = (0x81, 0), maxLevel = (0x80,))
+	image = bytearray(layout.image(before))
+	image[layout.headerLength + dut._framMap['group']] = 0x81
+	older = layout.record(0xFE, ((dut._framMap['shortAddress'], 0x05),), before)
+	newest = layout.record(0xFF, ((dut._framMap['group'], 0x81), (dut._framMap['maxLevel'], 0x80)), after)
+	torn = layout.record(0x00, ((dut._framMap['minLevel'], 0x40),), after)[:-4]
+	memory = dict(enumerate(image))
+	for slot, record in enumerate((older, newest, torn)):
+		memory.update(enumerate(record, start = layout.slotAddress(slot)))
+	transactions = []
+
+	def domainSync():
+		yield interface.rx.i.eq(1)
+		yield Settle()
+		# Let the startup read complete
+		yield from waitBitTime(1e6, bitRate)
+		yield from waitBitTime(1e6, bitRate)
+		yield from waitBitTime(1e6, bitRate)
+		# Send "Query Max Level" to device 5
+		yield from sendCommand(0b0000_1011_1010_0001, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Check the device answered with the journalled level and not the one still in the image
+		assert (yield from recvResponse(interface = interface, clkFreq = 1e6, bitRate = bitRate)) == 0x80
+		# Send "Query Group 0_7" to device 5
+		yield from sendCommand(0b0000_1011_1100_0000, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		assert (yield from recvResponse(interface = interface, clkFreq = 1e6, bitRate = bitRate)) == 0x81
+		# Send "Query Min Level" to device 5, which the torn record must not have touched
+		yield from sendCommand(0b0000_1011_1010_0010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		assert (yield from recvResponse(interface = interface, clkFreq = 1e6, bitRate = bitRate)) == 1
+		# Check the newest record was applied to the image again, leaving it intact, and nothing else was written
+		headerLength = layout.headerLength
+		writes = [transaction for transaction in transactions if transaction[0] != FRAMOpcodes.read]
+		assert writes == [
+			[FRAMOpcodes.writeEnable], [FRAMOpcodes.write, 0, headerLength + dut._framMap['group'], 0x81],
+			[FRAMOpcodes.writeEnable], [FRAMOpcodes.write, 0, headerLength + dut._framMap['maxLevel'], 0x80],
+			*crcWrite(layout.image(after)),
+		]
+		assert bytes(memory[addr] for addr in range(layout.imageLength)) == layout.image(after)
+
+	yield domainSync, 'sync'
+	yield framDevice(bus = fram_spi, memory = memory, transactions = transactions), 'sync'
+
+@sim_case(domains = (('sync', 120e3),),
+	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0)),
+	platform = Platform(clk_freq = 120e3))
+def queuedFrames(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+
+	def domainSync():
+		yield interface.rx.i.eq(1)
+		yield from waitBitTime(120e3, bitRate)
+		# With a slow enough clock both of these arrive while the boot load is still holding the first up
+		# Send "Download to DTR" w/ payload of 0x42
+		yield from sendCommand(0b1010_0011_0100_0010, interface = interface, clkFreq = 120e3, bitRate = bitRate)
+		# Broadcast "Store DTR as Scene 6"
+		yield from sendCommand(0b1111_1111_0100_0110, interface = interface, clkFreq = 120e3, bitRate = bitRate)
+		# Broadcast "Query Scene Level 6"
+		yield from sendCommand(0b1111_1111_1011_0110, interface = interface, clkFreq = 120e3, bitRate = bitRate)
+		# Check the device answered with 0x42, so neither frame was lost
+		assert (yield from recvResponse(interface = interface, clkFreq = 120e3, bitRate = bitRate)) == 0x42
+		assert (yield dut.rxOverflows) == 0
+		yield from waitBitTime(120e3, bitRate)
+	yield domainSync, 'sync'
+
+@sim_case(domains = (('sync', 120e3),),
+	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0)),
+	platform = Platform(clk_freq = 120e3))
+def ignoredFrames(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+
+	def domainSync():
+		yield interface.rx.i.eq(1)
+		yield from waitBitTime(120e3, bitRate)
+		# Send "Download to DTR" w/ payload of 0x42
+		yield from sendCommand(0b1010_0011_0100_0010, interface = interface, clkFreq = 120e3, bitRate = bitRate)
+		# Then an input device and an event frame, which would overwrite DTR if read as their last 16 bits
+		yield from sendCommand(0b1000_0001_1010_0011_0101_0101, interface = interface, clkFreq = 120e3,
+			bitRate = bitRate, bits = 24)
+		yield from sendCommand(0b1_0110_1100_1010_0011_0111_0111, interface = interface, clkFreq = 120e3,
+			bitRate = bitRate, bits = 25)
+		# Broadcast "Store DTR as Scene 6"
+		yield from sendCommand(0b1111_1111_0100_0110, interface = interface, clkFreq = 120e3, bitRate = bitRate)
+		# Broadcast "Query Scene Level 6"
+		yield from sendCommand(0b1111_1111_1011_0110, interface = interface, clkFreq = 120e3, bitRate = bitRate)
+		# Check the device answered with 0x42, and that nothing was lost or treated as a bad frame
+		assert (yield from recvResponse(interface = interface, clkFreq = 120e3, bitRate = bitRate)) == 0x42
+		assert (yield dut.rxOverflows) == 0
+		assert (yield dut.error) == 0
+		yield from waitBitTime(120e3, bitRate)
+	yield domainSync, 'sync'
+
+@sim_case(domains = (('sync', 120e3),),
+	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0)),
+	platform = Platform(clk_freq = 120e3))
+def brokenFrames(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+
+	def sendBroken(command):
+		# Send a 16 bit frame whose last bit never makes its mid-bit transition, breaking the Manchester coding
+		yield interface.rx.i.eq(0)
+		yield from waitBitTime(120e3, bitRate)
+		yield interface.rx.i.eq(1)
+		yield from waitBitTime(120e3, bitRate)
+		for i in range(16):
+			bit = (command >> (15 - i)) & 1
+			yield interface.rx.i.eq(bit)
+			yield from waitBitTime(120e3, bitRate)
+			yield interface.rx.i.eq(bit ^ (i != 15))
+			yield from waitBitTime(120e3, bitRate)
+		yield interface.rx.i.eq(1)
+		for _ in range(8):
+			yield from waitBitTime(120e3, bitRate)
+
+	def domainSync():
+		yield interface.rx.i.eq(1)
+		yield from waitBitTime(120e3, bitRate)
+		# Send "Download to DTR" w/ payload of 0x11
+		yield from sendCommand(0b1010_0011_0001_0001, interface = interface, clkFreq = 120e3, bitRate = bitRate)
+		# Then a broken "Download to DTR" w/ payload of 0x42, which gets flagged but must not be acted on
+		yield from sendBroken(0b1010_0011_0100_0010)
+		# And a broken broadcast "Query DTR", which must not be answered
+		yield from sendBroken(0b1111_1111_1001_1000)
+		yield from validateIdle(interface = interface, clkFreq = 120e3, bitRate = bitRate)
+		assert (yield dut.error) == 1
+		# Broadcast "Query DTR", checking DTR was left alone
+		yield from sendCommand(0b1111_1111_1001_1000, interface = interface, clkFreq = 120e3, bitRate = bitRate)
+		assert (yield from recvResponse(interface = interface, clkFreq = 120e3, bitRate = bitRate)) == 0x11
+		assert (yield dut.error) == 0
+		assert (yield dut.rxOverflows) == 0
+		yield from waitBitTime(120e3, bitRate)
+	yield domainSync, 'sync'
+
+@sim_case(domains = (('sync', 120e3),),
+	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0)),
+	platform = Platform(clk_freq = 120e3))
+def loopedBackReplies(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+
+	def loopback():
+		# The bus is wired-AND, so whatever we send comes straight back on RX as it would on a real bus
+		yield Passive()
+		last = 1
+		while True:
+			tx = (yield interface.tx.o)
+			if tx != last:
+				yield interface.rx.i.eq(tx)
+				last = tx
+			yield
+
+	def domainSync():
+		yield interface.rx.i.eq(1)
+		yield from waitBitTime(120e3, bitRate)
+		# Send "Download to DTR" w/ payload of 0x42, then broadcast "Query DTR" twice, hearing each reply back
+		yield from sendCommand(0b1010_0011_0100_0010, interface = interface, clkFreq = 120e3, bitRate = bitRate)
+		assert (yield from query(0b1111_1111_1001_1000, clkFreq = 120e3, bitRate = bitRate)) == 0x42
+		assert (yield from query(0b1111_1111_1001_1000, clkFreq = 120e3, bitRate = bitRate)) == 0x42
+		yield from waitBitTime(120e3, bitRate)
+		# Check the replies were dropped rather than being flagged or queued, and didn't count as collisions
+		assert (yield dut.error) == 0
+		assert (yield dut.rxOverflows) == 0
+		assert (yield dut.txCollisions) == 0
+	yield domainSync, 'sync'
+	yield loopback, 'sync'
+
+@sim_case(domains = (('sync', 1e6),),
+	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0)),
+	platform = Platform(clk_freq = 1e6))
+def registerCommands(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+
+	def domainSync():
+		yield interface.rx.i.eq(1)
+		yield from waitBitTime(1e6, bitRate)
+		# Send "Download to DTR" w/ payload of 20, then broadcast "Store DTR as Fade Time", which tops out at 15
+		yield from sendCommand(0b1010_0011_0001_0100, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_0010_1110, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Send "Download to DTR" w/ payload of 3, then broadcast "Store DTR as Fade Rate"
+		yield from sendCommand(0b1010_0011_0000_0011, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_0010_1111, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Broadcast "Query Fade Time/Rate"
+		assert (yield from query(0b1111_1111_1010_0101, clkFreq = 1e6, bitRate = bitRate)) == 0xF3
+		# Broadcast "Add To Group" for groups 3 and 12, then "Remove From Group" for group 3
+		yield from sendCommand(0b1111_1111_0110_0011, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_0110_1100, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_0111_0011, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Broadcast "Query Groups 0-7" and "Query Groups 8-15"
+		assert (yield from query(0b1111_1111_1100_0000, clkFreq = 1e6, bitRate = bitRate)) == 0x00
+		assert (yield from query(0b1111_1111_1100_0001, clkFreq = 1e6, bitRate = bitRate)) == 0x10
+		# Send "Download to DTR" w/ payload of 0x42, then broadcast "Store DTR as Scene 5"
+		yield from sendCommand(0b1010_0011_0100_0010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_0100_0101, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Broadcast "Query Scene Level 5"
+		assert (yield from query(0b1111_1111_1011_0101, clkFreq = 1e6, bitRate = bitRate)) == 0x42
+		# Broadcast "Remove From Scene 5" and check it went back to being unset
+		yield from sendCommand(0b1111_1111_0101_0101, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		assert (yield from query(0b1111_1111_1011_0101, clkFreq = 1e6, bitRate = bitRate)) == 0xFF
+		# Broadcast "Store Actual Level in DTR", with the lamp off, and "Query DTR"
+		yield from sendCommand(0b1111_1111_0010_0001, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		assert (yield from query(0b1111_1111_1001_1000, clkFreq = 1e6, bitRate = bitRate)) == 0
+		# Broadcast "Query Missing Short Address", which we are as it defaults to unset
+		assert (yield from query(0b1111_1111_1001_0110, clkFreq = 1e6, bitRate = bitRate)) == 1
+		# Send "Download to DTR" w/ payload of 1, then broadcast "Select Dimming Curve" for the linear curve
+		yield from sendCommand(0b1010_0011_0000_0001, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_1110_0011, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Broadcast "Query Dimming Curve"
+		assert (yield from query(0b1111_1111_1110_1110, clkFreq = 1e6, bitRate = bitRate)) == 1
+		# Send "Download to DTR" w/ payload of 5, which isn't a curve, and check "Select Dimming Curve" ignores it
+		yield from sendCommand(0b1010_0011_0000_0101, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_1110_0011, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		assert (yield from query(0b1111_1111_1110_1110, clkFreq = 1e6, bitRate = bitRate)) == 1
+		yield from waitBitTime(1e6, bitRate)
+	yield domainSync, 'sync'
+
+@sim_case(domains = (('sync', 1e6),),
+	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0), gearCount = 3),
+	platform = Platform(clk_freq = 1e6))
+def multipleGear(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+	# Give the gear short addresses 1, 2 and 3, with the first in group 0 and the second in groups 0 and 1
+	memory = dict(enumerate(persistImage(dut, **{
+		'shortAddress': (1,), 'group': (0x01,),
+		dut.gearRegister(1, 'shortAddress'): (2,), dut.gearRegister(1, 'group'): (0x03,),
+		dut.gearRegister(2, 'shortAddress'): (3,),
+	})))
+
+	def domainSync():
+		yield interface.rx.i.eq(1)
+		yield from waitBitTime(1e6, bitRate)
+		# Send "Download to DTR" w/ payload of 0x42, which every gear takes
+		yield from sendCommand(0b1010_0011_0100_0010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# "Store DTR as Scene 0" to short address 2, then "Query Scene Level 0" of short addresses 2 and 1
+		yield from sendCommand(0b0000_0101_0100_0000, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		assert (yield from query(0b0000_0101_1011_0000, clkFreq = 1e6, bitRate = bitRate)) == 0x42
+		assert (yield from query(0b0000_0011_1011_0000, clkFreq = 1e6, bitRate = bitRate)) == 0xFF
+		# "Store DTR as Scene 1" to group 0, which only the third gear isn't in
+		yield from sendCommand(0b1000_0001_0100_0001, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		assert (yield from query(0b0000_0011_1011_0001, clkFreq = 1e6, bitRate = bitRate)) == 0x42
+		assert (yield from query(0b0000_0111_1011_0001, clkFreq = 1e6, bitRate = bitRate)) == 0xFF
+		# Group 1 "Query Groups 0-7" only gets an answer from the second gear
+		assert (yield from query(0b1000_0011_1100_0000, clkFreq = 1e6, bitRate = bitRate)) == 0x03
+		# Every gear answering the same doesn't count as a conflict
+		assert (yield from query(0b1111_1111_1001_1001, clkFreq = 1e6, bitRate = bitRate)) == DeviceType.led
+		assert (yield dut.responseConflicts) == 0
+		# But a broadcast "Query Groups 0-7" has them all disagree, the first gear's answer being the one sent
+		assert (yield from query(0b1111_1111_1100_0000, clkFreq = 1e6, bitRate = bitRate)) == 0x01
+		assert (yield dut.responseConflicts) == 2
+		# And nothing answers for short address 4
+		yield from sendCommand(0b0000_1001_1001_1001, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from validateIdle(interface = interface, clkFreq = 1e6, bitRate = bitRate)
+
+	yield domainSync, 'sync'
+	yield framDevice(bus = fram_spi, memory = memory, transactions = []), 'sync'
+
+@sim_case(domains = (('sync', 1e6),),
+	dut = PowerCycledDALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0),
+		persistHoldoff = 50e-3, gearCount = 5),
+	platform = Platform(clk_freq = 1e6))
+def drainedBroadcast(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+	layout = dut._persistLayout
+	# Give the gear short addresses 1 through 5
+	addresses = {dut.gearRegister(gear, 'shortAddress'): (gear + 1,) for gear in range(5)}
+	memory = dict(enumerate(persistImage(dut, **addresses)))
+
+	def domainSync():
+		yield interface.rx.i.eq(1)
+		yield from waitBitTime(1e6, bitRate)
+		# Send "Download to DTR" w/ payload of 0x42
+		yield from sendCommand(0b1010_0011_0100_0010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Broadcast "Store DTR as Scene 0" through "Store DTR as Scene 3", 20 stores between the gear which
+		# fills the queue past half way and sets it draining part way through the last broadcast
+		for scene in range(4):
+			yield from sendCommand(0b1111_1111_0100_0000 | scene, interface = interface, clkFreq = 1e6,
+				bitRate = bitRate)
+		# Wait for the bus to have been quiet long enough for the rest to be written back too
+		for _ in range(100):
+			yield from waitBitTime(1e6, 1000)
+		# Check every store made it to the image in FRAM
+		registers = persistRegisters(dut, **addresses,
+			**{dut.gearRegister(gear, 'scene0'): (0x42,) * 4 for gear in range(5)})
+		assert bytes(memory[addr] for addr in range(layout.imageLength)) == layout.image(registers)
+		# Then power cycle, and check each gear comes back up with the last scene stored
+		yield dut.reset.eq(1)
+		yield
+		yield dut.reset.eq(0)
+		yield from waitBitTime(1e6, bitRate)
+		yield from waitBitTime(1e6, bitRate)
+		for gear in range(5):
+			# "Query Scene Level 3" to the gear's short address
+			frame = (((gear + 1) << 9) | 0b1_1011_0011)
+			assert (yield from query(frame, clkFreq = 1e6, bitRate = bitRate)) == 0x42
+
+	yield domainSync, 'sync'
+	yield framDevice(bus = fram_spi, memory = memory, transactions = []), 'sync'
+
+@sim_case(domains = (('sync', 1e6),),
+	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0)),
+	platform = Platform(clk_freq = 1e6))
+def levelControl(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+
+	def level(frame):
+		# Send a level command and check where broadcast "Query Actual Level" says the lamp ended up
+		yield from sendCommand(frame, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		return (yield from query(0b1111_1111_1010_0000, clkFreq = 1e6, bitRate = bitRate))
+
+	def latency(frame):
+		# Count the cycles from the start of the stop condition to the output changing, then let the stop
+		# condition run out
+		output = (yield dut.outputs[0])
+		yield from sendCommand(frame, interface = interface, clkFreq = 1e6, bitRate = bitRate, stopBits = False)
+		cycles = 0
+		while (yield dut.outputs[0]) == output:
+			assert cycles < 4 * (int(1e6) // bitRate)
+			cycles += 1
+			yield
+		for _ in range(4 * (int(1e6) // bitRate) - cycles):
+			yield
+		return cycles
+
+	def domainSync():
+		yield interface.rx.i.eq(1)
+		yield from waitBitTime(1e6, bitRate)
+		# Send "Download to DTR" w/ payload of 200 then broadcast "Store DTR as Max Level", and the same for a min
+		# level of 10
+		yield from sendCommand(0b1010_0011_1100_1000, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_0010_1010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1010_0011_0000_1010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_0010_1011, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Broadcast direct arc power to 100, which with no fade time reaches the output 1542 cycles into the stop
+		# condition. All but 84 of those are the receiver waiting out 3.5 half bits of it to be sure the frame's
+		# over, the rest being the frame queue, the gear's turn at it, the fade engine and the dimming curve
+		assert (yield from latency(0b1111_1110_0110_0100)) <= int(3.5 * 1e6 / bitRate) + 100
+		assert (yield from query(0b1111_1111_1010_0000, clkFreq = 1e6, bitRate = bitRate)) == 100
+		# Direct arc power is held between min and max level, 0 turning the lamp off and the mask doing nothing
+		assert (yield from level(0b1111_1110_1111_1010)) == 200
+		assert (yield from level(0b1111_1110_0000_0101)) == 10
+		assert (yield from level(0b1111_1110_1111_1111)) == 10
+		assert (yield from level(0b1111_1110_0000_0000)) == 0
+		# Broadcast "Step Up" and "Step Down" do nothing with the lamp off, and "Step Up And On" lights it at min
+		assert (yield from level(0b1111_1111_0000_0011)) == 0
+		assert (yield from level(0b1111_1111_0000_0100)) == 0
+		assert (yield from level(0b1111_1111_0000_1000)) == 10
+		# Then step up, back down to min level where it stays and "Step Down And Off" turns it off
+		assert (yield from level(0b1111_1111_0000_0011)) == 11
+		assert (yield from level(0b1111_1111_0000_0100)) == 10
+		assert (yield from level(0b1111_1111_0000_0100)) == 10
+		assert (yield from level(0b1111_1111_0000_0111)) == 0
+		# Broadcast "Go To Max Level" and "Go To Min Level"
+		assert (yield from level(0b1111_1111_0000_0101)) == 200
+		assert (yield from level(0b1111_1111_0000_0110)) == 10
+		# Send "Download to DTR" w/ payload of 0x42 and broadcast "Store DTR as Scene 3", then "Go To Scene 3"
+		yield from sendCommand(0b1010_0011_0100_0010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_0100_0011, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		assert (yield from level(0b1111_1111_0001_0011)) == 0x42
+		# A scene the gear isn't part of leaves the level alone
+		yield from sendCommand(0b1111_1111_0101_0100, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		assert (yield from level(0b1111_1111_0001_0100)) == 0x42
+		# Send "Download to DTR" w/ payload of 1 and broadcast "Store DTR as Fade Time", for 0.7s fades
+		yield from sendCommand(0b1010_0011_0000_0001, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_0010_1110, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# Broadcast direct arc power to 200 and check it's fading, then that it gets there
+		yield from sendCommand(0b1111_1110_1100_1000, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		assert (yield from query(0b1111_1111_1001_0000, clkFreq = 1e6, bitRate = bitRate)) & 0x10
+		assert 0x42 < (yield from query(0b1111_1111_1010_0000, clkFreq = 1e6, bitRate = bitRate)) < 200
+		for _ in range(int(0.7e6)):
+			yield
+		assert (yield from query(0b1111_1111_1010_0000, clkFreq = 1e6, bitRate = bitRate)) == 200
+		assert not (yield from query(0b1111_1111_1001_0000, clkFreq = 1e6, bitRate = bitRate)) & 0x10
+		# Send "Download to DTR" w/ payload of 150 and broadcast "Store DTR as Max Level", which brings the lamp
+		# down to the new max level, then broadcast "Fade Up" which has nowhere left to go
+		yield from sendCommand(0b1010_0011_1001_0110, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_0010_1010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		assert (yield from query(0b1111_1111_1010_0000, clkFreq = 1e6, bitRate = bitRate)) == 150
+		yield from sendCommand(0b1111_1111_0000_0001, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		assert not (yield from query(0b1111_1111_1001_0000, clkFreq = 1e6, bitRate = bitRate)) & 0x10
+		for _ in range(int(200e3)):
+			yield
+		assert (yield from query(0b1111_1111_1010_0000, clkFreq = 1e6, bitRate = bitRate)) == 150
+		# Whereas broadcast "Fade Down" does, at the default fade rate of 44.7 steps a second for 200ms
+		yield from sendCommand(0b1111_1111_0000_0010, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		for _ in range(int(200e3)):
+			yield
+		assert 140 <= (yield from query(0b1111_1111_1010_0000, clkFreq = 1e6, bitRate = bitRate)) < 150
+	yield domainSync, 'sync'
+
+@sim_case(domains = (('sync', 1e6),),
+	dut = DALI(interface = interface, deviceType = DeviceType.led, persistResource = ('fram', 0)),
+	platform = Platform(clk_freq = 1e6))
+def levelLimits(sim : Simulator, dut : DALI):
+	bitRate = 2400
+	interface = dut._interface
+
+	def setLimit(frame, value):
+		# Send "Download to DTR" w/ payload of value, then broadcast the store, and return where broadcast
+		# "Query Actual Level" says the lamp ended up
+		yield from sendCommand(0b1010_0011_0000_0000 | value, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(frame, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		return (yield from query(0b1111_1111_1010_0000, clkFreq = 1e6, bitRate = bitRate))
+
+	def domainSync():
+		storeMaxLevel = 0b1111_1111_0010_1010
+		storeMinLevel = 0b1111_1111_0010_1011
+		yield interface.rx.i.eq(1)
+		yield from waitBitTime(1e6, bitRate)
+		# Broadcast direct arc power to 200
+		yield from sendCommand(0b1111_1110_1100_1000, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		# A max level below the lamp brings it down, and one above it leaves it be
+		assert (yield from setLimit(storeMaxLevel, 150)) == 150
+		assert (yield from setLimit(storeMaxLevel, 220)) == 150
+		# A min level above the lamp brings it up, and one below it leaves it be
+		assert (yield from setLimit(storeMinLevel, 180)) == 180
+		assert (yield from setLimit(storeMinLevel, 100)) == 180
+		# But a lamp that's off stays off
+		yield from sendCommand(0b1111_1110_0000_0000, interface = interface, clkFreq = 1e6, bitRate = bitRate)
+		assert (yield from setLimit(storeMinLevel, 190)) == 0
+		assert (yield from setLimit(storeMaxLevel, 200)) == 0
+		yield from waitBitTime(1e6, bitRate)
+	yield domainSync, 'sync'
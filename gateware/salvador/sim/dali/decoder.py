@@ -0,0 +1,47 @@
+from arachne.core.sim import sim_case
+from nmigen.sim import *
+
+from ...dali.decoder import CommandDecoder
+from ...dali.types import DALICommand, DeviceType, DALILEDCommand
+
+__all__ = (
+	'decodeCommands',
+)
+
+class Platform:
+	@property
+	def default_clk_frequency(self):
+		return float(1e6)
+
+@sim_case(domains = (('sync', 1e6),), dut = CommandDecoder(deviceType = DeviceType.led), platform = Platform())
+def decodeCommands(sim : Simulator, dut : CommandDecoder):
+	def decode(commandByte):
+		yield dut.commandByte.eq(commandByte)
+		yield
+		yield Settle()
+		return (yield dut.command), (yield dut.deviceCommand), (yield dut.data)
+
+	def domainSync():
+		yield Settle()
+		ledNop = DALILEDCommand.nop
+		assert (yield from decode(0b0000_0000)) == (DALICommand.lampOff, ledNop, 0)
+		assert (yield from decode(0b0000_0010)) == (DALICommand.fadeDown, ledNop, 0)
+		assert (yield from decode(0b0010_0000)) == (DALICommand.reset, ledNop, 0)
+		assert (yield from decode(0b0010_0001)) == (DALICommand.levelToDTR, ledNop, 0)
+		# Commands carrying data in their bottom nibble
+		assert (yield from decode(0b0001_1010)) == (DALICommand.gotoScene, ledNop, 0b1010)
+		assert (yield from decode(0b0111_0101)) == (DALICommand.removeFromGroup, ledNop, 0b0101)
+		assert (yield from decode(0b1011_1111)) == (DALICommand.querySceneLevel, ledNop, 0b1111)
+		# Reserved bytes
+		assert (yield from decode(0b0000_1010)) == (DALICommand.nop, ledNop, 0)
+		assert (yield from decode(0b1101_0110)) == (DALICommand.nop, ledNop, 0)
+		# And the LED device specific ones
+		assert (yield from decode(0b1110_0011)) == (DALICommand.deviceSpecific, DALILEDCommand.selectCurve, 0)
+		assert (yield from decode(0b1111_1111)) == \
+			(DALICommand.deviceSpecific, DALILEDCommand.queryExtVersionNumber, 0)
+		assert (yield from decode(0b1110_0101)) == (DALICommand.deviceSpecific, ledNop, 0)
+		# The decode should hold for as long as the byte does
+		yield
+		yield Settle()
+		assert (yield dut.command) == DALICommand.deviceSpecific
+	yield domainSync, 'sync'
@@ -0,0 +1,84 @@
+from arachne.core.sim import sim_case
+from nmigen.sim import *
+
+from ...dali.fade import FadeEngine
+
+__all__ = (
+	'fadeLevels',
+)
+
+class Platform:
+	@property
+	def default_clk_frequency(self):
+		return float(100e3)
+
+@sim_case(domains = (('sync', 100e3),), dut = FadeEngine(gearCount = 2, tickRate = 1e3), platform = Platform())
+def fadeLevels(sim : Simulator, dut : FadeEngine):
+	# 100 cycles to each tick of the fade engine
+	def ticks(count):
+		for _ in range(count * 100):
+			yield
+		yield Settle()
+
+	def command(strobe, *, gear = 0, target = 0, fadeTime = 0, fadeRate = 0, up = False):
+		yield dut.gear.eq(gear)
+		yield dut.target.eq(target)
+		yield dut.fadeTime.eq(fadeTime)
+		yield dut.fadeRate.eq(fadeRate)
+		yield dut.fadeUp.eq(up)
+		yield strobe.eq(1)
+		yield
+		yield strobe.eq(0)
+		yield
+		yield Settle()
+
+	def domainSync():
+		yield Settle()
+		# Jumps take effect straight away
+		yield from command(dut.jump, target = 100)
+		assert (yield dut.levels[0]) == 100
+		assert (yield dut.fading) == 0
+		# Fade time 1 is 0.7s, so half way through a fade up to 200 the level should be around 150
+		yield from command(dut.fade, target = 200, fadeTime = 1)
+		assert (yield dut.fading) == 0b01
+		# Fading at the fade rate doesn't light the other gear's lamp
+		yield from command(dut.fadeAtRate, gear = 1, target = 254, fadeRate = 1, up = True)
+		yield from ticks(353)
+		assert 149 <= (yield dut.levels[0]) <= 151
+		assert (yield dut.levels[1]) == 0
+		assert (yield dut.fading) == 0b01
+		# Turn the fade round part way through, heading for off over the same fade time
+		level = (yield dut.levels[0])
+		yield from command(dut.fade, target = 0, fadeTime = 1)
+		yield from ticks(354)
+		assert abs((yield dut.levels[0]) - (level // 2)) <= 1
+		# Then fade up at fade rate 7, 44.7 steps a second, which stops after 200ms
+		level = (yield dut.levels[0])
+		yield from command(dut.fadeAtRate, target = 254, fadeRate = 7, up = True)
+		yield from ticks(300)
+		assert (yield dut.levels[0]) - level in (8, 9)
+		assert (yield dut.fading) == 0
+		# Fading up toward a limit the level is already above goes nowhere, rather than back down to it
+		level = (yield dut.levels[0])
+		yield from command(dut.fadeAtRate, target = level - 5, fadeRate = 7, up = True)
+		assert (yield dut.fading) == 0
+		yield from ticks(10)
+		assert (yield dut.levels[0]) == level
+		# And likewise fading down toward one the level is already below
+		yield from command(dut.fadeAtRate, target = level + 5, fadeRate = 7)
+		assert (yield dut.fading) == 0
+		yield from ticks(10)
+		assert (yield dut.levels[0]) == level
+		# A jump abandons a fade under way
+		yield from command(dut.fade, target = 254, fadeTime = 15)
+		yield from ticks(10)
+		assert (yield dut.fading) == 0b01
+		yield from command(dut.jump, target = 10)
+		yield from ticks(10)
+		assert (yield dut.levels[0]) == 10
+		assert (yield dut.fading) == 0
+		# And with no fade time a fade is a jump too
+		yield from command(dut.fade, gear = 1, target = 42, fadeTime = 0)
+		assert (yield dut.levels[1]) == 42
+		assert (yield dut.fading) == 0
+	yield domainSync, 'sync'
@@ -0,0 +1,62 @@
+from arachne.core.sim import sim_case
+from nmigen.sim import *
+
+from ...dali.frames import FrameFIFO
+
+__all__ = (
+	'queueFrames',
+)
+
+class Platform:
+	@property
+	def default_clk_frequency(self):
+		return float(1e6)
+
+@sim_case(domains = (('sync', 1e6),), dut = FrameFIFO(depth = 2, timestampPeriod = 10e-6), platform = Platform())
+def queueFrames(sim : Simulator, dut : FrameFIFO):
+	def writeFrame(data, error):
+		yield dut.dataIn.eq(data)
+		yield dut.errorIn.eq(error)
+		yield dut.write.eq(1)
+		yield Settle()
+		timestamp = (yield dut.time)
+		yield
+		yield dut.write.eq(0)
+		return timestamp
+
+	def domainSync():
+		yield Settle()
+		assert (yield dut.valid) == 0
+		for _ in range(25):
+			yield
+		first = yield from writeFrame(0x1234, 0)
+		for _ in range(20):
+			yield
+		second = yield from writeFrame(0xFFA1, 1)
+		# The queue is full now, so this one gets counted and dropped
+		yield from writeFrame(0x5678, 0)
+		assert first != second
+		yield
+		yield Settle()
+		assert (yield dut.overflows) == 1
+		# Check the frames come out in order along with their error flags and when they arrived
+		assert (yield dut.valid) == 1
+		assert (yield dut.data) == 0x1234
+		assert (yield dut.error) == 0
+		assert (yield dut.timestamp) == first
+		yield dut.next.eq(1)
+		yield
+		yield dut.next.eq(0)
+		yield
+		yield Settle()
+		assert (yield dut.valid) == 1
+		assert (yield dut.data) == 0xFFA1
+		assert (yield dut.error) == 1
+		assert (yield dut.timestamp) == second
+		yield dut.next.eq(1)
+		yield
+		yield dut.next.eq(0)
+		yield
+		yield Settle()
+		assert (yield dut.valid) == 0
+	yield domainSync, 'sync'
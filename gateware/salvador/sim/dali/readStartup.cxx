@@ -1,4 +1,6 @@
+#include <array>
 #include <exception>
+#include <initializer_list>
 #include <string>
 #include <substrate/fd>
 #include <substrate/index_sequence>
@@ -67,9 +69,9 @@ int main(int, char **)
 	auto &daliRX{dut.p_dali__0____rx____i};
 	auto &daliTX{dut.p_dali__0____tx____o};
 
-	auto &framCS{dut.p_persistMemory_2e_bus_2e_fram__spi____cs____o};
-	auto &framClk{dut.p_persistMemory_2e_bus_2e_fram__spi____clk____o};
-	auto &framCOPI{dut.p_persistMemory_2e_bus_2e_fram__spi____copi____o};
+	auto &framCS{dut.p_persist_2e_memory_2e_bus_2e_fram__spi____cs____o};
+	auto &framClk{dut.p_persist_2e_memory_2e_bus_2e_fram__spi____clk____o};
+	auto &framCOPI{dut.p_persist_2e_memory_2e_bus_2e_fram__spi____copi____o};
 	auto &framCIPO{dut.p_fram__spi____cipo____i};
 
 	const auto waitBitTime{
@@ -109,10 +111,20 @@ int main(int, char **)
 	const auto recvResponse{
 		[&]() -> uint8_t
 		{
-			// Wait for processing
-			cycleClock();
-			cycleClock();
-			cycleClock();
+			// The response has to start in the settling window after the forward frame,
+			// the stop bits of which have already gone by
+			auto delay{4U * (clkFrequency / bitRate)};
+			while (daliTX.get<bool>())
+			{
+				if (++delay > clkFrequency * 105U / 10000U)
+					throw cxxrtlAssertion_t{};
+				cycleClock();
+			}
+			if (delay < clkFrequency * 55U / 10000U)
+				throw cxxrtlAssertion_t{};
+			// Check each half-bit in its middle
+			for ([[maybe_unused]] const auto _ : indexSequence_t{clkFrequency / bitRate / 2U})
+				cycleClock();
 			// Check the DUT generates the correct start bit
 			cxxrtlAssert(daliTX, false);
 			waitBitTime();
@@ -169,32 +181,64 @@ int main(int, char **)
 		}
 	};
 
-	const auto writeAddress{
-		[&](const uint32_t addr)
+	// CRC-16/CCITT-FALSE, as used to protect the persisted image
+	const auto crc16{
+		[](const uint8_t *const data, const size_t length) -> uint16_t
 		{
-			cycleClock();
+			uint16_t crc{0xFFFFU};
+			for (const auto index : indexSequence_t{length})
+			{
+				crc ^= uint16_t(data[index] << 8U);
+				for ([[maybe_unused]] const auto _ : indexSequence_t{8})
+					crc = uint16_t((crc & 0x8000U) ? (crc << 1U) ^ 0x1021U : crc << 1U);
+			}
+			return crc;
+		}
+	};
+
+	const auto burstRead{
+		[&](const uint32_t start, const uint8_t *const data, const size_t length, const size_t setup)
+		{
+			for ([[maybe_unused]] const auto _ : indexSequence_t{setup})
+				cycleClock();
 			cxxrtlAssert(framCS, true);
-			cycleClock();
-			cycleClock();
 			if (readSPI() != 3U)
 				throw cxxrtlAssertion_t{};
-			cycleClock();
-			cycleClock();
-			if (readSPI() != uint8_t(addr >> 8U))
+			if (readSPI() != (start >> 8U))
 				throw cxxrtlAssertion_t{};
-			cycleClock();
-			cycleClock();
-			if (readSPI() != uint8_t(addr & 0xFFU))
+			if (readSPI() != (start & 0xFFU))
 				throw cxxrtlAssertion_t{};
+			for (const auto index : indexSequence_t{length})
+				writeSPI(data[index]);
 			cycleClock();
 			cycleClock();
-			writeSPI(addr + 5U);
-			cycleClock();
 			cxxrtlAssert(framCS, false);
 			cycleClock();
 		}
 	};
 
+	// The journal follows the image, 4 slots of 72 bytes each, and starts out empty
+	constexpr static auto journalBase{32U};
+	const std::array<uint8_t, 4 * 72> journal{};
+
+	// The layout version (see PersistLayout) and length, then groups and short address, the levels, fade
+	// time and rate, the scenes and finally the dimming curve, with the CRC over all that filled in below
+	std::array<uint8_t, 32> image
+	{{
+		0x94U, 0x85U, 0x00U, 0x1AU,
+		0x1BU, 0x1CU, 0x1DU, 0x05U, 0x06U, 0x07U, 0x08U, 0x09U, 0x0AU,
+		0x0BU, 0x0CU, 0x0DU, 0x0EU, 0x0FU, 0x10U, 0x11U, 0x12U,
+		0x13U, 0x14U, 0x15U, 0x16U, 0x17U, 0x18U, 0x19U, 0x1AU,
+		0x01U,
+	}};
+	const auto crc{crc16(image.data(), image.size() - 2U)};
+	image[image.size() - 2U] = uint8_t(crc >> 8U);
+	image[image.size() - 1U] = uint8_t(crc);
+
+	// The block RAM read enables nothing drives get left as inputs by the conversion, so hold them on by hand
+	for (auto *const readEnable : {&dut.p_rom__r__en, &dut.p_registers__r__en, &dut.p_microcode__r__en,
+		&dut.p_steps__r__en, &dut.p_shadow__r__en, &dut.p_staging__r__en})
+		readEnable->set(true);
 	dut.p_clk.set(true);
 	dut.p_rst.set(true);
 	dut.step();
@@ -202,8 +246,9 @@ int main(int, char **)
 	dut.p_rst.set(false);
 	daliRX.set(true);
 	cycleClock();
-	for (const auto i : indexSequence_t{25})
-		writeAddress(i);
+	// The journal gets scanned first, then the whole image comes in as a single burst, groups and short address first
+	burstRead(journalBase, journal.data(), journal.size(), 2U);
+	burstRead(0U, image.data(), image.size(), 3U);
 	waitBitTime();
 	// Broadcast "Query Max Level"
 	sendCommand(0b1111'1111'1010'0001U);
@@ -253,6 +298,11 @@ int main(int, char **)
 	// Check the device answered with 0x1D
 	if (recvResponse() != 0x1DU)
 		throw cxxrtlAssertion_t{};
+	// Broadcast "Query Dimming Curve"
+	sendCommand(0b1111'1111'1110'1110U);
+	// Check the device answered with 1 (linear)
+	if (recvResponse() != 1U)
+		throw cxxrtlAssertion_t{};
 	waitBitTime();
 
 	writeVCD();
@@ -5,40 +5,64 @@ from ...dali.serial import Serial
 
 __all__ = (
 	'rxDALI',
+	'rxTolerance',
+	'rxGlitches',
+	'rxBadTiming',
+	'rxFrameLengths',
 	'txDALI',
+	'txBitRate',
+	'responseSettling',
+	'responseJitter',
+	'txCollision',
 )
 
 class Platform:
+	def __init__(self, *, clk_freq):
+		self.clk_freq = clk_freq
+
 	@property
 	def default_clk_frequency(self):
-		return float(16e6)
+		return float(self.clk_freq)
 
 def waitBitTime(clkFreq, bitRate):
 	for _ in range(int(clkFreq) // bitRate):
 		yield
 	yield Settle()
 
-def sendCommand(command, *, dut, clkFreq, bitRate):
-	# Generate state bit
-	yield dut.rx.eq(0)
-	yield from waitBitTime(clkFreq, bitRate)
-	yield dut.rx.eq(1)
-	yield from waitBitTime(clkFreq, bitRate)
-	# Send command bits
-	for i in range(16):
-		bit = (command >> (15 - i)) & 1
-		yield dut.rx.eq(bit)
-		yield from waitBitTime(clkFreq, bitRate)
-		yield dut.rx.eq(bit ^ 1)
-		yield from waitBitTime(clkFreq, bitRate)
-	# Stop bits
+def commandHalfBits(command, bits = 16):
+	# Line levels for each half-bit of the start bit and command bits
+	levels = [0, 1]
+	for i in range(bits):
+		bit = (command >> (bits - 1 - i)) & 1
+		levels += [bit, bit ^ 1]
+	return levels
+
+def sendHalfBits(levels, periods, *, dut):
+	# Drive each half-bit for its own number of cycles, then idle the line
+	for level, period in zip(levels, periods):
+		yield dut.rx.eq(level)
+		for _ in range(period):
+			yield
 	yield dut.rx.eq(1)
-	yield from waitBitTime(clkFreq, bitRate)
-	yield from waitBitTime(clkFreq, bitRate)
-	yield from waitBitTime(clkFreq, bitRate)
-	yield from waitBitTime(clkFreq, bitRate)
 
-@sim_case(domains = (('sync', 16e6),), dut = Serial(), platform = Platform())
+def sendFrame(command, *, dut, clkFreq, bitRate):
+	levels = commandHalfBits(command)
+	yield from sendHalfBits(levels, [int(clkFreq) // bitRate] * len(levels), dut = dut)
+
+def recvFrame(*, dut, clkFreq, bitRate):
+	# Wait up to the length of the stop condition at its slowest for the frame to be presented
+	for _ in range(int(clkFreq) * 5 // bitRate):
+		if (yield dut.dataAvailable):
+			return (yield dut.dataOut), (yield dut.error)
+		yield
+	assert False, 'No frame received'
+
+def validateNoFrame(cycles, *, dut):
+	for _ in range(cycles):
+		assert (yield dut.dataAvailable) == 0
+		yield
+
+@sim_case(domains = (('sync', 16e6),), dut = Serial(), platform = Platform(clk_freq = 16e6))
 def rxDALI(sim : Simulator, dut):
 	def domainSync():
 		yield Settle()
@@ -49,20 +73,132 @@ def rxDALI(sim : Simulator, dut):
 		yield Settle()
 		yield from waitBitTime(16e6, dut._bitRate)
 		# Broadcast "Query Short Address"
-		yield from sendCommand(0b1111_1111_1001_0110, dut = dut, clkFreq = 16e6, bitRate = dut._bitRate)
+		levels = commandHalfBits(0b1111_1111_1001_0110)
+		yield from sendHalfBits(levels, [int(16e6) // dut._bitRate] * len(levels), dut = dut)
+		assert (yield from recvFrame(dut = dut, clkFreq = 16e6, bitRate = dut._bitRate)) == (0b1111_1111_1001_0110, 0)
 		yield
 		yield
 
 	yield domainSync, 'sync'
 
-def recvResponse(response, *, dut, clkFreq, bitRate):
+@sim_case(domains = (('sync', 1e6),), dut = Serial(), platform = Platform(clk_freq = 1e6))
+def rxTolerance(sim : Simulator, dut):
+	def domainSync():
+		yield dut.rx.eq(1)
+		yield from waitBitTime(1e6, dut._bitRate)
+		levels = commandHalfBits(0b1010_0011_0101_1100)
+		# Half-bits at either end of the 333.3µs to 500µs allowed
+		for period in (340, 490):
+			yield from sendHalfBits(levels, [period] * len(levels), dut = dut)
+			assert (yield from recvFrame(dut = dut, clkFreq = 1e6, bitRate = dut._bitRate)) == (0b1010_0011_0101_1100, 0)
+			yield from waitBitTime(1e6, dut._bitRate)
+		# And a frame that starts short and drifts long over its length
+		periods = [350 + (130 * i) // len(levels) for i in range(len(levels))]
+		yield from sendHalfBits(levels, periods, dut = dut)
+		assert (yield from recvFrame(dut = dut, clkFreq = 1e6, bitRate = dut._bitRate)) == (0b1010_0011_0101_1100, 0)
+		yield from waitBitTime(1e6, dut._bitRate)
+
+	yield domainSync, 'sync'
+
+@sim_case(domains = (('sync', 1e6),), dut = Serial(), platform = Platform(clk_freq = 1e6))
+def rxGlitches(sim : Simulator, dut):
+	def domainSync():
+		yield dut.rx.eq(1)
+		yield from waitBitTime(1e6, dut._bitRate)
+		# A glitch on the idle line mustn't look like a start bit
+		yield dut.rx.eq(0)
+		for _ in range(30):
+			yield
+		yield dut.rx.eq(1)
+		yield from validateNoFrame(20000, dut = dut)
+		# Nor should one long enough to get through the filter, or the line being shorted for a while and then
+		# coming back up, and neither should be reported as a bad frame either
+		for period in (150, 10000):
+			yield dut.rx.eq(0)
+			for _ in range(period):
+				yield
+			yield dut.rx.eq(1)
+			for _ in range(20000):
+				assert (yield dut.dataAvailable) == 0
+				assert (yield dut.error) == 0
+				yield
+		# Nor should glitches part way through the half-bits of a frame upset it
+		levels = commandHalfBits(0b1111_1111_1001_0110)
+		for halfBit, level in enumerate(levels):
+			for cycle in range(417):
+				if halfBit in (1, 10, 23) and 150 <= cycle < 180:
+					yield dut.rx.eq(level ^ 1)
+				else:
+					yield dut.rx.eq(level)
+				yield
+		yield dut.rx.eq(1)
+		assert (yield from recvFrame(dut = dut, clkFreq = 1e6, bitRate = dut._bitRate)) == (0b1111_1111_1001_0110, 0)
+		yield from waitBitTime(1e6, dut._bitRate)
+
+	yield domainSync, 'sync'
+
+@sim_case(domains = (('sync', 1e6),), dut = Serial(), platform = Platform(clk_freq = 1e6))
+def rxBadTiming(sim : Simulator, dut):
+	def domainSync():
+		yield dut.rx.eq(1)
+		yield from waitBitTime(1e6, dut._bitRate)
+		levels = commandHalfBits(0b1111_1111_1001_0110)
+		# Cut one half-bit to well under the shortest allowed
+		periods = [417] * len(levels)
+		periods[12] = 150
+		yield from sendHalfBits(levels, periods, dut = dut)
+		assert (yield from recvFrame(dut = dut, clkFreq = 1e6, bitRate = dut._bitRate))[1] == 1
+		yield from waitBitTime(1e6, dut._bitRate)
+		# A frame a bit short should be flagged too
+		levels = commandHalfBits(0b1111_1111_1001_011, bits = 15)
+		yield from sendHalfBits(levels, [417] * len(levels), dut = dut)
+		assert (yield from recvFrame(dut = dut, clkFreq = 1e6, bitRate = dut._bitRate))[1] == 1
+		yield from waitBitTime(1e6, dut._bitRate)
+		# But the receiver should have recovered for the next frame
+		levels = commandHalfBits(0b1111_1111_1001_0110)
+		yield from sendHalfBits(levels, [417] * len(levels), dut = dut)
+		assert (yield from recvFrame(dut = dut, clkFreq = 1e6, bitRate = dut._bitRate)) == (0b1111_1111_1001_0110, 0)
+		yield from waitBitTime(1e6, dut._bitRate)
+
+	yield domainSync, 'sync'
+
+@sim_case(domains = (('sync', 1e6),), dut = Serial(), platform = Platform(clk_freq = 1e6))
+def rxFrameLengths(sim : Simulator, dut):
+	def domainSync():
+		yield dut.rx.eq(1)
+		yield from waitBitTime(1e6, dut._bitRate)
+		# A backward frame, input device and event frames, then a control gear one to check nothing's left over
+		for frame, bits in ((0b1010_0101, 8), (0b1000_0001_1111_1110_1010_0101, 24),
+			(0b1_0110_1100_0011_1001_0101_1010, 25), (0b0000_0001_1001_0110, 16)):
+			levels = commandHalfBits(frame, bits = bits)
+			yield from sendHalfBits(levels, [417] * len(levels), dut = dut)
+			assert (yield from recvFrame(dut = dut, clkFreq = 1e6, bitRate = dut._bitRate)) == (frame, 0)
+			assert (yield dut.dataLength) == bits
+			yield from waitBitTime(1e6, dut._bitRate)
+		# Anything in between lengths is still an error
+		levels = commandHalfBits(0b1010_1010_1010_1010_1010, bits = 20)
+		yield from sendHalfBits(levels, [417] * len(levels), dut = dut)
+		assert (yield from recvFrame(dut = dut, clkFreq = 1e6, bitRate = dut._bitRate))[1] == 1
+		assert (yield dut.dataLength) == 20
+		yield from waitBitTime(1e6, dut._bitRate)
+
+	yield domainSync, 'sync'
+
+def recvResponse(response, *, dut, clkFreq, bitRate) -> int:
 	# Signal to start sending
 	yield dut.dataIn.eq(response)
 	yield dut.dataSend.eq(1)
 	yield
 	yield dut.dataSend.eq(0)
-	yield
-	yield
+	# Transmission waits for the bus to settle after the forward frame, find out how long that took
+	delay = 1
+	while (yield dut.tx) == 1:
+		assert delay <= clkFreq * 10.5e-3
+		delay += 1
+		yield
+	# Check each half-bit in its middle
+	for _ in range(int(clkFreq) // (bitRate * 2)):
+		yield
 	# Check the dut generates the correct start bit
 	assert (yield dut.tx) == 0
 	yield from waitBitTime(clkFreq, bitRate)
@@ -80,19 +216,166 @@ def recvResponse(response, *, dut, clkFreq, bitRate):
 	yield from waitBitTime(clkFreq, bitRate)
 	yield from waitBitTime(clkFreq, bitRate)
 	yield from waitBitTime(clkFreq, bitRate)
+	return delay
 
-@sim_case(domains = (('sync', 16e6),), dut = Serial(), platform = Platform())
+def answerFrame(command, response, *, dut, clkFreq, bitRate, wait = 0):
+	# Send a forward frame and answer it once it's been received, returning how long after the end of the frame
+	# the response was asked for and when it started
+	yield from sendFrame(command, dut = dut, clkFreq = clkFreq, bitRate = bitRate)
+	requested = 0
+	while not (yield dut.dataAvailable):
+		requested += 1
+		yield
+	for _ in range(wait):
+		yield
+	requested += wait
+	started = requested + (yield from recvResponse(response, dut = dut, clkFreq = clkFreq, bitRate = bitRate))
+	return requested, started
+
+@sim_case(domains = (('sync', 16e6),), dut = Serial(), platform = Platform(clk_freq = 16e6))
 def txDALI(sim : Simulator, dut):
 	def domainSync():
 		yield Settle()
 		assert (yield dut.tx) == 1
 		yield
 		yield
+		yield dut.rx.eq(1)
 		yield Settle()
 		assert (yield dut.tx) == 1
 		yield from waitBitTime(16e6, dut._bitRate)
-		yield from recvResponse(0b0100_0100, dut = dut, clkFreq = 16e6, bitRate = dut._bitRate)
+		# Broadcast "Query Short Address"
+		yield from answerFrame(0b1111_1111_1001_0110, 0b0100_0100, dut = dut, clkFreq = 16e6, bitRate = dut._bitRate)
 		yield
 		yield
 
 	yield domainSync, 'sync'
+
+@sim_case(domains = (('sync', 100e3),), dut = Serial(), platform = Platform(clk_freq = 100e3))
+def txBitRate(sim : Simulator, dut):
+	def domainSync():
+		yield dut.rx.eq(1)
+		yield from waitBitTime(100e3, dut._bitRate)
+		yield from sendFrame(0b1111_1111_1001_0110, dut = dut, clkFreq = 100e3, bitRate = dut._bitRate)
+		yield from recvFrame(dut = dut, clkFreq = 100e3, bitRate = dut._bitRate)
+		yield dut.dataIn.eq(0b0101_0101)
+		yield dut.dataSend.eq(1)
+		yield
+		yield dut.dataSend.eq(0)
+		# Time from the start bit to the line going back high for good at the end of the last bit
+		while (yield dut.tx) == 1:
+			yield
+		cycles = 0
+		lastRise = None
+		previous = 0
+		while lastRise is None or cycles - lastRise < 4 * 100e3 / dut._bitRate:
+			yield
+			cycles += 1
+			level = (yield dut.tx)
+			if level and not previous:
+				lastRise = cycles
+			previous = level
+		# At 100kHz a half-bit is 41 2/3 cycles, which mustn't get rounded down to 41
+		assert abs(lastRise - 18 * 100e3 / dut._bitRate) <= 2
+		yield from waitBitTime(100e3, dut._bitRate)
+		yield from waitBitTime(100e3, dut._bitRate)
+		yield from waitBitTime(100e3, dut._bitRate)
+		yield from waitBitTime(100e3, dut._bitRate)
+
+	yield domainSync, 'sync'
+
+@sim_case(domains = (('sync', 1e6),), dut = Serial(), platform = Platform(clk_freq = 1e6))
+def responseSettling(sim : Simulator, dut):
+	def domainSync():
+		yield dut.rx.eq(1)
+		yield from waitBitTime(1e6, dut._bitRate)
+		# Asked for straight away, the response should go out at the start of the settling window
+		_, started = yield from answerFrame(0b1111_1111_1001_0110, 0x12, dut = dut, clkFreq = 1e6,
+			bitRate = dut._bitRate)
+		assert 5500 <= started <= 5700
+		# Asked for part way through the window, it should go out immediately
+		requested, started = yield from answerFrame(0b1111_1111_1001_0110, 0x34, dut = dut, clkFreq = 1e6,
+			bitRate = dut._bitRate, wait = 5000)
+		assert 5700 < requested and started - requested <= 100
+		assert (yield dut.deadlineMissed) == 0
+		# Asked for after the window has closed, it should be dropped and flagged
+		yield from sendFrame(0b1111_1111_1001_0110, dut = dut, clkFreq = 1e6, bitRate = dut._bitRate)
+		yield from recvFrame(dut = dut, clkFreq = 1e6, bitRate = dut._bitRate)
+		for _ in range(10000):
+			yield
+		yield dut.dataIn.eq(0x56)
+		yield dut.dataSend.eq(1)
+		yield
+		yield dut.dataSend.eq(0)
+		yield
+		assert (yield dut.sendComplete) == 1
+		yield
+		assert (yield dut.deadlineMissed) == 1
+		for _ in range(20000):
+			assert (yield dut.tx) == 1
+			yield
+		# The next response to go out on time should clear that again
+		yield from answerFrame(0b1111_1111_1001_0110, 0x78, dut = dut, clkFreq = 1e6, bitRate = dut._bitRate)
+		assert (yield dut.deadlineMissed) == 0
+
+	yield domainSync, 'sync'
+
+@sim_case(domains = (('sync', 1e6),), dut = Serial(settlingJitter = 4e-3), platform = Platform(clk_freq = 1e6))
+def responseJitter(sim : Simulator, dut):
+	def domainSync():
+		yield dut.rx.eq(1)
+		yield from waitBitTime(1e6, dut._bitRate)
+		# Responses should be spread out over the window rather than all going at its start
+		starts = set()
+		for response in range(4):
+			_, started = yield from answerFrame(0b1111_1111_1001_0110, response, dut = dut, clkFreq = 1e6,
+				bitRate = dut._bitRate, wait = response * 100)
+			assert 5500 <= started <= 10500
+			starts.add(started)
+		assert len(starts) > 1
+
+	yield domainSync, 'sync'
+
+@sim_case(domains = (('sync', 1e6),), dut = Serial(), platform = Platform(clk_freq = 1e6))
+def txCollision(sim : Simulator, dut):
+	def sendOnBus(response, pullLow):
+		# Drive rx as the wired-AND of our tx and another device that pulls the bus low for the half-bits given
+		yield dut.dataIn.eq(response)
+		yield dut.dataSend.eq(1)
+		yield
+		yield dut.dataSend.eq(0)
+		while (yield dut.tx) == 1:
+			yield
+		# Find out whether it finished, and the last half-bit it drove the bus low in
+		completed = False
+		lastLow = 0
+		for cycle in range(22 * 417):
+			halfBit = cycle // 417
+			if (yield dut.tx) == 0:
+				lastLow = halfBit
+			yield dut.rx.eq((yield dut.tx) & (halfBit not in pullLow))
+			completed |= bool((yield dut.sendComplete))
+			yield
+		yield dut.rx.eq(1)
+		return completed, lastLow
+
+	def domainSync():
+		yield dut.rx.eq(1)
+		yield from waitBitTime(1e6, dut._bitRate)
+		yield from sendFrame(0b1111_1111_1001_0110, dut = dut, clkFreq = 1e6, bitRate = dut._bitRate)
+		yield from recvFrame(dut = dut, clkFreq = 1e6, bitRate = dut._bitRate)
+		# Another device pulling the bus low through the first half of our second bit, which we send high
+		completed, lastLow = yield from sendOnBus(0b1111_0000, pullLow = (4,))
+		assert completed
+		assert (yield dut.collision) == 1
+		assert (yield dut.collisions) == 1
+		# We should have let go of the bus straight away rather than carry on sending
+		assert lastLow < 4
+		# Nothing else on the bus, so the next response should go out whole and clear the collision flag
+		yield from sendFrame(0b1111_1111_1001_0110, dut = dut, clkFreq = 1e6, bitRate = dut._bitRate)
+		yield from recvFrame(dut = dut, clkFreq = 1e6, bitRate = dut._bitRate)
+		completed, lastLow = yield from sendOnBus(0b1111_0000, pullLow = ())
+		assert completed and lastLow == 16
+		assert (yield dut.collision) == 0
+		assert (yield dut.collisions) == 1
+
+	yield domainSync, 'sync'
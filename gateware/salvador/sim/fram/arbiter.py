@@ -0,0 +1,74 @@
+from arachne.core.sim import sim_case
+from nmigen.sim import *
+
+from ...fram import *
+from ...fram.fram import Opcodes as FRAMOpcodes
+from .fram import Platform, DDRPlatform, bus, ddrBus, framDevice, spiTiming, readStream, writeStream, waitComplete
+
+__all__ = (
+	'sharedAccess',
+	'sharedAccessDDR',
+)
+
+def sharedSequence(*, dut : FRAMArbiter, bus, ddr = False):
+	first, second = dut.ports
+	data = [0x9B, 0x5A, 0xC3]
+	# The second client's window starts half way up the FRAM
+	memory = {1024 + 5 + i: value for i, value in enumerate(data)}
+	transactions = []
+
+	def domainFirst():
+		yield
+		# Write a burst, then straight away start another write
+		yield first.address.eq(16)
+		yield first.write.eq(1)
+		yield
+		yield first.write.eq(0)
+		yield from writeStream(dut = first, data = [0x01, 0x02, 0x03])
+		yield from waitComplete(dut = first)
+		yield first.address.eq(32)
+		yield first.write.eq(1)
+		yield
+		yield first.write.eq(0)
+		yield from writeStream(dut = first, data = [0x04])
+		yield from waitComplete(dut = first)
+
+	def domainSecond():
+		yield
+		yield
+		# Ask for a read while the first client has the FRAM
+		yield second.address.eq(5)
+		yield second.read.eq(1)
+		yield
+		yield second.read.eq(0)
+		assert (yield from readStream(dut = second, count = len(data))) == data
+		for _ in range(200):
+			yield
+		yield Settle()
+		assert (yield bus.cs.o) == 0
+		# The read waited for the first write, then went before the first client's second write
+		assert [transaction[:3] for transaction in transactions] == [
+			[FRAMOpcodes.writeEnable], [FRAMOpcodes.write, 0, 16],
+			[FRAMOpcodes.read, (1024 + 5) >> 8, (1024 + 5) & 0xFF],
+			[FRAMOpcodes.writeEnable], [FRAMOpcodes.write, 0, 32],
+		]
+		assert transactions[2][3:3 + len(data)] == data
+		assert {addr: memory[addr] for addr in (16, 17, 18, 32)} == {16: 0x01, 17: 0x02, 18: 0x03, 32: 0x04}
+
+	yield domainFirst, 'sync'
+	yield domainSecond, 'sync'
+	yield framDevice(bus = bus, memory = memory, transactions = transactions, ddr = ddr), 'sync'
+	yield spiTiming(bus = bus, ddr = ddr), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAMArbiter(('fram', 0), clients = 2),
+	platform = Platform())
+def sharedAccess(sim : Simulator, dut : FRAMArbiter):
+	yield from sharedSequence(dut = dut, bus = bus)
+
+# The arbiter has to hand the SCLK settings on so the FRAM asks for its pins with DDR I/O
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAMArbiter(('fram', 0), clients = 2, ddr = True),
+	platform = DDRPlatform())
+def sharedAccessDDR(sim : Simulator, dut : FRAMArbiter):
+	yield from sharedSequence(dut = dut, bus = ddrBus, ddr = True)
@@ -31,12 +31,15 @@ class DUT(Elaboratable):
 	def __init__(self, *, resource):
 		self._dut = Bus(resource = resource)
 		self._bus = self._dut._bus
-		self.cs = self._dut.cs
 		self.copi = self._dut.copi
 		self.copi_oe = self._dut.copi_oe
+		self.valid = self._dut.valid
+		self.ready = self._dut.ready
+		self.last = self._dut.last
 		self.cipo = self._dut.cipo
-		self.begin = self._dut.begin
 		self.complete = self._dut.complete
+		self.done = self._dut.done
+		self.stop = self._dut.stop
 		self.reset = Signal()
 
 	def elaborate(self, platform) -> Module:
@@ -45,47 +48,59 @@ class DUT(Elaboratable):
 		m.d.comb += ResetSignal().eq(self.reset)
 		return m
 
-def performIO(*, bus, dut, dataOut = None, dataIn = None):
-	yield Settle()
-	assert (yield dut.begin) == 0
-	if dataOut is not None:
-		yield dut.copi.eq(dataOut)
-		yield dut.copi_oe.eq(1)
-	else:
-		yield dut.copi_oe.eq(0)
-	yield dut.begin.eq(1)
-	yield
-	yield Settle()
-	yield dut.begin.eq(0)
-	yield dut.cs.eq(1)
-	yield
-	yield Settle()
-	assert (yield bus.cs.o) == 1
-	for i in range(8):
-		if dataOut is not None:
-			bit = (dataOut >> (7 - i)) & 1
+def queueBytes(*, dut, dataOut):
+	# Hand the bytes to the bus as fast as it will take them
+	for i, data in enumerate(dataOut):
+		if data is not None:
+			yield dut.copi.eq(data)
+			yield dut.copi_oe.eq(1)
 		else:
-			bit = 0
+			yield dut.copi_oe.eq(0)
+		yield dut.last.eq(i == len(dataOut) - 1)
+		yield dut.valid.eq(1)
+		while True:
+			yield Settle()
+			ready = (yield dut.ready)
+			yield
+			if ready:
+				break
+	yield dut.valid.eq(0)
+	yield dut.last.eq(0)
+
+def performIO(*, bus, dut, dataOut, dataIn):
+	# Wait for the transaction to start
+	while not (yield bus.cs.o):
 		yield
 		yield Settle()
-		assert (yield bus.clk.o) == 0
-		assert (yield bus.copi.o) == bit
-		if dataIn is not None:
-			bit = (dataIn >> (7 - i)) & 1
-			yield bus.cipo.i.eq(bit)
-		yield
+	# Check SCLK runs without gaps across every byte in the transaction
+	for data, response in zip(dataOut, dataIn):
+		for i in range(8):
+			if data is not None:
+				bit = (data >> (7 - i)) & 1
+			else:
+				bit = 0
+			yield
+			yield Settle()
+			assert (yield bus.cs.o) == 1
+			assert (yield bus.clk.o) == 0
+			assert (yield bus.copi.oe) == (1 if data is not None else 0)
+			if data is not None:
+				assert (yield bus.copi.o) == bit
+			if response is not None:
+				yield bus.cipo.i.eq((response >> (7 - i)) & 1)
+			yield
+			yield Settle()
+			assert (yield bus.clk.o) == 1
 		yield Settle()
-		assert (yield bus.clk.o) == 1
-	assert (yield dut.complete) == 1
-	yield
-	yield Settle()
-	assert (yield dut.complete) == 0
-	yield dut.cs.eq(0)
+		assert (yield dut.complete) == 1
+		if response is not None:
+			assert (yield dut.cipo) == response
+	# CS is held for a cycle after the final rising edge and then released
+	assert (yield bus.cs.o) == 1
 	yield
 	yield Settle()
-	if dataIn is not None:
-		assert (yield dut.cipo) == dataIn
-	yield
+	assert (yield bus.cs.o) == 0
+	assert (yield dut.done) == 1
 
 @sim_case(domains = (('sync', 16e6),),
 	dut = DUT(resource = bus))
@@ -97,16 +112,21 @@ def transactions(sim : Simulator, dut):
 		yield reset.eq(1)
 		yield Settle()
 		yield
-		yield dut.cs.eq(0)
-		yield
 		yield reset.eq(0)
-		yield bus.clk.o.eq(1)
 		yield Settle()
+		assert (yield bus.clk.o) == 1
 		yield
 		assert (yield bus.cs.o) == 0
 		yield
-		yield from performIO(bus = bus, dut = dut, dataOut = 0x5A)
-		yield from performIO(bus = bus, dut = dut, dataOut = 0x5A, dataIn = 0xF0)
+		yield from performIO(bus = bus, dut = dut, dataOut = (0x5A, 0xA5), dataIn = (None, None))
+		yield from performIO(bus = bus, dut = dut, dataOut = (0x5A, None, None), dataIn = (None, 0xF0, 0x0F))
 		yield
 
+	def feeder():
+		for _ in range(4):
+			yield
+		yield from queueBytes(dut = dut, dataOut = (0x5A, 0xA5))
+		yield from queueBytes(dut = dut, dataOut = (0x5A, None, None))
+
 	yield domainSync, 'sync'
+	yield feeder, 'sync'
@@ -5,10 +5,24 @@ from nmigen.hdl.rec import DIR_FANIN, DIR_FANOUT
 from nmigen.sim import *
 
 from ...fram import *
+from ...fram.fram import Opcodes as FRAMOpcodes
+from ...fram.hardBus import Registers as SPIRegisters
 
 __all__ = (
 	'read',
+	'readBurst',
 	'write',
+	'writeBurst',
+	'readBurstDDR',
+	'writeBurstDDR',
+	'readBurstDivided',
+	'writeBurstDivided',
+	'readHardBus',
+	'writeHardBus',
+	'readBurstHardBus',
+	'writeBurstHardBus',
+	'readBurstHardBusDivided',
+	'writeBurstHardBusDivided',
 )
 
 bus = Record(
@@ -29,6 +43,30 @@ bus = Record(
 	)
 )
 
+ddrBus = Record(
+	layout = (
+		('cs', [
+			('o', 1, DIR_FANOUT),
+		]),
+		('clk', [
+			('o_clk', 1, DIR_FANOUT),
+			('o0', 1, DIR_FANOUT),
+			('o1', 1, DIR_FANOUT),
+		]),
+		('copi', [
+			('o_clk', 1, DIR_FANOUT),
+			('o0', 1, DIR_FANOUT),
+			('o1', 1, DIR_FANOUT),
+			('oe', 1, DIR_FANOUT),
+		]),
+		('cipo', [
+			('i_clk', 1, DIR_FANOUT),
+			('i0', 1, DIR_FANIN),
+			('i1', 1, DIR_FANIN),
+		]),
+	)
+)
+
 class Platform:
 	@property
 	def default_clk_frequency(self):
@@ -44,76 +82,494 @@ class Platform:
 		assert number == 0
 		return bus
 
-@sim_case(domains = (('sync', 16e6),),
-	dut = FRAM(resourceName = ('fram', 0)),
-	platform = Platform())
-def read(sim : Simulator, dut):
-	data = 0x9B
+class DDRPlatform(Platform):
+	def request(self, name, number, *, xdr):
+		assert name == 'fram'
+		assert number == 0
+		assert xdr == {'clk': 2, 'copi': 2, 'cipo': 2}
+		return ddrBus
 
-	def domainSync():
-		yield
-		yield dut.address.eq(1000)
-		yield dut.read.eq(1)
-		yield
-		yield dut.read.eq(0)
-		for i in range(18):
+def spiPins(*, bus, ddr):
+	# Builds a sampler giving the (cs, clk, copi) seen on the SPI pins over each half of the current cycle,
+	# DDR outputs driven during a cycle only reach the pins over the one following it
+	outputs = [(1, 0), (1, 0)]
+
+	def sample():
+		nonlocal outputs
+		cs = (yield bus.cs.o)
+		if not ddr:
+			clk = (yield bus.clk.o)
+			copi = (yield bus.copi.o)
+			return [(cs, clk, copi), (cs, clk, copi)]
+		pins = [(cs, *outputs[0]), (cs, *outputs[1])]
+		outputs = [
+			((yield bus.clk.o0), (yield bus.copi.o0)),
+			((yield bus.clk.o1), (yield bus.copi.o1)),
+		]
+		return pins
+	return sample
+
+def spiTiming(*, bus, ddr = False, divider = 1):
+	# Checks the SPI pins half a cycle at a time against the timing the FRAM needs in mode 3
+	halfPeriod = 1 if ddr else divider * 2
+	# Abandoned reads let go of CS as soon as they can, a full cycle is still far beyond the FRAM's hold time
+	csHold = min(halfPeriod, 2)
+
+	def process():
+		yield Passive()
+		pins = spiPins(bus = bus, ddr = ddr)
+		lastCS = 0
+		lastClk = 1
+		lastCOPI = 0
+		# Half cycles since SCLK last changed, since CS last changed and since the last rising edge
+		phase = 0
+		selected = halfPeriod * 2
+		risen = 0
+		bits = 0
+		while True:
+			yield Settle()
+			for cs, clk, copi in (yield from pins()):
+				if not cs and not lastCS:
+					assert clk == 1, 'SCLK must idle high while CS is deasserted'
+				if cs != lastCS:
+					if cs:
+						assert selected >= 2, 'CS must be deasserted for at least a cycle between transactions'
+						bits = 0
+					# Abandoned transactions can drop CS anywhere, complete ones must hold it past the last edge
+					elif bits % 8 == 0:
+						assert risen >= csHold, 'CS released too soon after the final rising edge of SCLK'
+					selected = 0
+				elif cs and clk != lastClk:
+					if not clk:
+						if bits == 0:
+							assert selected >= halfPeriod, 'SCLK fell too soon after CS was asserted'
+						else:
+							assert phase >= halfPeriod, 'SCLK high phase too short'
+					else:
+						assert phase == halfPeriod, 'SCLK low phase is the wrong length'
+						bits += 1
+						risen = 0
+					phase = 0
+				if cs and lastCS and copi != lastCOPI:
+					assert not clk and lastClk, 'COPI must only change on the falling edge of SCLK'
+				phase += 1
+				selected += 1
+				risen += 1
+				lastCS = cs
+				lastClk = clk
+				lastCOPI = copi
 			yield
-		yield Settle()
-		for i in range(18):
+	return process
+
+def framDevice(*, bus, memory, transactions, ddr = False):
+	# Behavioural model of the SPI FRAM (mode 3), records each chip selected transaction seen
+	def process():
+		yield Passive()
+		pins = spiPins(bus = bus, ddr = ddr)
+		transaction = []
+		writeEnabled = False
+		lastCS = 0
+		lastClk = 1
+		value = 0
+		bits = 0
+		address = 0
+		cipo = 0
+		while True:
+			yield Settle()
+			for cs, clk, copi in (yield from pins()):
+				if cs and not lastCS:
+					transaction = []
+					value = 0
+					bits = 0
+				elif cs and clk and not lastClk:
+					# Rising edge, sample COPI
+					value = ((value << 1) | copi) & 0xFF
+					bits += 1
+					if bits == 8:
+						# Record the data handed back rather than the dummy bytes for reads
+						if len(transaction) >= 3 and transaction[0] == FRAMOpcodes.read:
+							value = memory.get(address, 0)
+						transaction.append(value)
+						bits = 0
+						opcode = transaction[0]
+						if len(transaction) == 3 and opcode in (FRAMOpcodes.read, FRAMOpcodes.write):
+							address = ((transaction[1] << 8) | transaction[2]) & 0x7FF
+						elif len(transaction) > 3 and opcode == FRAMOpcodes.write:
+							assert writeEnabled
+							memory[address] = value
+							address = (address + 1) & 0x7FF
+				elif cs and not clk and lastClk:
+					# Falling edge, drive CIPO with the next bit of read data once the address is in
+					if len(transaction) >= 3 and transaction[0] == FRAMOpcodes.read:
+						if bits == 0 and len(transaction) > 3:
+							address = (address + 1) & 0x7FF
+						data = memory.get(address, 0)
+						cipo = (data >> (7 - bits)) & 1
+						if not ddr:
+							yield bus.cipo.i.eq(cipo)
+				elif not cs and lastCS:
+					if transaction == [FRAMOpcodes.writeEnable]:
+						writeEnabled = True
+					elif transaction[:1] == [FRAMOpcodes.write]:
+						writeEnabled = False
+					transactions.append(transaction)
+				lastCS = cs
+				lastClk = clk
 			yield
-		yield Settle()
-		for i in range(18):
+			# The DDR input register captures CIPO mid-way through the cycle and hands it over a cycle later
+			if ddr:
+				yield bus.cipo.i1.eq(cipo)
+	return process
+
+def spiBlock(*, dut, bus):
+	# Behavioural model of the SB_SPI block's system bus registers and controller, standing in for the hard
+	# block HardBus drives as it has no simulation model of its own
+	hardBus = dut._bus
+
+	def process():
+		yield Passive()
+		registers = {
+			SPIRegisters.control1: 0,
+			SPIRegisters.control2: 0,
+			SPIRegisters.baudRate: 0,
+			SPIRegisters.chipSelect: 0b1111,
+		}
+		transmit = None
+		receive = 0
+		receiveReady = False
+		# The byte being shifted out and in, and how far through it we are
+		shifting = None
+		shifted = 0
+		bits = 0
+		phase = 0
+		clk = 1
+		# Accesses are acknowledged on the cycle after the strobe is seen
+		pending = False
+		yield bus.clk.o.eq(1)
+		yield bus.copi.oe.eq(0)
+		while True:
+			yield Settle()
+			yield hardBus._ack.eq(0)
+			if pending:
+				register = (yield hardBus._register)
+				if (yield hardBus._accessWrite):
+					data = (yield hardBus._dataWrite)
+					if register == SPIRegisters.transmit:
+						assert registers[SPIRegisters.control1] & 0x80, 'SPI written to while disabled'
+						assert registers[SPIRegisters.control2] & 0b1000_0110 == 0b1000_0110, \
+							'SPI block must be a mode 3 controller'
+						assert transmit is None, 'Transmit register overrun'
+						transmit = data
+					else:
+						assert register in registers, f'Write to unmodelled SPI register {register:04b}'
+						registers[register] = data
+						if register == SPIRegisters.chipSelect:
+							# Manual CS hold hands the chip select register straight to MCSNO
+							assert registers[SPIRegisters.control2] & 0b0100_0000
+							yield hardBus._chipSelects.eq(data & 0b1111)
+						elif register == SPIRegisters.control1:
+							yield bus.copi.oe.eq(data >> 7)
+				else:
+					if register == SPIRegisters.status:
+						data = (int(shifting is not None) << 7) | (int(transmit is None) << 4) | \
+							(int(receiveReady) << 3)
+					elif register == SPIRegisters.receive:
+						data = receive
+						receiveReady = False
+					else:
+						data = registers[register]
+					yield hardBus._dataRead.eq(data)
+				yield hardBus._ack.eq(1)
+				pending = False
+			elif (yield hardBus._strobe):
+				pending = True
+
+			# Mode 3 shifting, SCLK spends (BR + 1) / 2 cycles in each half of its period
+			halfPeriod = (registers[SPIRegisters.baudRate] + 1) // 2
+			if shifting is None and transmit is not None:
+				shifting = transmit
+				transmit = None
+				shifted = 0
+				bits = 0
+				phase = 0
+			if shifting is not None:
+				phase += 1
+				if phase == halfPeriod:
+					phase = 0
+					if clk:
+						clk = 0
+						yield bus.copi.o.eq((shifting >> (7 - bits)) & 1)
+					else:
+						clk = 1
+						# Let the FRAM finish driving the bit it put out on the falling edge before sampling it
+						yield Settle()
+						shifted = ((shifted << 1) | (yield bus.cipo.i)) & 0xFF
+						bits += 1
+						if bits == 8:
+							assert not receiveReady, 'Receive register overrun'
+							receive = shifted
+							receiveReady = True
+							shifting = None
+					yield bus.clk.o.eq(clk)
 			yield
-		yield Settle()
-		for i in range(2):
+	return process
+
+def readStream(*, dut, count, stall = 0):
+	# Consume a read burst of count bytes, optionally stalling before accepting each one
+	result = []
+	while len(result) < count:
+		for _ in range(stall):
 			yield
-		yield Settle()
-		for i in range(8):
-			bit = (data >> (7 - i)) & 1
-			yield bus.cipo.i.eq(bit)
+		yield dut.readReady.eq(1)
+		yield dut.last.eq(len(result) == count - 1)
+		while True:
+			yield Settle()
+			if (yield dut.readValid):
+				result.append((yield dut.dataIn))
+				break
 			yield
+		yield
+		yield dut.readReady.eq(0)
+		yield dut.last.eq(0)
+	return result
+
+def writeStream(*, dut, data):
+	# Feed a write burst to the FRAM as fast as it'll take it
+	for i, value in enumerate(data):
+		yield dut.dataOut.eq(value)
+		yield dut.writeValid.eq(1)
+		yield dut.last.eq(i == len(data) - 1)
+		while True:
+			yield Settle()
+			ready = (yield dut.writeReady)
 			yield
+			if ready:
+				break
+	yield dut.writeValid.eq(0)
+	yield dut.last.eq(0)
+
+def waitComplete(*, dut):
+	while True:
 		yield Settle()
-		assert (yield dut.complete) == 1
+		if (yield dut.complete):
+			break
 		yield
-		yield Settle()
-		assert (yield dut.dataIn) == data
+	yield
+
+def readSequence(*, dut, bus, readAhead = 0, release = 4):
+	# readAhead is how many bytes the bus clocks in past the last one before it learns it has the last, and
+	# release how many cycles it then has to let go of CS
+	memory = {1000: 0x9B}
+	transactions = []
+
+	def domainSync():
 		yield
+		yield dut.address.eq(1000)
+		yield dut.read.eq(1)
+		yield
+		yield dut.read.eq(0)
+		assert (yield from readStream(dut = dut, count = 1)) == [0x9B]
+		for _ in range(release):
+			yield
+		yield Settle()
+		assert (yield bus.cs.o) == 0
+		assert transactions == [[FRAMOpcodes.read, 1000 >> 8, 1000 & 0xFF, 0x9B] + [0] * readAhead]
+	return domainSync, memory, transactions
 
-	yield domainSync, 'sync'
+def writeSequence(*, dut, bus):
+	memory = {}
+	transactions = []
 
-@sim_case(domains = (('sync', 16e6),),
-	dut = FRAM(resourceName = ('fram', 0)),
-	platform = Platform())
-def write(sim : Simulator, dut):
 	def domainSync():
 		yield
 		yield dut.address.eq(1000)
-		yield dut.dataOut.eq(0xB9)
 		yield dut.write.eq(1)
 		yield
 		yield dut.write.eq(0)
-		for i in range(18):
-			yield
+		yield from writeStream(dut = dut, data = [0xB9])
+		yield from waitComplete(dut = dut)
 		yield Settle()
+		assert (yield bus.cs.o) == 0
+		assert memory == {1000: 0xB9}
+		assert transactions == [[FRAMOpcodes.writeEnable], [FRAMOpcodes.write, 1000 >> 8, 1000 & 0xFF, 0xB9]]
+	return domainSync, memory, transactions
+
+def readBurstSequence(*, dut, bus, release = 4):
+	data = [0x9B, 0x5A, 0xC3, 0x3C, 0xA5]
+	memory = {1000 + i: value for i, value in enumerate(data)}
+	transactions = []
+
+	def domainSync():
 		yield
-		for i in range(18):
-			yield
-		yield Settle()
-		for i in range(18):
-			yield
-		yield Settle()
-		for i in range(18):
-			yield
-		yield Settle()
-		for i in range(18):
+		yield dut.address.eq(1000)
+		yield dut.read.eq(1)
+		yield
+		yield dut.read.eq(0)
+		assert (yield from readStream(dut = dut, count = len(data))) == data
+		# And again with a consumer that can't keep up with the bus
+		yield dut.read.eq(1)
+		yield
+		yield dut.read.eq(0)
+		assert (yield from readStream(dut = dut, count = len(data), stall = 40)) == data
+		for _ in range(release):
 			yield
 		yield Settle()
+		assert (yield bus.cs.o) == 0
+		assert len(transactions) == 2
+		for transaction in transactions:
+			assert transaction[:3] == [FRAMOpcodes.read, 1000 >> 8, 1000 & 0xFF]
+			assert transaction[3:3 + len(data)] == data
+	return domainSync, memory, transactions
+
+def writeBurstSequence(*, dut, bus):
+	data = [0xB9, 0x5A, 0xC3]
+	memory = {}
+	transactions = []
+
+	def domainSync():
 		yield
-		yield Settle()
-		assert (yield dut.complete) == 1
+		yield dut.address.eq(1000)
+		yield dut.write.eq(1)
 		yield
+		yield dut.write.eq(0)
+		yield from writeStream(dut = dut, data = data)
+		yield from waitComplete(dut = dut)
 		yield Settle()
-		yield
+		assert (yield bus.cs.o) == 0
+		assert memory == {1000 + i: value for i, value in enumerate(data)}
+		assert transactions == [[FRAMOpcodes.writeEnable], [FRAMOpcodes.write, 1000 >> 8, 1000 & 0xFF, *data]]
+	return domainSync, memory, transactions
 
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0)),
+	platform = Platform())
+def read(sim : Simulator, dut):
+	domainSync, memory, transactions = readSequence(dut = dut, bus = bus)
+	yield domainSync, 'sync'
+	yield framDevice(bus = bus, memory = memory, transactions = transactions), 'sync'
+	yield spiTiming(bus = bus), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0)),
+	platform = Platform())
+def readBurst(sim : Simulator, dut):
+	domainSync, memory, transactions = readBurstSequence(dut = dut, bus = bus)
+	yield domainSync, 'sync'
+	yield framDevice(bus = bus, memory = memory, transactions = transactions), 'sync'
+	yield spiTiming(bus = bus), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0)),
+	platform = Platform())
+def write(sim : Simulator, dut):
+	domainSync, memory, transactions = writeSequence(dut = dut, bus = bus)
+	yield domainSync, 'sync'
+	yield framDevice(bus = bus, memory = memory, transactions = transactions), 'sync'
+	yield spiTiming(bus = bus), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0)),
+	platform = Platform())
+def writeBurst(sim : Simulator, dut):
+	domainSync, memory, transactions = writeBurstSequence(dut = dut, bus = bus)
+	yield domainSync, 'sync'
+	yield framDevice(bus = bus, memory = memory, transactions = transactions), 'sync'
+	yield spiTiming(bus = bus), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0), ddr = True),
+	platform = DDRPlatform())
+def readBurstDDR(sim : Simulator, dut):
+	domainSync, memory, transactions = readBurstSequence(dut = dut, bus = ddrBus)
+	yield domainSync, 'sync'
+	yield framDevice(bus = ddrBus, memory = memory, transactions = transactions, ddr = True), 'sync'
+	yield spiTiming(bus = ddrBus, ddr = True), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0), ddr = True),
+	platform = DDRPlatform())
+def writeBurstDDR(sim : Simulator, dut):
+	domainSync, memory, transactions = writeBurstSequence(dut = dut, bus = ddrBus)
+	yield domainSync, 'sync'
+	yield framDevice(bus = ddrBus, memory = memory, transactions = transactions, ddr = True), 'sync'
+	yield spiTiming(bus = ddrBus, ddr = True), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0), divider = 3),
+	platform = Platform())
+def readBurstDivided(sim : Simulator, dut):
+	domainSync, memory, transactions = readBurstSequence(dut = dut, bus = bus)
+	yield domainSync, 'sync'
+	yield framDevice(bus = bus, memory = memory, transactions = transactions), 'sync'
+	yield spiTiming(bus = bus, divider = 3), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0), divider = 3),
+	platform = Platform())
+def writeBurstDivided(sim : Simulator, dut):
+	domainSync, memory, transactions = writeBurstSequence(dut = dut, bus = bus)
+	yield domainSync, 'sync'
+	yield framDevice(bus = bus, memory = memory, transactions = transactions), 'sync'
+	yield spiTiming(bus = bus, divider = 3), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0), hardBus = True),
+	platform = Platform())
+def readHardBus(sim : Simulator, dut):
+	# With two bytes in the block, one more goes out before the last is known to be the last and has to be
+	# shifted and read back before CS can be released
+	domainSync, memory, transactions = readSequence(dut = dut, bus = bus, readAhead = 1, release = 32)
+	yield domainSync, 'sync'
+	yield spiBlock(dut = dut, bus = bus), 'sync'
+	yield framDevice(bus = bus, memory = memory, transactions = transactions), 'sync'
+	yield spiTiming(bus = bus), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0), hardBus = True),
+	platform = Platform())
+def writeHardBus(sim : Simulator, dut):
+	domainSync, memory, transactions = writeSequence(dut = dut, bus = bus)
+	yield domainSync, 'sync'
+	yield spiBlock(dut = dut, bus = bus), 'sync'
+	yield framDevice(bus = bus, memory = memory, transactions = transactions), 'sync'
+	yield spiTiming(bus = bus), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0), hardBus = True),
+	platform = Platform())
+def readBurstHardBus(sim : Simulator, dut):
+	domainSync, memory, transactions = readBurstSequence(dut = dut, bus = bus, release = 32)
+	yield domainSync, 'sync'
+	yield spiBlock(dut = dut, bus = bus), 'sync'
+	yield framDevice(bus = bus, memory = memory, transactions = transactions), 'sync'
+	yield spiTiming(bus = bus), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0), hardBus = True),
+	platform = Platform())
+def writeBurstHardBus(sim : Simulator, dut):
+	domainSync, memory, transactions = writeBurstSequence(dut = dut, bus = bus)
+	yield domainSync, 'sync'
+	yield spiBlock(dut = dut, bus = bus), 'sync'
+	yield framDevice(bus = bus, memory = memory, transactions = transactions), 'sync'
+	yield spiTiming(bus = bus), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0), hardBus = True, divider = 3),
+	platform = Platform())
+def readBurstHardBusDivided(sim : Simulator, dut):
+	domainSync, memory, transactions = readBurstSequence(dut = dut, bus = bus, release = 64)
+	yield domainSync, 'sync'
+	yield spiBlock(dut = dut, bus = bus), 'sync'
+	yield framDevice(bus = bus, memory = memory, transactions = transactions), 'sync'
+	yield spiTiming(bus = bus, divider = 3), 'sync'
+
+@sim_case(domains = (('sync', 16e6),),
+	dut = FRAM(resourceName = ('fram', 0), hardBus = True, divider = 3),
+	platform = Platform())
+def writeBurstHardBusDivided(sim : Simulator, dut):
+	domainSync, memory, transactions = writeBurstSequence(dut = dut, bus = bus)
 	yield domainSync, 'sync'
+	yield spiBlock(dut = dut, bus = bus), 'sync'
+	yield framDevice(bus = bus, memory = memory, transactions = transactions), 'sync'
+	yield spiTiming(bus = bus, divider = 3), 'sync'
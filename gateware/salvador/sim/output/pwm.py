@@ -0,0 +1,65 @@
+from arachne.core.sim import sim_case
+from nmigen.sim import *
+
+from ...output.pwm import PWMOutput, Modulation
+
+__all__ = (
+	'pwm',
+	'dithered',
+	'sigmaDelta',
+)
+
+class Platform:
+	@property
+	def default_clk_frequency(self):
+		return float(1e6)
+
+def measure(dut, duty, *, clocks):
+	# Set the duty and give it time to cross over and take effect, then count how many clocks the output is high for
+	yield dut.duty.eq(duty)
+	for _ in range(2 * clocks):
+		yield
+	high = 0
+	for _ in range(clocks):
+		yield
+		high += (yield dut.output)
+	return high
+
+@sim_case(domains = (('sync', 1e6), ('pwm', 4e6)),
+	dut = PWMOutput(bits = 10, modulation = Modulation.pwm), platform = Platform())
+def pwm(sim : Simulator, dut : PWMOutput):
+	def domainPWM():
+		# Each period is 1023 clocks, all of duty going into the pulse width
+		for duty in (0, 1, 300, 1023):
+			assert (yield from measure(dut, duty, clocks = 1023)) == duty
+	yield domainPWM, 'pwm'
+
+@sim_case(domains = (('sync', 1e6), ('pwm', 4e6)),
+	dut = PWMOutput(bits = 10, modulation = Modulation.dithered, pwmBits = 6), platform = Platform())
+def dithered(sim : Simulator, dut : PWMOutput):
+	def domainPWM():
+		# 63 clock periods, with the bottom 4 bits of duty spread over 16 of them. Measuring across period
+		# boundaries can be a clock out, as can the top half of the range which adds one to make full scale fully on
+		for duty in (0, 1, 300, 700):
+			assert abs((yield from measure(dut, duty, clocks = 63 * 16)) - duty) <= 2
+		assert (yield from measure(dut, 1023, clocks = 63 * 16)) == 63 * 16
+	yield domainPWM, 'pwm'
+
+@sim_case(domains = (('sync', 1e6), ('pwm', 4e6)),
+	dut = PWMOutput(bits = 10, modulation = Modulation.sigmaDelta), platform = Platform())
+def sigmaDelta(sim : Simulator, dut : PWMOutput):
+	def domainPWM():
+		for duty in (0, 1, 300):
+			assert (yield from measure(dut, duty, clocks = 1024)) == duty
+		assert (yield from measure(dut, 1023, clocks = 1024)) == 1024
+		# Small duties come out as evenly spread single clock pulses rather than one wide one
+		yield dut.duty.eq(4)
+		for _ in range(2048):
+			yield
+		edges = []
+		for clock in range(1024):
+			yield
+			if (yield dut.output):
+				edges.append(clock)
+		assert [later - earlier for earlier, later in zip(edges, edges[1:])] == [256, 256, 256]
+	yield domainPWM, 'pwm'
@@ -0,0 +1,108 @@
+from arachne.core.sim import sim_case
+from nmigen import Record
+from nmigen.build import Resource, Subsignal, Pins
+from nmigen.hdl.rec import DIR_FANIN, DIR_FANOUT
+from nmigen.sim import *
+
+from ..salvador import Salvador
+from ..platform import SalvadorPlatform
+from ..dali.dali import DALI
+from ..dali.persist import PersistLayout, crc16
+from .dali.dali import fram_spi, sendCommand, query, waitBitTime
+from .fram.fram import framDevice
+
+__all__ = (
+	'sharedFRAM',
+	'outputPins',
+)
+
+interfaces = tuple(
+	Record(
+		layout = (
+			('rx', [
+				('i', 1, DIR_FANIN),
+			]),
+			('tx', [
+				('o', 1, DIR_FANOUT),
+			])
+		),
+		name = f'dali_{bus}',
+	) for bus in range(2)
+)
+
+class Platform:
+	@property
+	def default_clk_frequency(self):
+		return float(1e6)
+
+	def lookup(self, name, number):
+		if name == 'dali':
+			assert number < len(interfaces)
+			return Resource('dali', number, Subsignal('rx', Pins('0', dir = 'i')), Subsignal('tx', Pins('1', dir = 'o')))
+		assert name == 'fram'
+		assert number == 0
+		return Resource('fram', 0, Subsignal('copi', Pins('0', dir = 'o')))
+
+	def request(self, name, number):
+		if name == 'dali':
+			return interfaces[number]
+		assert name == 'fram'
+		assert number == 0
+		return fram_spi
+
+@sim_case(domains = (('sync', 1e6),), dut = Salvador(buses = 2), platform = Platform())
+def sharedFRAM(sim : Simulator, dut : Salvador):
+	bitRate = 2400
+	# The FRAM starts out blank, so both buses put their defaults back and rewrite their images as they start up.
+	# Each bus has half the FRAM, the second's window starting 1024 bytes in
+	memory = {}
+	length = sum(length for _, length in DALI.persistedRegisters)
+	imageLength = PersistLayout.headerLength + length + PersistLayout.crcLength
+	sceneAddress = PersistLayout.headerLength + sum(length for _, length in
+		DALI.persistedRegisters[:[name for name, _ in DALI.persistedRegisters].index('scene0')])
+
+	def domainFirst():
+		yield interfaces[0].rx.i.eq(1)
+		yield from waitBitTime(1e6, bitRate)
+		# Keep asking the first bus for scene 2 while the second is storing and writing it back, which is
+		# never held up and never sees the second bus's value
+		for _ in range(8):
+			assert (yield from query(0b1111_1111_1011_0010, interface = interfaces[0], clkFreq = 1e6,
+				bitRate = bitRate)) == 0xFF
+
+	def domainSecond():
+		yield interfaces[1].rx.i.eq(1)
+		yield from waitBitTime(1e6, bitRate)
+		# Send "Download to DTR" w/ payload of 0x42 and broadcast "Store DTR as Scene 2" on the second bus
+		yield from sendCommand(0b1010_0011_0100_0010, interface = interfaces[1], clkFreq = 1e6, bitRate = bitRate)
+		yield from sendCommand(0b1111_1111_0100_0010, interface = interfaces[1], clkFreq = 1e6, bitRate = bitRate)
+		assert (yield from query(0b1111_1111_1011_0010, interface = interfaces[1], clkFreq = 1e6,
+			bitRate = bitRate)) == 0x42
+		# Wait for the first bus to finish and both to sit out their write back holdoffs, then check each bus's
+		# image landed intact in its own window
+		for _ in range(500):
+			yield from waitBitTime(1e6, 1000)
+		for base in (0, 1024):
+			image = bytes(memory.get(base + addr, 0) for addr in range(imageLength))
+			assert crc16(image) == 0
+		assert memory[sceneAddress + 2] == 0xFF
+		assert memory[1024 + sceneAddress + 2] == 0x42
+
+	yield domainFirst, 'sync'
+	yield domainSecond, 'sync'
+	yield framDevice(bus = fram_spi, memory = memory, transactions = []), 'sync'
+
+# The board itself, which has to find a pin for each gear's output
+board = SalvadorPlatform()
+
+@sim_case(domains = (('sync', 16e6),), dut = Salvador(gearCount = 2, outputs = True), platform = board)
+def outputPins(sim : Simulator, dut : Salvador):
+	def domainSync():
+		yield
+		# Check the gears' outputs went to the first two PWM pins, alongside the DALI bus and FRAM
+		pins = {port: pin for port, pin, _ in board.iter_port_constraints_bits()}
+		assert pins['pwm_0__io'] == '11'
+		assert pins['pwm_1__io'] == '12'
+		assert pins['dali_0__tx__io'] == '10'
+		assert pins['fram_0__cs__io'] == '36'
+	yield domainSync, 'sync'